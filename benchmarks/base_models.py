@@ -0,0 +1,225 @@
+"""
+Benchmarks of the whole-matrix simulation kernels
+against the per-sample loops they replaced, on the
+bundled 88soils and keyboard tables.
+"""
+import os
+
+import numpy as np
+from biom import Table, load_table
+from scipy.sparse import random as sparse_random
+from numpy.random import (poisson, lognormal, gamma,
+                          dirichlet, multinomial)
+from birdman_jr.base_models import (poisson_lognormal,
+                                    negative_binomial,
+                                    BACKENDS,
+                                    MULTINOMIAL_METHODS,
+                                    input_matrix_validation,
+                                    output_matrix_validation,
+                                    _poisson_lognormal,
+                                    _negative_binomial,
+                                    _dirichlet_multinomial)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "notebooks", "data")
+DATASETS = ["88soils", "keyboard", "keyboard-x50"]
+
+
+def load_dataset(name):
+    # "<name>-x<k>" tiles the samples of a bundled
+    # table k times to mimic a many-sample study
+    name, _, tiles = name.partition("-x")
+    table = load_table(os.path.join(DATA_DIR, name, "table.biom"))
+    mat = table.matrix_data.toarray().T
+    if tiles:
+        mat = np.tile(mat, (int(tiles), 1))
+    depths = mat.sum(1).reshape(mat.shape[0], -1)
+    return mat, depths
+
+
+def synthetic_table(n_samples, n_features, density, seed=0):
+    """
+    Sparse (features x samples) table with about
+    density nonzero counts, scaled up from nothing
+    but its shape, with a log-normal spread of
+    feature abundances and sample depths.
+    """
+    rng = np.random.default_rng(seed)
+    mat = sparse_random(n_samples, n_features, density=density,
+                        format="csr", random_state=rng)
+    abundances = rng.lognormal(0, 2, n_features)
+    mat.data = np.ceil(mat.data * abundances[mat.indices] * 10)
+    mat = mat.multiply(rng.lognormal(0, 0.5, (n_samples, 1))).tocsr()
+    mat.data = np.ceil(mat.data)
+    # every sample needs at least one count
+    mat[np.flatnonzero(mat.getnnz(1) == 0), 0] = 1
+    return Table(mat.T.tocsr(), ["F%i" % i for i in range(n_features)],
+                 ["S%i" % i for i in range(n_samples)])
+
+
+def loop_poisson_lognormal(mat, depths, kappa=1):
+    mu = depths * mat
+    with np.errstate(divide="ignore"):
+        return np.vstack([poisson(lognormal(np.log(mu[i, :]), kappa))
+                          for i in range(mat.shape[0])])
+
+
+def loop_negative_binomial(mat, depths, kappa=1):
+    mu = depths * mat
+    return np.vstack([poisson(gamma(kappa, mu[i, :] / kappa))
+                      for i in range(mat.shape[0])])
+
+
+def loop_dirichlet_multinomial(mat, depths, use_dirichlet=False):
+    if use_dirichlet:
+        return np.vstack([multinomial(depths[i, 0], dirichlet(mat[i, :]))
+                          for i in range(mat.shape[0])])
+    return np.vstack([multinomial(depths[i, 0], mat[i, :])
+                      for i in range(mat.shape[0])])
+
+
+class Kernels:
+
+    params = (DATASETS, ["vectorized", "loop"])
+    param_names = ["dataset", "implementation"]
+
+    def setup(self, dataset, implementation):
+        mat, self.depths = load_dataset(dataset)
+        self.mat = input_matrix_validation(mat, self.depths)
+        self.mat_dirichlet = input_matrix_validation(mat + 0.001,
+                                                     self.depths)
+        self.rng = np.random.default_rng(42)
+        self.vectorized = implementation == "vectorized"
+
+    def time_poisson_lognormal(self, dataset, implementation):
+        if self.vectorized:
+            _poisson_lognormal(self.mat, self.depths, 1, self.rng)
+        else:
+            loop_poisson_lognormal(self.mat, self.depths)
+
+    def time_negative_binomial(self, dataset, implementation):
+        if self.vectorized:
+            _negative_binomial(self.mat, self.depths, 1, self.rng)
+        else:
+            loop_negative_binomial(self.mat, self.depths)
+
+    def time_multinomial(self, dataset, implementation):
+        if self.vectorized:
+            _dirichlet_multinomial(self.mat, self.depths,
+                                   False, self.rng)
+        else:
+            loop_dirichlet_multinomial(self.mat, self.depths)
+
+    def time_dirichlet_multinomial(self, dataset, implementation):
+        if self.vectorized:
+            _dirichlet_multinomial(self.mat_dirichlet, self.depths,
+                                   True, self.rng)
+        else:
+            loop_dirichlet_multinomial(self.mat_dirichlet, self.depths,
+                                       use_dirichlet=True)
+
+
+class MultinomialMethods:
+    """
+    Multinomial samplers on high-dimensional
+    compositions, with depths much smaller than
+    (1e3), comparable to (1e5) and much larger
+    than (1e7) the number of features.
+    """
+
+    params = (MULTINOMIAL_METHODS, [10 ** 3, 10 ** 5, 10 ** 7])
+    param_names = ["method", "depth"]
+
+    def setup(self, method, depth):
+        if method == "cdf" and depth > 10 ** 5:
+            # one categorical draw per read
+            raise NotImplementedError
+        rng = np.random.default_rng(0)
+        self.mat = rng.dirichlet(np.full(200000, 0.5), size=8)
+        self.depths = np.full((self.mat.shape[0], 1), depth)
+        self.rng = np.random.default_rng(42)
+
+    def time_multinomial(self, method, depth):
+        _dirichlet_multinomial(self.mat, self.depths, False, self.rng,
+                               method)
+
+
+class Parallel:
+
+    params = ([1, 2, 4],)
+    param_names = ["n_jobs"]
+
+    def setup(self, n_jobs):
+        self.mat, self.depths = load_dataset("keyboard-x50")
+
+    def time_poisson_lognormal(self, n_jobs):
+        poisson_lognormal(self.mat, self.depths, seed=42, n_jobs=n_jobs)
+
+
+class OutputValidation:
+
+    params = (DATASETS,)
+    param_names = ["dataset"]
+
+    def setup(self, dataset):
+        mat, depths = load_dataset(dataset)
+        mat = input_matrix_validation(mat, depths)
+        self.sim = _dirichlet_multinomial(mat, depths, False,
+                                          np.random.default_rng(42))
+
+    def peakmem_output_matrix_validation(self, dataset):
+        output_matrix_validation(self.sim)
+
+    def time_output_matrix_validation(self, dataset):
+        output_matrix_validation(self.sim)
+
+
+class Precision:
+
+    params = (["float64", "float32"],)
+    param_names = ["dtype"]
+
+    def setup(self, dtype):
+        self.mat, self.depths = load_dataset("keyboard-x50")
+        self.dtype = np.dtype(dtype).type
+
+    def time_poisson_lognormal(self, dtype):
+        poisson_lognormal(self.mat, self.depths, seed=42, dtype=self.dtype)
+
+    def peakmem_poisson_lognormal(self, dtype):
+        poisson_lognormal(self.mat, self.depths, seed=42, dtype=self.dtype)
+
+
+class Backends:
+    """
+    numpy and fused numba backends of the pln and
+    nb kernels on uniform float32 tables of up to
+    10k samples x 50k features (2 GB of input). The
+    numpy path holds the closure, the rates and the
+    int64 counts at once, the numba one only the
+    uint32 counts.
+    """
+
+    params = (BACKENDS, [(1000, 5000), (10000, 5000), (10000, 50000)])
+    param_names = ["backend", "shape"]
+    timeout = 600
+
+    def setup(self, backend, shape):
+        rng = np.random.default_rng(0)
+        self.mat = rng.random(shape, dtype=np.float32)
+        self.depths = rng.integers(10 ** 4, 10 ** 5, size=(shape[0], 1))
+        # compile the numba kernels outside of the timings
+        poisson_lognormal(self.mat[:2], self.depths[:2],
+                          dtype=np.float32, backend=backend)
+
+    def time_poisson_lognormal(self, backend, shape):
+        poisson_lognormal(self.mat, self.depths, seed=42,
+                          dtype=np.float32, backend=backend)
+
+    def time_negative_binomial(self, backend, shape):
+        negative_binomial(self.mat, self.depths, seed=42,
+                          dtype=np.float32, backend=backend)
+
+    def peakmem_poisson_lognormal(self, backend, shape):
+        poisson_lognormal(self.mat, self.depths, seed=42,
+                          dtype=np.float32, backend=backend)
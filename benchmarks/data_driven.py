@@ -0,0 +1,57 @@
+"""
+Benchmarks of data-driven simulation, comparing
+repeated simulate() calls with simulate_replicates,
+which shares the input preparation across replicates,
+and a full simulate() with seeding="sample" with the
+resimulate() of the new samples only.
+"""
+from biom import load_table
+from birdman_jr.data_driven import (simulate, simulate_replicates,
+                                    resimulate)
+
+from .base_models import DATA_DIR, DATASETS
+
+N_REPLICATES = 10
+
+
+class Replicates:
+
+    params = (DATASETS[:2], [False, True])
+    param_names = ["dataset", "impose_noise"]
+
+    def setup(self, dataset, impose_noise):
+        self.table = load_table("%s/%s/table.biom" % (DATA_DIR, dataset))
+
+    def time_simulate_loop(self, dataset, impose_noise):
+        for _ in range(N_REPLICATES):
+            simulate(self.table, distribution="m",
+                     impose_noise=impose_noise)
+
+    def time_simulate_replicates(self, dataset, impose_noise):
+        for _ in simulate_replicates(self.table, N_REPLICATES,
+                                     distribution="m",
+                                     impose_noise=impose_noise):
+            pass
+
+
+class Resimulate:
+
+    params = DATASETS[:2]
+    param_names = ["dataset"]
+
+    def setup(self, dataset):
+        self.table = load_table("%s/%s/table.biom" % (DATA_DIR, dataset))
+        # a previous simulation without the last tenth of the samples
+        ids = self.table.ids()
+        old = self.table.filter(ids[:len(ids) - len(ids) // 10],
+                                inplace=False)
+        self.previous = simulate(old, seed=42, seeding="sample")
+
+    def time_simulate_block(self, dataset):
+        simulate(self.table, seed=42)
+
+    def time_simulate_sample(self, dataset):
+        simulate(self.table, seed=42, seeding="sample")
+
+    def time_resimulate(self, dataset):
+        resimulate(self.previous, self.table, 42)
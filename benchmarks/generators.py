@@ -0,0 +1,34 @@
+"""
+Benchmarks of the broadcast Gaussian generators on
+large synthetic designs.
+"""
+import numpy as np
+from birdman_jr.generators import gradient, blocks
+
+
+class Generators:
+
+    params = ([10000, 100000], ["float64", "float32"])
+    param_names = ["n_features", "dtype"]
+
+    def setup(self, n_features, dtype):
+        self.g = np.linspace(0, 10, 500)
+        self.mu = np.linspace(0, 10, n_features)
+        self.sigma = np.ones(n_features)
+        self.dtype = np.dtype(dtype).type
+
+    def time_gradient(self, n_features, dtype):
+        gradient(self.g, self.mu, self.sigma, dtype=self.dtype)
+
+    def peakmem_gradient_chunked(self, n_features, dtype):
+        gradient(self.g, self.mu, self.sigma, dtype=self.dtype,
+                 chunk_size=64)
+
+    def peakmem_gradient(self, n_features, dtype):
+        gradient(self.g, self.mu, self.sigma, dtype=self.dtype)
+
+    def time_blocks(self, n_features, dtype):
+        blocks(n_features, 500, 10, overlap=4, dtype=self.dtype)
+
+    def peakmem_blocks(self, n_features, dtype):
+        blocks(n_features, 500, 10, overlap=4, dtype=self.dtype)
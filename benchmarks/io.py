@@ -0,0 +1,41 @@
+"""
+Benchmarks of loading a subset of the samples of
+a large HDF5 biom file against loading all of it.
+"""
+import os
+
+import h5py
+import numpy as np
+from biom import load_table
+from birdman_jr.data_driven import simulate
+from birdman_jr.io import load_subset
+from .base_models import synthetic_table
+
+
+class LoadSubset:
+
+    params = ([100, 1000],)
+    param_names = ["n_selected"]
+    timeout = 300
+
+    def setup_cache(self):
+        # written once and shared by the benchmarks
+        path = os.path.abspath("reference.biom")
+        table = synthetic_table(20000, 2000, 0.05)
+        with h5py.File(path, "w") as fh:
+            table.to_hdf5(fh, "benchmark")
+        return path
+
+    def setup(self, path, n_selected):
+        rng = np.random.default_rng(0)
+        self.sample_ids = ["S%i" % i for i in
+                           rng.choice(20000, n_selected, replace=False)]
+
+    def time_load_subset(self, path, n_selected):
+        load_subset(path, self.sample_ids)
+
+    def time_load_table_and_filter(self, path, n_selected):
+        load_table(path).filter(self.sample_ids, inplace=False)
+
+    def time_simulate_subset(self, path, n_selected):
+        simulate(path, seed=42, sample_ids=self.sample_ids)
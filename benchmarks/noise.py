@@ -0,0 +1,51 @@
+"""
+Benchmarks of the blockwise log-space noise against
+the ALR implementation it replaced, and of the noise
+on the stored entries of sparse tables.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+from skbio.stats.composition import alr, alr_inv
+from birdman_jr.noise import add_noise
+from .base_models import load_dataset, DATASETS
+
+
+def alr_add_noise(mat, pseudocount=1, percent_normal=0.1,
+                  percent_random=0.1, random_count=1, rng=None):
+    mat_noise = alr(mat + pseudocount)
+    err = percent_normal * np.ones_like(mat_noise)
+    mat_noise = mat_noise + err * rng.standard_normal(mat_noise.shape)
+    err = percent_random * np.ones_like(mat_noise)
+    n_entries = int(percent_random * np.count_nonzero(mat_noise))
+    i = rng.integers(0, err.shape[0], n_entries)
+    j = rng.integers(0, err.shape[1], n_entries)
+    err[i, j] = random_count
+    mat_noise += err * rng.standard_normal(mat_noise.shape)
+    mat_noise = alr_inv(mat_noise)
+    mat_noise[mat == 0] = 0
+    return mat_noise
+
+
+class Noise:
+
+    params = (DATASETS, ["log", "alr", "sparse"])
+    param_names = ["dataset", "implementation"]
+
+    def setup(self, dataset, implementation):
+        self.mat, _ = load_dataset(dataset)
+        self.mat = self.mat.astype(np.float64)
+        if implementation == "sparse":
+            self.mat = csr_matrix(self.mat)
+        self.implementation = implementation
+
+    def _add_noise(self):
+        if self.implementation == "alr":
+            alr_add_noise(self.mat, rng=np.random.default_rng(42))
+        else:
+            add_noise(self.mat, seed=42)
+
+    def time_add_noise(self, dataset, implementation):
+        self._add_noise()
+
+    def peakmem_add_noise(self, dataset, implementation):
+        self._add_noise()
@@ -0,0 +1,62 @@
+"""
+Benchmarks of the CmdStan CSV parser and its cache
+in stan-tmp/parse.py, on synthetic sim_nb outputs.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from birdman_jr.regression import negative_binomial_regression
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "stan-tmp"))
+import parse  # noqa: E402
+
+
+def write_stan_csv(path, draws):
+    names, values = [], []
+    for name in parse.VARIABLES:
+        array = draws[name]
+        shape = array.shape[1:]
+        for flat in range(int(np.prod(shape))):
+            dims = np.unravel_index(flat, shape, order="F")
+            names.append(".".join([name] + [str(i + 1) for i in dims]))
+        values.append(array.reshape(len(array), -1, order="F"))
+    with open(path, "w") as fh:
+        fh.write("# model = sim_nb_model\n")
+        fh.write(",".join(["lp__", "accept_stat__"] + names) + "\n")
+        np.savetxt(fh, np.hstack([np.zeros((len(values[0]), 2))] + values),
+                   delimiter=",", fmt="%.6g")
+        fh.write("# \n#  Elapsed Time: 0 seconds (Total)\n")
+
+
+class ReadFile:
+
+    params = ([100, 1000], [20, 200])
+    param_names = ["n_draws", "n_features"]
+    timeout = 300
+
+    def setup(self, n_draws, n_features):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "sim_nb-1.csv")
+        x = np.ones((50, 2))
+        x[:25, 1] = 0
+        write_stan_csv(self.path, negative_binomial_regression(
+            x, np.log(np.full(50, 100)), n_features, n_draws=n_draws,
+            seed=42))
+        self.cache_dir = os.path.join(self.tmp, "cache")
+        parse.read_cached(self.path, self.cache_dir)
+
+    def teardown(self, n_draws, n_features):
+        shutil.rmtree(self.tmp)
+
+    def time_read_file(self, n_draws, n_features):
+        parse.read_file(self.path)
+
+    def peakmem_read_file(self, n_draws, n_features):
+        parse.read_file(self.path)
+
+    def time_read_cached(self, n_draws, n_features):
+        parse.read_cached(self.path, self.cache_dir)["y_sim"].sum()
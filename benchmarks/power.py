@@ -0,0 +1,44 @@
+"""
+Benchmarks of the batched power analysis against
+simulate and a scipy test per replicate.
+"""
+import os
+
+import numpy as np
+from biom import load_table
+from scipy.stats import false_discovery_control, ttest_ind
+from birdman_jr.data_driven import simulate
+from birdman_jr.power import power_analysis
+from .base_models import DATA_DIR
+
+N_REPLICATES = 50
+
+
+class Power:
+
+    params = (["88soils", "keyboard"],)
+    param_names = ["dataset"]
+
+    def setup(self, dataset):
+        self.table = load_table(os.path.join(DATA_DIR, dataset,
+                                             "table.biom"))
+        n_samples, n_features = self.table.shape[::-1]
+        self.groups = np.arange(n_samples) % 2 == 1
+        self.lfc = np.zeros(n_features)
+        self.lfc[:n_features // 10] = 1
+
+    def time_power_analysis(self, dataset):
+        power_analysis(self.table, self.groups, self.lfc,
+                       n_replicates=N_REPLICATES, tests=["t"], seed=42)
+
+    def time_simulate_per_replicate(self, dataset):
+        # without the effects, only the cost of the loop
+        for r in range(N_REPLICATES):
+            table = simulate(self.table, seed=r)
+            keep = np.isin(self.table.ids(), table.ids())
+            clr = np.log(table.matrix_data.toarray().T + 0.5)
+            clr -= clr.mean(1, keepdims=True)
+            pvalues = ttest_ind(clr[self.groups[keep]],
+                                clr[~self.groups[keep]],
+                                equal_var=False).pvalue
+            false_discovery_control(np.nan_to_num(pvalues, nan=1.0))
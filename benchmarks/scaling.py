@@ -0,0 +1,78 @@
+"""
+Time and peak memory of simulate and add_noise for
+every distribution, over the bundled tables and
+synthetic tables of growing samples x features x
+sparsity.
+"""
+import os
+
+import numpy as np
+from biom import load_table
+from birdman_jr.data_driven import simulate
+from birdman_jr.noise import add_noise
+from .base_models import DATA_DIR, synthetic_table
+
+DISTRIBUTIONS = ["pln", "nb", "dm", "m"]
+SAMPLES = [100, 2000]
+FEATURES = [500, 5000]
+DENSITIES = [0.02, 0.2]
+
+
+class Datasets:
+
+    params = (["88soils", "keyboard"], DISTRIBUTIONS, [False, True])
+    param_names = ["dataset", "distribution", "sparse"]
+
+    def setup(self, dataset, distribution, sparse):
+        self.table = load_table(os.path.join(DATA_DIR, dataset,
+                                             "table.biom"))
+
+    def time_simulate(self, dataset, distribution, sparse):
+        simulate(self.table, distribution=distribution, sparse=sparse,
+                 seed=42)
+
+    def peakmem_simulate(self, dataset, distribution, sparse):
+        simulate(self.table, distribution=distribution, sparse=sparse,
+                 seed=42)
+
+
+class Synthetic:
+
+    params = (SAMPLES, FEATURES, DENSITIES, DISTRIBUTIONS, [False, True])
+    param_names = ["n_samples", "n_features", "density", "distribution",
+                   "sparse"]
+    timeout = 300
+
+    def setup(self, n_samples, n_features, density, distribution, sparse):
+        self.table = synthetic_table(n_samples, n_features, density)
+
+    def time_simulate(self, n_samples, n_features, density, distribution,
+                      sparse):
+        simulate(self.table, distribution=distribution, sparse=sparse,
+                 seed=42)
+
+    def peakmem_simulate(self, n_samples, n_features, density,
+                         distribution, sparse):
+        simulate(self.table, distribution=distribution, sparse=sparse,
+                 seed=42)
+
+
+class Noise:
+
+    params = (SAMPLES, FEATURES, DENSITIES, [False, True])
+    param_names = ["n_samples", "n_features", "density", "sparse"]
+
+    def setup(self, n_samples, n_features, density, sparse):
+        mat = synthetic_table(n_samples, n_features,
+                              density).matrix_data.T.tocsr()
+        self.mat = mat if sparse else mat.toarray()
+
+    def time_add_noise(self, n_samples, n_features, density, sparse):
+        add_noise(self.mat, seed=42)
+
+    def peakmem_add_noise(self, n_samples, n_features, density, sparse):
+        add_noise(self.mat, seed=42)
+
+    def time_add_noise_float32(self, n_samples, n_features, density,
+                               sparse):
+        add_noise(self.mat, seed=42, dtype=np.float32)
@@ -0,0 +1,34 @@
+"""
+Benchmarks of a parameter sweep against one call
+of simulate per grid point.
+"""
+import os
+
+from biom import load_table
+from birdman_jr.data_driven import simulate
+from birdman_jr.sweep import sweep, expand_grid
+from .base_models import DATA_DIR
+
+GRID = {"distribution": ["pln", "dm"],
+        "kappa": [0.5, 1, 2],
+        "pseudocount": [0.5, 1],
+        "impose_noise": [False, True]}
+
+
+class Sweep:
+
+    params = (["88soils", "keyboard"],)
+    param_names = ["dataset"]
+
+    def setup(self, dataset):
+        self.table = load_table(os.path.join(DATA_DIR, dataset,
+                                             "table.biom"))
+
+    def time_sweep(self, dataset):
+        _, tables = sweep(self.table, GRID, seed=42)
+        for _ in tables:
+            pass
+
+    def time_simulate_per_point(self, dataset):
+        for params in expand_grid(GRID).to_dict("records"):
+            simulate(self.table, seed=42, **params)
@@ -1,10 +1,29 @@
+from importlib.util import find_spec
+
 import numpy as np
+from scipy.sparse import csr_matrix, issparse
 from skbio.stats.composition import closure
-from numpy.random import (poisson, lognormal, gamma,
-                          dirichlet, multinomial)
-
-
-def poisson_lognormal(mat, depths, kappa=1):
+from birdman_jr.parallel import (as_seed_sequence, as_generator,
+                                 child_sequence,
+                                 run_blocks, worker_pool, KERNEL_STREAM)
+
+# rows per block of the single sweep of output_matrix_validation
+_SWEEP_ROWS = 1024
+# samplers of the multinomial step of dirichlet_multinomial
+MULTINOMIAL_METHODS = ["numpy", "cdf", "poisson"]
+# categorical draws held in memory at once by the cdf sampler
+_CDF_DRAWS = 2 ** 22
+# backends of the pln and nb kernels
+BACKENDS = ["numpy", "numba"]
+# rows per seeded block of the numba backend
+_JIT_ROWS = 64
+# numba is optional, the "numba" backend falls back to
+# numpy without it (birdman_jr.jit is imported on use)
+_HAS_NUMBA = find_spec("numba") is not None
+
+
+def poisson_lognormal(mat, depths, kappa=1, seed=None, n_jobs=None,
+                      dtype=np.float64, backend="numpy"):
 
     """
     Simulate from counts, probabilities, or
@@ -13,23 +32,58 @@ def poisson_lognormal(mat, depths, kappa=1):
 
     Parameters
     ----------
-    mat: array_like
+    mat: array_like or scipy.sparse matrix
         matrix of strictly positive counts
         or probabilities/proportions.
         columns = features (components)
         rows = samples (compositions)
+        If sparse, only the stored entries
+        (the support) are simulated.
     depth : array_like
         Read depth of the simulation
         for each sample (row).
-    kappa: float
-        Over-dispersion parameter.
+    kappa: float or array_like
+        Over-dispersion parameter, one value
+        or one per feature (column).
         Default is 1.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed of the random streams. Samples
+        are drawn in blocks, each from its own
+        child stream, so for a given seed the
+        output does not depend on n_jobs.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes the sample
+        blocks are sharded over. None or 1 runs
+        serially, -1 uses all CPUs.
+        Default is None.
+    dtype: np.float64 or np.float32
+        Floating point precision of the
+        computation. np.float32 halves the
+        memory of every intermediate and
+        stores the counts as np.uint16 when
+        no count overflows it.
+        Default is np.float64.
+    backend: str
+        "numpy" runs the closure, the draws and
+        the output filtering as whole-matrix
+        numpy operations. "numba" fuses them
+        into one compiled pass per row of a
+        dense matrix, with blocks of rows drawn
+        in parallel threads (n_jobs is ignored,
+        see numba.set_num_threads). Its draws
+        come from numba's generator, so for a
+        given seed they differ from the numpy
+        ones. Sparse input and installs without
+        numba use numpy.
+        Default is "numpy".
 
     Returns
     -------
     array_like, np.int
        A matrix of counts simulated from
        the input mat by the distribution.
+       Sparse (CSR) if mat is sparse.
     list, bool
         Mask of rows that summed to zero
     list, bool
@@ -52,21 +106,27 @@ def poisson_lognormal(mat, depths, kappa=1):
        Raises an error if the matrix has more than 2 dimension.
     ValueError
        Raises an error if there is a row that has all zeros.
+    ValueError
+       Raises an error if dtype is not np.float32 or np.float64.
+    ValueError
+       Raises an error if backend is unknown.
 
     """
 
+    if _use_jit(mat, backend):
+        return _fused_simulate(mat, depths, "pln", kappa, seed, dtype)
     # check matrix and ensure
     # data is proportions
-    mat = input_matrix_validation(mat, depths)
+    mat = input_matrix_validation(mat, depths, dtype=dtype)
     # simulate from proportions
-    mu = depths * mat
-    sim = np.vstack([poisson(lognormal(np.log(mu[i, :]), kappa))
-                     for i in range(mat.shape[0])])
+    sim = _simulate_seeded(mat, depths, "pln", kappa, seed, n_jobs,
+                           out_dtype=_draw_dtype(dtype))
 
-    return output_matrix_validation(sim)
+    return output_matrix_validation(sim, compact=dtype == np.float32)
 
 
-def negative_binomial(mat, depths, kappa=1):
+def negative_binomial(mat, depths, kappa=1, seed=None, n_jobs=None,
+                      dtype=np.float64, backend="numpy"):
 
     """
     Simulate from counts, probabilities, or
@@ -75,23 +135,58 @@ def negative_binomial(mat, depths, kappa=1):
 
     Parameters
     ----------
-    mat: array_like
+    mat: array_like or scipy.sparse matrix
         matrix of strictly positive counts
         or probabilities/proportions.
         columns = features (components)
         rows = samples (compositions)
+        If sparse, only the stored entries
+        (the support) are simulated.
     depth : array_like
         Read depth of the simulation
         for each sample (row).
-    kappa: float
-        Over-dispersion parameter.
+    kappa: float or array_like
+        Over-dispersion parameter, one value
+        or one per feature (column).
         Default is 1.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed of the random streams. Samples
+        are drawn in blocks, each from its own
+        child stream, so for a given seed the
+        output does not depend on n_jobs.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes the sample
+        blocks are sharded over. None or 1 runs
+        serially, -1 uses all CPUs.
+        Default is None.
+    dtype: np.float64 or np.float32
+        Floating point precision of the
+        computation. np.float32 halves the
+        memory of every intermediate and
+        stores the counts as np.uint16 when
+        no count overflows it.
+        Default is np.float64.
+    backend: str
+        "numpy" runs the closure, the draws and
+        the output filtering as whole-matrix
+        numpy operations. "numba" fuses them
+        into one compiled pass per row of a
+        dense matrix, with blocks of rows drawn
+        in parallel threads (n_jobs is ignored,
+        see numba.set_num_threads). Its draws
+        come from numba's generator, so for a
+        given seed they differ from the numpy
+        ones. Sparse input and installs without
+        numba use numpy.
+        Default is "numpy".
 
     Returns
     -------
     array_like, np.int
        A matrix of counts simulated from
        the input mat by the distribution.
+       Sparse (CSR) if mat is sparse.
     list, bool
         Mask of rows that summed to zero
     list, bool
@@ -114,23 +209,32 @@ def negative_binomial(mat, depths, kappa=1):
        Raises an error if the matrix has more than 2 dimension.
     ValueError
        Raises an error if there is a row that has all zeros.
+    ValueError
+       Raises an error if dtype is not np.float32 or np.float64.
+    ValueError
+       Raises an error if backend is unknown.
 
     """
 
+    if _use_jit(mat, backend):
+        return _fused_simulate(mat, depths, "nb", kappa, seed, dtype)
     # check matrix and ensure
     # data is proportions
-    mat = input_matrix_validation(mat, depths)
+    mat = input_matrix_validation(mat, depths, dtype=dtype)
     # simulate from proportions
-    mu = depths * mat
-    sim = np.vstack([poisson(gamma(kappa, kappa * mu[i, :]))
-                     for i in range(mat.shape[0])])
+    sim = _simulate_seeded(mat, depths, "nb", kappa, seed, n_jobs,
+                           out_dtype=_draw_dtype(dtype))
 
-    return output_matrix_validation(sim)
+    return output_matrix_validation(sim, compact=dtype == np.float32)
 
 
 def dirichlet_multinomial(mat, depths,
                           use_dirichlet=False,
-                          pseudocount=0.001):
+                          pseudocount=0.001,
+                          seed=None,
+                          n_jobs=None,
+                          dtype=np.float64,
+                          method="numpy"):
 
     """
     Simulate from counts, probabilities, or
@@ -139,11 +243,13 @@ def dirichlet_multinomial(mat, depths,
 
     Parameters
     ----------
-    mat: array_like
+    mat: array_like or scipy.sparse matrix
         matrix of strictly positive counts
         or probabilities/proportions.
         columns = features (components)
         rows = samples (compositions)
+        If sparse, only the stored entries
+        (the support) are simulated.
     depth : array_like
         Read depth of the simulation
         for each sample (row).
@@ -155,12 +261,53 @@ def dirichlet_multinomial(mat, depths,
         A pseudocount for sampling the
         Dirichlet distribution. Only
         applies if dirichlet is True.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed of the random streams. Samples
+        are drawn in blocks, each from its own
+        child stream, so for a given seed the
+        output does not depend on n_jobs.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes the sample
+        blocks are sharded over. None or 1 runs
+        serially, -1 uses all CPUs.
+        Default is None.
+    dtype: np.float64 or np.float32
+        Floating point precision of the
+        computation. np.float32 halves the
+        memory of every intermediate and
+        stores the counts as np.uint16 when
+        no count overflows it.
+        Default is np.float64.
+    method: str
+        Sampler of the multinomial. "numpy" uses
+        numpy's conditional binomial chain (the
+        ragged batched chain for sparse input).
+        "cdf" draws the depths as batched
+        categorical draws by inverse cdf, fast when
+        the depths are small compared with the
+        number of features. "poisson" draws Poisson
+        counts with a mean just below the depth and
+        tops them up with cdf draws, fast when the
+        depths are in the millions. "cdf" and
+        "poisson" are exact up to the float64
+        rounding of the cdfs: the rows of a block
+        of samples are drawn in chunks of at most
+        2 ** 22 draws (the depth plus one per row,
+        a deeper row alone), with the cdf of the
+        i-th row of a chunk shifted to [i, i + 1].
+        Its probabilities are resolved to about
+        i * 2.2e-16, so to about 5.7e-14 at most
+        for the BLOCK_SIZE (256) rows of a block,
+        and finer when few deep rows fill a chunk.
+        Default is "numpy".
 
     Returns
     -------
     array_like, np.int
        A matrix of counts simulated from
        the input mat by the distribution.
+       Sparse (CSR) if mat is sparse.
     list, bool
         Mask of rows that summed to zero
     list, bool
@@ -183,30 +330,506 @@ def dirichlet_multinomial(mat, depths,
        Raises an error if the matrix has more than 2 dimension.
     ValueError
        Raises an error if there is a row that has all zeros.
+    ValueError
+       Raises an error if dtype is not np.float32 or np.float64.
+    ValueError
+       Raises an error if method is unknown.
 
     """
 
+    if method not in MULTINOMIAL_METHODS:
+        raise ValueError("method must be one of %s"
+                         % ", ".join(MULTINOMIAL_METHODS))
     # with or w/o dirichlet
     if use_dirichlet:
         # check matrix and ensure
         # data is proportions
-        mat = input_matrix_validation(mat + pseudocount,
-                                      depths)
-        sim = np.vstack([multinomial(depths[i, 0],
-                                     dirichlet(mat[i, :]))
-                         for i in range(mat.shape[0])])
+        mat = input_matrix_validation(_add_pseudocount(mat, pseudocount),
+                                      depths, dtype=dtype)
     else:
         # check matrix and ensure
         # data is proportions
-        mat = input_matrix_validation(mat, depths)
-        sim = np.vstack([multinomial(depths[i, 0],
-                                     mat[i, :])
-                         for i in range(mat.shape[0])])
+        mat = input_matrix_validation(mat, depths, dtype=dtype)
+    sim = _simulate_seeded(mat, depths, "dm" if use_dirichlet else "m",
+                           1, seed, n_jobs, method=method,
+                           out_dtype=_draw_dtype(dtype))
+
+    return output_matrix_validation(sim, compact=dtype == np.float32)
+
+
+def _simulate_seeded(mat, depths, model, kappa, seed, n_jobs, **kwargs):
+
+    """
+    Run the kernel of a model block-wise from the
+    kernel stream of seed, serially or in a pool.
+    """
+
+    seeds = [child_sequence(as_seed_sequence(seed), KERNEL_STREAM)]
+    with worker_pool(n_jobs) as executor:
+        sims = run_blocks(_simulate_closed, mat, depths, seeds,
+                          executor=executor, model=model, kappa=kappa,
+                          **kwargs)
+
+    return sims[0]
+
+
+def _use_jit(mat, backend):
+
+    """
+    Whether the numba backend runs on mat,
+    numpy is used for sparse or non 2D input
+    and when numba is not installed.
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError("backend must be one of %s" % ", ".join(BACKENDS))
+    return (backend == "numba" and _HAS_NUMBA
+            and not issparse(mat) and np.ndim(mat) == 2)
+
+
+def _fused_simulate(mat, depths, model, kappa, seed, dtype):
+
+    """
+    pln or nb simulation of the numba backend,
+    from the kernel stream of seed as in
+    _simulate_seeded, with the output of
+    output_matrix_validation.
+    """
+
+    mat = np.asarray(mat, dtype=dtype)
+    _check_depths(mat, depths, dtype)
+    rng = as_generator(child_sequence(as_seed_sequence(seed),
+                                      KERNEL_STREAM))
+    sim, rows, columns, max_count = _fused_counts(mat, depths, model,
+                                                  kappa, rng)
+
+    return _subset_counts(sim, rows, columns, max_count,
+                          dtype == np.float32)
+
+
+def _fused_counts(mat, depths, model, kappa, rng):
+
+    """
+    Counts of a dense matrix (closed or not) drawn
+    by the fused numba kernel, one child stream of
+    rng per block of _JIT_ROWS rows, with the masks
+    of the nonzero rows and columns and the largest
+    count. The counts are written as np.uint32 and
+    drawn again from the same streams as np.int64
+    in the unlikely case one overflows.
+    """
+
+    from numba.typed import List
+    from birdman_jr.jit import fused_counts, NEGATIVE, ZERO_ROW
+
+    n_rows, n_cols = mat.shape
+    sequences = rng.bit_generator.seed_seq.spawn(-(-n_rows // _JIT_ROWS))
+    kappa = np.ascontiguousarray(np.broadcast_to(
+        np.asarray(kappa, dtype=np.float64), (n_cols,)))
+    depths = np.asarray(depths, dtype=np.float64).ravel()
+    for dtype in (np.uint32, np.int64):
+        generators = List([as_generator(seq) for seq in sequences])
+        sim = np.empty(mat.shape, dtype=dtype)
+        rows = np.zeros(n_rows, dtype=bool)
+        columns = np.zeros(n_cols, dtype=bool)
+        max_count, error = fused_counts(mat, depths, kappa, model == "nb",
+                                        generators, _JIT_ROWS, sim, rows,
+                                        columns)
+        if max_count <= np.iinfo(np.uint32).max:
+            break
+    # the checks of skbio's closure
+    if error == NEGATIVE:
+        raise ValueError("Cannot have negative proportions")
+    if error == ZERO_ROW:
+        raise ValueError("Input matrix cannot have rows with all zeros")
+
+    return sim, rows, columns, max_count
+
+
+def _simulate_closed(mat, depths, model, kappa=1, rng=None,
+                     method="numpy", backend="numpy"):
+
+    """
+    Run the kernel of a model ("pln", "nb", "dm"
+    or "m") on an already validated and closed
+    dense or CSR matrix, without output filtering.
+    method is the multinomial sampler of dm and m,
+    backend the one of pln and nb.
+    """
+
+    rng = as_generator(rng)
+    if model in ("pln", "nb") and _use_jit(mat, backend):
+        return _fused_counts(mat, depths, model, kappa, rng)[0]
+    if issparse(mat):
+        if model in ("dm", "m"):
+            return _sparse_dirichlet_multinomial(mat, depths,
+                                                 model == "dm", rng,
+                                                 method)
+        kernel = (_poisson_lognormal if model == "pln"
+                  else _negative_binomial)
+        if np.ndim(kappa):
+            # one kappa per stored entry
+            kappa = np.asarray(kappa)[mat.indices]
+        return _like_support(mat, kernel(
+            mat.data, _support_depths(mat, depths), kappa, rng))
+    if model == "pln":
+        return _poisson_lognormal(mat, depths, kappa, rng)
+    if model == "nb":
+        return _negative_binomial(mat, depths, kappa, rng)
+    return _dirichlet_multinomial(mat, depths, model == "dm", rng, method)
+
+
+def _poisson_lognormal(mat, depths, kappa, rng):
+
+    """
+    Whole-matrix Poisson Log-Normal kernel on
+    closed proportions. The log-normal rates are
+    built in a single preallocated buffer as
+    exp(log(depths * mat) + kappa * z).
+    """
+
+    lam = np.empty(mat.shape, dtype=mat.dtype)
+    rng.standard_normal(out=lam, dtype=lam.dtype)
+    lam *= kappa
+    # zero proportions give exp(-inf) = 0
+    with np.errstate(divide="ignore"):
+        lam += np.log(mat)
+        lam += np.log(depths)
+    np.exp(lam, out=lam)
+
+    return rng.poisson(lam)
+
+
+def _negative_binomial(mat, depths, kappa, rng):
+
+    """
+    Whole-matrix Negative Binomial (Gamma-Poisson)
+    kernel on closed proportions. The gamma rates
+    with shape kappa and scale depths * mat / kappa
+    are built in a single preallocated buffer, so
+    the counts have mean m = depths * mat and
+    variance m + m ** 2 / kappa.
+    """
+
+    lam = np.empty(mat.shape, dtype=mat.dtype)
+    rng.standard_gamma(kappa, out=lam, dtype=lam.dtype)
+    lam /= kappa
+    lam *= mat
+    lam *= depths
+
+    return rng.poisson(lam)
+
+
+def _dirichlet_multinomial(mat, depths, use_dirichlet, rng,
+                           method="numpy"):
+
+    """
+    Whole-matrix (Dirichlet) Multinomial kernel on
+    closed proportions. The Dirichlet is drawn for
+    all rows at once as normalized gamma variates
+    and the multinomial uses the batched array form.
+    """
+
+    if use_dirichlet:
+        pvals = np.empty(mat.shape, dtype=mat.dtype)
+        rng.standard_gamma(mat, out=pvals, dtype=pvals.dtype)
+        row_sums = pvals.sum(1, keepdims=True)
+        # very small concentrations can underflow to
+        # an all-zero row, draw those rows directly
+        degenerate = np.flatnonzero(row_sums[:, 0] == 0)
+        row_sums[degenerate] = 1.0
+        pvals /= row_sums
+        for i in degenerate:
+            pvals[i, :] = rng.dirichlet(mat[i, :])
+    else:
+        pvals = mat
+    if pvals.dtype != np.float64:
+        # the multinomial checks the sums in double
+        # precision, which single precision rounding
+        # can fail, so renormalize in double
+        pvals = pvals.astype(np.float64)
+        pvals /= pvals.sum(1, keepdims=True)
+    n = depths[:, 0].astype(np.int64)
+    if method == "numpy":
+        return rng.multinomial(n, pvals)
+    # the other samplers work on the CSR layout
+    # of the rows, all of the same length here
+    n_rows, n_cols = pvals.shape
+    indptr = np.arange(0, (n_rows + 1) * n_cols, n_cols)
+    sampler = (_cdf_multinomial if method == "cdf"
+               else _poisson_multinomial)
+
+    return sampler(n, pvals.ravel(), indptr, rng).reshape(pvals.shape)
+
+
+def _sparse_dirichlet_multinomial(mat, depths, use_dirichlet, rng,
+                                  method="numpy"):
+
+    """
+    (Dirichlet) Multinomial kernel restricted to the
+    stored entries of a closed CSR matrix. Draws are
+    made on the support only so memory scales with
+    the number of stored entries.
+    """
+
+    pvals = mat.data
+    if use_dirichlet:
+        pvals = rng.standard_gamma(pvals, dtype=pvals.dtype)
+        row_sums = np.add.reduceat(pvals, mat.indptr[:-1])
+        # very small concentrations can underflow to
+        # an all-zero row, draw those rows directly
+        for i in np.flatnonzero(row_sums == 0):
+            start, stop = mat.indptr[i], mat.indptr[i + 1]
+            pvals[start:stop] = rng.dirichlet(mat.data[start:stop])
+            row_sums[i] = 1.0
+        pvals /= np.repeat(row_sums, np.diff(mat.indptr))
+
+    sampler = {"numpy": _ragged_multinomial, "cdf": _cdf_multinomial,
+               "poisson": _poisson_multinomial}[method]
+
+    return _like_support(mat, sampler(
+        depths[:, 0].astype(np.int64), pvals, mat.indptr, rng))
+
+
+def _ragged_multinomial(n, pvals, indptr, rng):
+
+    """
+    Multinomial draws for rows of different lengths
+    (CSR layout) by the conditional binomial method.
+    The k-th entry of every row is drawn in one
+    batched binomial call, so the Python loop runs
+    over the longest row rather than over rows.
+    """
+
+    counts = np.zeros(pvals.shape[0], dtype=np.int64)
+    lengths = np.diff(indptr)
+    # order rows longest first so the rows still
+    # active at position k are always a prefix
+    order = np.argsort(-lengths, kind="stable")
+    positions = np.arange(lengths.max(initial=0))
+    n_active = lengths.shape[0] - np.searchsorted(
+        lengths[order][::-1], positions, side="right")
+    n_left = n[order].astype(np.int64)
+    p_left = np.ones(order.shape[0])
+    for k, n_rows in enumerate(n_active):
+        rows = order[:n_rows]
+        idx = indptr[rows] + k
+        p = pvals[idx]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = np.clip(p / p_left[:n_rows], 0.0, 1.0)
+        # the last entry of a row takes what is left
+        q[(lengths[rows] == k + 1) | ~np.isfinite(q)] = 1.0
+        draw = rng.binomial(n_left[:n_rows], q)
+        counts[idx] = draw
+        n_left[:n_rows] -= draw
+        p_left[:n_rows] -= p
+
+    return counts
+
+
+def _cdf_multinomial(n, pvals, indptr, rng):
+
+    """
+    Multinomial draws for the rows of a CSR layout
+    as n categorical draws per row by inverse cdf.
+    The draws of a row are made already sorted
+    (normalized sums of exponential spacings) and
+    the cdfs of the rows of a chunk are laid end to
+    end, its row i spanning [i, i + 1], so the draws
+    of all its rows are located by a single
+    searchsorted, cache
+    friendly as the draws are sorted, and counted
+    by a single bincount. The cost is O(nnz +
+    sum(n) log(nnz)) instead of one binomial per
+    entry. The offsets are relative to the chunk,
+    the cdfs of a chunk of r rows are resolved up
+    to about r * 2.2e-16.
+    """
+
+    counts = np.zeros(pvals.shape[0], dtype=np.int64)
+    lengths = np.diff(indptr)
+    # empty rows (zero-depth samples) draw nothing
+    n = np.where(lengths > 0, n, 0)
+    cdf = _row_cdfs(pvals, indptr)
+    ends = np.cumsum(n + 1)
+    start = 0
+    while start < len(n):
+        # rows of at most _CDF_DRAWS draws at once,
+        # a row with more draws is drawn alone
+        first = ends[start] - n[start] - 1
+        stop = max(start + 1, np.searchsorted(
+            ends, first + _CDF_DRAWS, side="right"))
+        offsets = np.arange(stop - start)
+        u = _sorted_uniforms(n[start:stop], rng)
+        u += np.repeat(offsets, n[start:stop])
+        # i + u can round up to i + 1
+        np.minimum(u, np.nextafter(np.repeat(
+            offsets + 1, n[start:stop]), 0), out=u)
+        low, high = indptr[start], indptr[stop]
+        idx = np.searchsorted(cdf[low:high] + np.repeat(
+            offsets, lengths[start:stop]), u, side="right")
+        counts[low:high] = np.bincount(idx, minlength=high - low)
+        start = stop
+
+    return counts
+
+
+def _sorted_uniforms(n, rng):
 
-    return output_matrix_validation(sim)
+    """
+    n[i] sorted uniform draws for each row i, laid
+    end to end, as the normalized cumulative sums
+    of n[i] + 1 exponential spacings.
+    """
+
+    spacings = rng.standard_exponential(int(n.sum()) + len(n))
+    sums = np.cumsum(spacings)
+    ends = np.cumsum(n + 1) - 1
+    before = np.concatenate([[0.0], sums[ends[:-1]]])
+    rows = np.repeat(np.arange(len(n)), n + 1)
+    sums -= before[rows]
+    sums /= sums[ends][rows]
+    # the last sum of a row is 1 and not a draw
+    keep = np.ones(len(sums), dtype=bool)
+    keep[ends] = False
+
+    return sums[keep]
+
+
+def _row_cdfs(pvals, indptr):
+
+    """
+    Normalized cdfs of the rows of a CSR layout.
+    The last entries of a row are exactly 1 and
+    zero probabilities repeat the previous value,
+    so they are never the first value above a
+    draw.
+    """
+
+    lengths = np.diff(indptr)
+    n_rows = len(lengths)
+    if n_rows and np.all(lengths == lengths[0]):
+        # rows of a dense matrix, summed row by row
+        cdf = np.cumsum(pvals.reshape(n_rows, -1), axis=1,
+                        dtype=np.float64)
+        totals = cdf[:, -1:].copy()
+        totals[totals == 0] = 1.0
+        cdf /= totals
+        return cdf.ravel()
+    cdf = np.cumsum(pvals, dtype=np.float64)
+    # the cumulative sum restarted at each row
+    sums = np.concatenate([[0.0], cdf])
+    before = sums[indptr[:-1]]
+    totals = sums[indptr[1:]] - before
+    totals[totals == 0] = 1.0
+    cdf -= np.repeat(before, lengths)
+    cdf /= np.repeat(totals, lengths)
+
+    return cdf
+
+
+def _poisson_multinomial(n, pvals, indptr, rng):
+
+    """
+    Exact multinomial draws for large depths by
+    Poisson splitting. Independent Poisson counts
+    of mean lam * p are multinomial given their
+    total, so for totals N <= n adding n - N cdf
+    draws gives a multinomial(n, p). lam is three
+    standard deviations below n, so a row is
+    redrawn (N > n) with probability about 0.1%
+    and only about 3 sqrt(n) cdf draws are left.
+    """
+
+    lengths = np.diff(indptr)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    totals = np.bincount(rows, weights=pvals, minlength=len(lengths))
+    totals[totals == 0] = 1.0
+    lam = np.maximum(n - 3 * np.sqrt(n), 0) / totals
+    mean = pvals * lam[rows]
+    counts = rng.poisson(mean)
+    drawn = np.bincount(rows, weights=counts, minlength=len(lengths))
+    over = np.flatnonzero(drawn > n)
+    while len(over):
+        # redraw the rows that overshot
+        entries = np.flatnonzero(np.isin(rows, over))
+        counts[entries] = rng.poisson(mean[entries])
+        drawn = np.bincount(rows, weights=counts, minlength=len(lengths))
+        over = np.flatnonzero(drawn > n)
+    counts += _cdf_multinomial(n - drawn.astype(np.int64), pvals, indptr,
+                               rng)
+
+    return counts
+
+
+def _add_pseudocount(mat, pseudocount):
+
+    """
+    Add a pseudocount to a dense matrix or to the
+    stored entries (the support) of a sparse one.
+    """
+
+    if issparse(mat):
+        mat = csr_matrix(mat, copy=True)
+        if mat.dtype.kind != "f":
+            mat = mat.astype(np.float64)
+        mat.data += pseudocount
+        return mat
+    return mat + pseudocount
 
 
-def input_matrix_validation(mat, depths):
+def _support_depths(mat, depths):
+
+    """
+    Repeat the per-sample depths for every stored
+    entry of a CSR matrix.
+    """
+
+    return np.repeat(depths[:, 0], np.diff(mat.indptr))
+
+
+def _like_support(mat, values):
+
+    """
+    Build a CSR matrix with the sparsity structure
+    of mat and the given stored values.
+    """
+
+    return csr_matrix((values, mat.indices.copy(), mat.indptr.copy()),
+                      shape=mat.shape)
+
+
+def _sparse_closure(mat, dtype=np.float64):
+
+    """
+    Closure over the stored entries of a sparse
+    matrix, with the same checks as skbio's closure.
+    """
+
+    mat = csr_matrix(mat, dtype=dtype, copy=True)
+    if np.any(mat.data < 0):
+        raise ValueError("Cannot have negative proportions")
+    row_sums = np.asarray(mat.sum(1)).ravel()
+    if np.any(row_sums == 0):
+        raise ValueError("Input matrix cannot have rows with all zeros")
+    mat.data /= np.repeat(row_sums, np.diff(mat.indptr))
+
+    return mat
+
+
+def input_matrix_validation(mat, depths, dtype=np.float64):
+
+    _check_depths(mat, depths, dtype)
+    # check matrix and ensure
+    # data is proportions
+    if issparse(mat):
+        return _sparse_closure(mat, dtype)
+    mat = closure(np.asarray(mat, dtype=dtype))
+
+    return mat
+
+
+def _check_depths(mat, depths, dtype):
 
     if np.any(depths <= 0):
         raise ValueError("Read depth cannot have values "
@@ -216,21 +839,133 @@ def input_matrix_validation(mat, depths):
     if depths.shape[0] != mat.shape[0]:
         raise ValueError("Number of est. read depth does not match number of "
                          "samples in the input matrix")
-    # check matrix and ensure
-    # data is proportions
-    mat = closure(mat)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype must be np.float32 or np.float64")
 
-    return mat
 
+def output_matrix_validation(sim, subset=True, compact=False):
+
+    """
+    Clip negative counts and remove samples (rows)
+    and features (columns) that sum to zero.
+
+    The row and column masks are computed in a single
+    sweep over blocks of rows, negatives are clipped
+    in place, and the filtered integer counts are
+    copied once into the most compact dtype that
+    holds them (np.uint32, or np.uint16 if compact,
+    falling back to a wider dtype whenever a count
+    would overflow).
+
+    Parameters
+    ----------
+    sim: array_like or scipy.sparse matrix
+        Simulated counts (samples x features),
+        clipped in place.
+    subset: bool
+        If False only the masks are computed and sim
+        is returned unfiltered without any copy, to
+        be subset later with sim[np.ix_(rows, cols)].
+        Default is True.
+    compact: bool
+        If True counts may be stored as np.uint16.
+        Default is False.
+
+    Returns
+    -------
+    array_like or scipy.sparse matrix
+       The filtered (or, if not subset, the
+       unfiltered) counts.
+    list, bool
+        Mask of rows that summed to zero
+    list, bool
+        Mask of columns that summed to zero
+    """
+
+    if issparse(sim):
+        # drop stored zeros so the masks
+        # only count the simulated support
+        sim = csr_matrix(sim)
+        sim.data[sim.data < 0] = 0
+        sim.eliminate_zeros()
+        zero_sum_mask_rows = sim.getnnz(1) > 0
+        zero_sum_mask_columns = np.bincount(
+            sim.indices, minlength=sim.shape[1]) > 0
+        if not subset:
+            return sim, zero_sum_mask_rows, zero_sum_mask_columns
+        sim = sim[zero_sum_mask_rows][:, zero_sum_mask_columns]
+        if sim.dtype.kind in "iu":
+            sim.data = sim.data.astype(
+                _count_dtype(sim.data.max(initial=0), compact), copy=False)
+        return sim, zero_sum_mask_rows, zero_sum_mask_columns
+
+    sim = np.asarray(sim)
+    zero_sum_mask_rows = np.empty(sim.shape[0], dtype=bool)
+    zero_sum_mask_columns = np.zeros(sim.shape[1], dtype=bool)
+    max_count = 0
+    for start in range(0, sim.shape[0], _SWEEP_ROWS):
+        block = sim[start:start + _SWEEP_ROWS]
+        # ensure no zero counts
+        if block.dtype.kind != "u":
+            np.maximum(block, 0, out=block)
+        nonzero = block != 0
+        zero_sum_mask_rows[start:start + _SWEEP_ROWS] = nonzero.any(1)
+        zero_sum_mask_columns |= nonzero.any(0)
+        max_count = max(max_count, block.max(initial=0))
+    if not subset:
+        return sim, zero_sum_mask_rows, zero_sum_mask_columns
+
+    return _subset_counts(sim, zero_sum_mask_rows, zero_sum_mask_columns,
+                          max_count, compact)
+
+
+def _subset_counts(sim, zero_sum_mask_rows, zero_sum_mask_columns,
+                   max_count, compact):
+
+    """
+    Remove the zero sum rows and columns of dense
+    counts with one copy into the compact dtype.
+    """
+
+    dtype = (_count_dtype(max_count, compact) if sim.dtype.kind in "iu"
+             else sim.dtype)
+    all_rows = zero_sum_mask_rows.all()
+    all_columns = zero_sum_mask_columns.all()
+    if all_rows and all_columns:
+        return (sim.astype(dtype, copy=False),
+                zero_sum_mask_rows, zero_sum_mask_columns)
+    rows = np.flatnonzero(zero_sum_mask_rows)
+    out = np.empty((rows.shape[0], zero_sum_mask_columns.sum()),
+                   dtype=dtype)
+    for start in range(0, rows.shape[0], _SWEEP_ROWS):
+        block = sim[rows[start:start + _SWEEP_ROWS]]
+        out[start:start + _SWEEP_ROWS] = (block if all_columns else
+                                          block[:, zero_sum_mask_columns])
+
+    return out, zero_sum_mask_rows, zero_sum_mask_columns
 
-def output_matrix_validation(sim):
 
-    # ensure no zero counts
-    sim[sim < 0.0] = 0.0
-    # remove zero sums and return a mask (if needed)
-    zero_sum_mask_rows = sim.sum(1) > 0
-    sim = sim[zero_sum_mask_rows]
-    zero_sum_mask_columns = sim.sum(0) > 0
-    sim = sim[:, zero_sum_mask_columns]
+def _draw_dtype(dtype):
+
+    """
+    Dtype of the unfiltered dense counts, np.uint32
+    in the float32 mode so that they are not held
+    as np.int64 until output_matrix_validation
+    (see run_blocks).
+    """
+
+    return np.uint32 if dtype == np.float32 else np.int64
+
+
+def _count_dtype(max_count, compact=False):
+
+    """
+    Most compact dtype for counts up to max_count,
+    np.uint16 is only considered if compact.
+    """
 
-    return sim, zero_sum_mask_rows, zero_sum_mask_columns
+    if compact and max_count <= np.iinfo(np.uint16).max:
+        return np.uint16
+    if max_count <= np.iinfo(np.uint32).max:
+        return np.uint32
+    return np.int64
@@ -0,0 +1,120 @@
+import os
+
+import click
+
+# the simulation stack (numpy, scipy, skbio, biom) is
+# imported inside the commands so that --help and
+# argument errors return without loading it
+_DISTRIBUTIONS = ["pln", "nb", "dm", "m"]
+
+
+def parse_shard(value):
+    """
+    Parse a "i/n" shard into (i, n), 0 <= i < n.
+    """
+
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("shard must be of the form i/n")
+    if count < 1 or not 0 <= index < count:
+        raise click.BadParameter("shard i/n needs 0 <= i < n")
+
+    return index, count
+
+
+def shard_range(n_replicates, index, count):
+    """
+    Contiguous range of the replicates in shard
+    index of count, the shard sizes differ by at
+    most one.
+    """
+
+    return range(n_replicates * index // count,
+                 n_replicates * (index + 1) // count)
+
+
+@click.group()
+def cli():
+    """
+    Simulate microbiome feature tables.
+    """
+
+
+@cli.command()
+@click.argument("table", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_dir", type=click.Path(file_okay=False))
+@click.option("--distribution", type=click.Choice(_DISTRIBUTIONS),
+              default="pln", show_default=True,
+              help="Model of the simulated counts.")
+@click.option("--kappa", type=float, default=1, show_default=True,
+              help="Over-dispersion of pln and nb.")
+@click.option("--pseudocount", type=float, default=1, show_default=True,
+              help="Pseudocount of the noise and of dm.")
+@click.option("--impose-noise", is_flag=True,
+              help="Add noise before simulating.")
+@click.option("--percent-normal", type=float, default=0.1,
+              show_default=True, help="Homoscedastic noise.")
+@click.option("--percent-random", type=float, default=0.1,
+              show_default=True, help="Heteroscedastic noise.")
+@click.option("--random-count", type=float, default=1, show_default=True,
+              help="Intensity of the heteroscedastic noise.")
+@click.option("--add-missing-at-random", is_flag=True,
+              help="Add zeros at random instead of matching the input.")
+@click.option("--percent-missing", type=float, default=0.1,
+              show_default=True, help="Fraction of zeros added at random.")
+@click.option("--sparse", is_flag=True,
+              help="Simulate on the nonzero entries only.")
+@click.option("--float32", is_flag=True,
+              help="Compute in single precision.")
+@click.option("--replicates", type=click.IntRange(min=1), default=1,
+              show_default=True, help="Total number of replicates.")
+@click.option("--shard", default="0/1", show_default=True,
+              help="Simulate only shard i of n of the replicates.")
+@click.option("--seed", type=int, default=None,
+              help="Root seed, required with more than one shard.")
+@click.option("--n-jobs", type=int, default=None,
+              help="Worker processes per replicate (-1 for all CPUs).")
+def simulate(table, output_dir, distribution, kappa, pseudocount,
+             impose_noise, percent_normal, percent_random, random_count,
+             add_missing_at_random, percent_missing, sparse, float32,
+             replicates, shard, seed, n_jobs):
+    """
+    Simulate replicates of the biom TABLE into OUTPUT_DIR.
+
+    Replicate r is written to OUTPUT_DIR/replicate-<r>.biom and
+    drawn from child stream r of the seed, so the files do not
+    depend on how the replicates are split over shards.
+    """
+
+    index, count = parse_shard(shard)
+    if count > 1 and seed is None:
+        raise click.UsageError("--seed is required with --shard")
+    indices = shard_range(replicates, index, count)
+    if not len(indices):
+        return
+
+    import h5py
+    import numpy as np
+    from biom import load_table
+    from birdman_jr.data_driven import simulate_replicates
+
+    reps = simulate_replicates(
+        load_table(table), len(indices), distribution=distribution,
+        kappa=kappa, pseudocount=pseudocount, impose_noise=impose_noise,
+        percent_normal=percent_normal, percent_random=percent_random,
+        random_count=random_count,
+        add_missing_at_random=add_missing_at_random,
+        percent_missing=percent_missing, sparse=sparse, seed=seed,
+        n_jobs=n_jobs, dtype=np.float32 if float32 else np.float64,
+        offset=indices.start)
+    os.makedirs(output_dir, exist_ok=True)
+    for r, rep in zip(indices, reps):
+        path = os.path.join(output_dir, "replicate-%05i.biom" % r)
+        with h5py.File(path, "w") as fh:
+            rep.to_hdf5(fh, "birdman_jr")
+        click.echo(path)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,8 +1,31 @@
+import os
+
+import numpy as np
+import pandas as pd
 from biom import Table
-from birdman_jr.noise import add_noise
-from birdman_jr.base_models import (poisson_lognormal,
+from scipy.sparse import csr_matrix, issparse, vstack
+from birdman_jr.noise import (add_noise,  # noqa: F401
+                              _noise_base, _apply_noise)
+from birdman_jr.base_models import (poisson_lognormal,  # noqa: F401
                                     dirichlet_multinomial,
-                                    negative_binomial)
+                                    negative_binomial,
+                                    input_matrix_validation,
+                                    output_matrix_validation,
+                                    _add_pseudocount,
+                                    _simulate_closed,
+                                    _draw_dtype,
+                                    _sparse_closure,
+                                    BACKENDS)
+from birdman_jr.io import HDF5TableWriter, load_subset, _positions
+from birdman_jr.parallel import (as_seed_sequence, as_generator,
+                                 child_sequence, sample_sequence,
+                                 run_blocks, worker_pool, BLOCK_SIZE,
+                                 NOISE_STREAM, KERNEL_STREAM, DEPTH_STREAM,
+                                 RESAMPLE_STREAM)
+from birdman_jr.depths import (draw_depths, resample_samples,
+                               sample_columns, resampled_ids,
+                               DEPTH_MODELS)
+from birdman_jr.profiling import stage
 
 
 def simulate(table,
@@ -15,7 +38,19 @@ def simulate(table,
              percent_random=0.1,
              random_count=1,
              add_missing_at_random=False,
-             percent_missing=0.1):
+             percent_missing=0.1,
+             sparse=False,
+             support=None,
+             seed=None,
+             n_jobs=None,
+             dtype=np.float64,
+             n_samples=None,
+             groups=None,
+             log_fold_changes=None,
+             sample_ids=None,
+             feature_ids=None,
+             seeding="block",
+             backend="numpy"):
     """
     This function will take and input table
     and simulate on the proportions of the data
@@ -28,13 +63,19 @@ def simulate(table,
 
     Parameters
     ----------
-    table: biom.Table
-        Feature table (features x samples)
-    depths: array_like or None
+    table: biom.Table or str
+        Feature table (features x samples), or
+        the path of an HDF5 biom file of which
+        only the selected samples and features
+        are read (see load_subset).
+    depths: array_like, None or str
         The depth of each sample
         if depth is None then the
         depth input table depth
-        will be used.
+        will be used. "empirical",
+        "lognormal" (or "fit") and "nb"
+        draw them from a model of the
+        table depths (see draw_depths).
         Default is None.
     distribution: str
         The type of distribution to
@@ -44,9 +85,12 @@ def simulate(table,
         Dirichlet Multinomial (or dm), or
         Multinomial (or m).
         Default is Poisson Log-Normal/pln.
-    kappa: float
-        Over-dispersion parameter.
+    kappa: float, array_like or str
+        Over-dispersion parameter, one
+        value or one per feature.
         Only applies for pln and nb.
+        "auto" estimates it from the
+        table (see estimate_kappa).
         Default is 1.
     pseudocount: float
         Pseudocount to add for ALR
@@ -74,12 +118,107 @@ def simulate(table,
     percent_missing: float
         Percent of data to add missing (zero)
         values. Default is 0.1 (i.e. 10%)
+    sparse: bool
+        If True the table is never densified.
+        The simulation runs on the nonzero
+        entries (the support) of the table
+        and the output is built from sparse
+        arrays, so memory scales with the
+        number of nonzeros. For dm the
+        pseudocount is only added on the
+        support. Noise is only added on the
+        support as well. Default is False.
+    support: biom.Table, scipy.sparse matrix or None
+        Declared support mask (features x samples)
+        restricting the simulation to its nonzero
+        entries. Implies sparse=True.
+        Default is None.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed of the random streams. Samples
+        are drawn in blocks, each from its own
+        child stream, so for a given seed the
+        output does not depend on n_jobs.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes the sample
+        blocks are sharded over. None or 1 runs
+        serially, -1 uses all CPUs. The workers
+        start from a fork server, so scripts need
+        an if __name__ == "__main__" guard.
+        Default is None.
+    dtype: np.float64 or np.float32
+        Floating point precision of the
+        densified input, the noise and the
+        simulation. np.float32 halves their
+        memory.
+        Default is np.float64.
+    n_samples: int or None
+        If given, the simulation runs on this
+        many samples resampled with replacement
+        from the table (see resample_samples),
+        with depths drawn for n_samples when
+        depths is a model name.
+        Default is None (the table's samples).
+    groups: array_like, pd.Series or None
+        Two-level grouping of the samples, in the
+        order of the table or indexed by sample id,
+        the larger level (in sorted order) is the
+        group the log_fold_changes are applied to.
+        Resampled samples keep the group of their
+        template. Default is None.
+    log_fold_changes: array_like, pd.Series or None
+        Natural log-fold-change of each feature in
+        the second group, in the order of the table
+        or indexed by feature id (missing features
+        have no effect). The proportions of the
+        second group are multiplied by
+        exp(log_fold_changes) and closed again
+        before the model is drawn (after the noise).
+        Default is None (no effect).
+    sample_ids: array_like of str or None
+        Samples of the table to simulate from, in
+        this order. The samples and features that
+        sum to zero in the selection are removed.
+        depths, groups and log_fold_changes refer
+        to the selected table.
+        Default is None (all the samples).
+    feature_ids: array_like of str or None
+        Features of the table to simulate from,
+        as sample_ids.
+        Default is None (all the features).
+    seeding: str
+        "block" draws the samples in blocks of
+        rows, each from its own child stream of
+        seed. "sample" draws each sample from
+        streams keyed by (seed, sample id), so a
+        sample does not depend on its row or on
+        the other samples and resimulate can
+        recompute only new or changed samples.
+        "sample" runs serially (n_jobs is
+        ignored) and needs depths that do not
+        depend on the other samples (None or an
+        array), a numeric kappa and no n_samples.
+        Default is "block".
+    backend: str
+        Backend of the pln and nb kernels on
+        dense input. "numba" fuses the rate and
+        Poisson draws into one compiled pass per
+        row (see poisson_lognormal), its draws
+        differ from the numpy ones for a given
+        seed. Without numba, numpy is used. The
+        threading layer is left to numba.
+        Default is "numpy".
 
     Returns
     -------
     biom.Table
        A table of the simulated data on the
        input data based on distribution chosen.
+    pd.Series
+       Only with log_fold_changes, the true
+       log-fold-change of each feature of the
+       table (nonzero for the differentially
+       abundant features).
 
     Raises
     ------
@@ -98,41 +237,971 @@ def simulate(table,
        Raises an error if the matrix has more than 2 dimension.
     ValueError
        Raises an error if there is a row that has all zeros.
+    ValueError
+       Raises an error if dtype is not np.float32 or np.float64.
+    ValueError
+       Raises an error if kappa or depths is an unknown string.
+    ValueError
+       Raises an error if depths does not have n_samples rows.
+    ValueError
+       Raises an error if groups does not have two levels
+       or log_fold_changes does not match the features.
+    ValueError
+       Raises an error if a selected id is not in the table.
+    ValueError
+       Raises an error if seeding is unknown or its
+       requirements are not met.
+    ValueError
+       Raises an error if backend is unknown.
+    """
+
+    _check_seeding(seeding, depths, kappa, n_samples)
+    table = _select(table, sample_ids, feature_ids)
+    with stage("simulate", shape=table.shape):
+        root = as_seed_sequence(seed)
+        effects = None
+        if log_fold_changes is not None:
+            effects = (_as_groups(groups, table.ids()),
+                       _as_effects(log_fold_changes,
+                                   table.ids("observation")))
+        depths = _resolve_depths(table, depths, root, n_samples)
+        if n_samples is not None:
+            kappa = _resolve_kappa(table, kappa, distribution)
+            resample_seed = child_sequence(root, RESAMPLE_STREAM)
+            if effects is not None:
+                columns = sample_columns(table, n_samples, resample_seed)
+                effects = (effects[0][columns], effects[1])
+            with stage("resample", shape=(table.shape[0], n_samples)):
+                table = resample_samples(table, n_samples, resample_seed)
+        simulation = _Simulation(table, depths, distribution, kappa,
+                                 pseudocount, impose_noise, percent_normal,
+                                 percent_random, random_count,
+                                 add_missing_at_random, percent_missing,
+                                 sparse, support, dtype, backend=backend)
+
+        if seeding == "sample":
+            sim = simulation.run_samples(root, effects)
+        else:
+            with worker_pool(n_jobs) as executor:
+                sim = simulation.run(root, executor, effects=effects)
+
+        if effects is None:
+            return simulation.to_table(sim)
+        return simulation.to_table(sim, truth=effects[1])
+
+
+def simulate_effects(table,
+                     groups,
+                     log_fold_changes,
+                     depths=None,
+                     distribution="pln",
+                     kappa=1,
+                     pseudocount=1,
+                     impose_noise=False,
+                     percent_normal=0.1,
+                     percent_random=0.1,
+                     random_count=1,
+                     add_missing_at_random=False,
+                     percent_missing=0.1,
+                     sparse=False,
+                     seed=None,
+                     n_jobs=None,
+                     dtype=np.float64):
+    """
+    Simulate a table per set of log-fold-changes
+    (e.g. a sweep of effect sizes) from the same
+    table. The input is validated, densified and
+    closed only once, the effects are applied to
+    the closed proportions.
+
+    Every effect is drawn from the same seed, so
+    effect e gives the table of simulate with
+    log_fold_changes=log_fold_changes[e] and the
+    effects only differ by the changed proportions
+    (common random numbers).
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    groups: array_like or pd.Series
+        Two-level grouping of the samples,
+        see simulate.
+    log_fold_changes: array_like or pd.DataFrame
+        Natural log-fold-changes (effects x
+        features), one row per effect, with
+        features as columns for a DataFrame.
+
+    All other parameters are as in simulate.
+
+    Returns
+    -------
+    iterator of (biom.Table, pd.Series)
+       The simulated table of each effect and
+       its true log-fold-changes, lazily.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if groups does not have two levels
+       or log_fold_changes does not match the features.
+
+    The errors of simulate are raised here
+    as well, before any effect is drawn.
+    """
+
+    group = _as_groups(groups, table.ids())
+    feature_ids = table.ids("observation")
+    if isinstance(log_fold_changes, pd.DataFrame):
+        lfc = log_fold_changes.reindex(columns=feature_ids, fill_value=0)
+        lfc = lfc.to_numpy(dtype=np.float64)
+    else:
+        lfc = np.atleast_2d(np.asarray(log_fold_changes, dtype=np.float64))
+    if lfc.ndim != 2 or lfc.shape[1] != len(feature_ids):
+        raise ValueError("log_fold_changes must have one column "
+                         "per feature")
+    root = as_seed_sequence(seed)
+    depths = _resolve_depths(table, depths, root)
+    simulation = _Simulation(table, depths, distribution, kappa,
+                             pseudocount, impose_noise, percent_normal,
+                             percent_random, random_count,
+                             add_missing_at_random, percent_missing,
+                             sparse, None, dtype)
+
+    return _iter_effects(simulation, group, lfc, root, n_jobs)
+
+
+def _iter_effects(simulation, group, lfc, root, n_jobs):
+    with worker_pool(n_jobs) as executor:
+        for e, effect in enumerate(lfc):
+            with stage("effect", effect=e):
+                sim = simulation.run(root, executor, effects=(group, effect))
+                res = simulation.to_table(sim, truth=effect)
+            yield res
+
+
+def resimulate(previous,
+               table,
+               seed,
+               changed=None,
+               depths=None,
+               distribution="pln",
+               kappa=1,
+               pseudocount=1,
+               impose_noise=False,
+               percent_normal=0.1,
+               percent_random=0.1,
+               random_count=1,
+               add_missing_at_random=False,
+               percent_missing=0.1,
+               sparse=False,
+               dtype=np.float64,
+               groups=None,
+               log_fold_changes=None):
+    """
+    Update a table simulated with seeding="sample"
+    after samples of its input were added or
+    changed. Only the samples of table that are
+    not in previous, and the changed ones, are
+    simulated, the other samples are copied from
+    previous. The result is the table of
+    simulate(table, seed=seed, seeding="sample")
+    with the same parameters, so the copied
+    samples are identical to previous.
+
+    The features of table must be the ones the
+    previous table was simulated from: the draws
+    of a sample depend on all the features, a
+    change of the features needs a new simulate.
+
+    Parameters
+    ----------
+    previous: biom.Table
+        Table simulated from an earlier version
+        of table with seeding="sample".
+    table: biom.Table
+        Feature table (features x samples)
+    seed: int or np.random.SeedSequence
+        Root seed previous was simulated with.
+    changed: array_like of str or None
+        Samples of table to simulate again even
+        if they are in previous.
+        Default is None (only the new samples).
+    depths: array_like or None
+        Read depths of all the samples of table,
+        see simulate.
+        Default is None (the sample sums).
+    groups: array_like, pd.Series or None
+        Grouping of all the samples of table,
+        see simulate.
+
+    All other parameters are as in simulate.
+
+    Returns
+    -------
+    biom.Table
+       The updated simulated table.
+    pd.Series
+       Only with log_fold_changes, the true
+       log-fold-changes, see simulate.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if seed is None.
+    ValueError
+       Raises an error if previous has features
+       or changed has samples that are not in table.
+
+    The errors of simulate with seeding="sample"
+    are raised here as well.
+    """
+
+    if seed is None:
+        raise ValueError("seed must be the seed of the previous table")
+    _check_seeding("sample", depths, kappa, None)
+    sample_ids = table.ids()
+    feature_ids = table.ids("observation")
+    columns = _positions(feature_ids, previous.ids("observation"),
+                         "feature")
+    todo = ~np.isin(sample_ids, previous.ids())
+    if changed is not None:
+        todo[_positions(sample_ids, changed, "sample")] = True
+    effects = None
+    if log_fold_changes is not None:
+        effects = (_as_groups(groups, sample_ids)[todo],
+                   _as_effects(log_fold_changes, feature_ids))
+
+    with stage("resimulate", shape=table.shape, samples=int(todo.sum())):
+        # the previous samples, over the features of table
+        kept = previous.matrix_data.T.tocsr()[
+            _positions(previous.ids(), sample_ids[~todo], "sample")]
+        kept = csr_matrix((kept.data, columns[kept.indices], kept.indptr),
+                          shape=(len(kept.indptr) - 1, len(feature_ids)))
+        parts = [kept]
+        if todo.any():
+            # all the features are kept so the draws
+            # match the ones of the whole table
+            subset = Table(table.matrix_data.tocsc()[:, todo], feature_ids,
+                           sample_ids[todo])
+            if depths is not None:
+                depths = np.asarray(depths)[todo]
+            simulation = _Simulation(subset, depths, distribution, kappa,
+                                     pseudocount, impose_noise,
+                                     percent_normal, percent_random,
+                                     random_count, add_missing_at_random,
+                                     percent_missing, sparse, None, dtype)
+            parts.append(csr_matrix(simulation.run_samples(
+                as_seed_sequence(seed), effects)))
+        # back to the order of the samples of table
+        order = np.argsort(np.concatenate([np.flatnonzero(~todo),
+                                           np.flatnonzero(todo)]))
+        sim = vstack(parts, format="csr")[order]
+        if not sparse:
+            sim = sim.toarray()
+
+        with stage("output_validation", shape=sim.shape):
+            sim, rows, columns = output_matrix_validation(
+                sim, compact=dtype == np.float32)
+        result = Table(sim.T, feature_ids[columns], sample_ids[rows])
+    if effects is None:
+        return result
+    return result, pd.Series(effects[1][columns],
+                             index=result.ids("observation"),
+                             name="log_fold_change")
+
+
+def simulate_replicates(table,
+                        n,
+                        depths=None,
+                        distribution="pln",
+                        kappa=1,
+                        pseudocount=1,
+                        impose_noise=False,
+                        percent_normal=0.1,
+                        percent_random=0.1,
+                        random_count=1,
+                        add_missing_at_random=False,
+                        percent_missing=0.1,
+                        sparse=False,
+                        support=None,
+                        output="tables",
+                        seed=None,
+                        n_jobs=None,
+                        dtype=np.float64,
+                        offset=0):
+    """
+    Simulate n replicate tables from the same input
+    table. The input is validated, densified (unless
+    sparse), closed and, with noise, log transformed
+    only once and reused by every replicate.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    n: int
+        Number of replicates to simulate.
+    output: str
+        "tables" returns a lazy iterator
+        of biom.Table, one per replicate,
+        each filtered like simulate.
+        "array" returns a dense array of
+        counts (n x samples x features)
+        without any filtering.
+        Default is "tables".
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed, replicate i is simulated from
+        its i-th child stream.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes. Without noise
+        the "array" output shards all replicates
+        and sample blocks over one pool with the
+        input in shared memory, otherwise the
+        sample blocks of each replicate are sharded.
+        Default is None (serial).
+    offset: int
+        Index of the first replicate, so that
+        replicates offset to offset + n - 1 of
+        a larger run (e.g. a shard of a batch
+        job) are drawn from the same streams.
+        Default is 0.
+
+    All other parameters are as in simulate.
+
+    Returns
+    -------
+    iterator of biom.Table or array_like, np.int
+       The simulated replicates.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if output is not
+       "tables" or "array".
+    ValueError
+       Raises an error if output is "array"
+       with sparse.
+
+    The errors of simulate are raised here
+    as well, before any replicate is drawn.
+    """
+
+    if output not in ["tables", "array"]:
+        raise ValueError("output must be one of tables, array")
+    if output == "array" and (sparse or support is not None):
+        raise ValueError("output='array' is not supported with sparse")
+    root = as_seed_sequence(seed)
+    depths = _resolve_depths(table, depths, root)
+    with stage("setup", shape=table.shape):
+        simulation = _Simulation(table, depths, distribution, kappa,
+                                 pseudocount, impose_noise, percent_normal,
+                                 percent_random, random_count,
+                                 add_missing_at_random, percent_missing,
+                                 sparse, support, dtype)
+    seeds = [child_sequence(root, i) for i in range(offset, offset + n)]
+    if output == "tables":
+        return _iter_tables(simulation, seeds, n_jobs, offset)
+    with worker_pool(n_jobs) as executor:
+        return simulation.run_many(seeds, executor, replicate=offset)
+
+
+def _iter_tables(simulation, seeds, n_jobs, offset):
+    with worker_pool(n_jobs) as executor:
+        for i, seed in enumerate(seeds, offset):
+            # the stage is closed before the table is handed
+            # over, the consumer's time is not recorded
+            with stage("replicate", replicate=i):
+                rep = simulation.to_table(
+                    simulation.run(seed, executor, replicate=i))
+            yield rep
+
+
+def simulate_to_hdf5(table,
+                     path,
+                     chunk_size=4 * BLOCK_SIZE,
+                     depths=None,
+                     distribution="pln",
+                     kappa=1,
+                     pseudocount=1,
+                     impose_noise=False,
+                     percent_normal=0.1,
+                     percent_random=0.1,
+                     random_count=1,
+                     add_missing_at_random=False,
+                     percent_missing=0.1,
+                     sparse=False,
+                     seed=None,
+                     n_jobs=None,
+                     dtype=np.float64,
+                     n_samples=None):
+    """
+    Stream a simulation to an HDF5 biom file. The
+    samples are simulated in chunks of chunk_size and
+    each chunk is appended to the file as soon as it
+    is drawn, so memory is bounded by the chunk size
+    rather than by the size of the table. Zero-sum
+    samples and features are removed as in simulate.
+
+    Without noise, the file holds the same table as
+    simulate with the same seed. With noise, each
+    chunk draws its own noise, and percent_missing
+    applies per chunk. With n_samples, the template
+    samples of each chunk are resampled as it is
+    drawn, so the resampled table is never held
+    in memory.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    path: str
+        Output HDF5 biom file.
+    chunk_size: int
+        Number of samples simulated at once, it is
+        rounded up to a multiple of the sample block
+        size of the random streams.
+        Default is 1024.
+
+    All other parameters are as in simulate.
+
+    Returns
+    -------
+    str
+       The path of the written file.
+
+    Raises
+    ------
+    The errors of simulate are raised here as well.
+    """
+
+    chunk_size = -(-max(chunk_size, 1) // BLOCK_SIZE) * BLOCK_SIZE
+    root = as_seed_sequence(seed)
+    depths = _resolve_depths(table, depths, root, n_samples)
+    # estimated on the whole table, not per chunk
+    kappa = _resolve_kappa(table, kappa, distribution)
+    # column (sample) slices are cheap in CSC
+    data = table.matrix_data.tocsc()
+    feature_ids = table.ids("observation")
+    if n_samples is None:
+        columns = np.arange(table.shape[1])
+    else:
+        columns = sample_columns(table, n_samples,
+                                 child_sequence(root, RESAMPLE_STREAM))
+    with worker_pool(n_jobs) as executor, \
+            HDF5TableWriter(path, feature_ids,
+                            table_id=table.table_id) as writer:
+        for start in range(0, len(columns), chunk_size):
+            stop = min(start + chunk_size, len(columns))
+            if n_samples is None:
+                sample_ids = table.ids()[start:stop]
+            else:
+                sample_ids = resampled_ids(table.ids(),
+                                           columns[start:stop], start)
+            chunk = Table(data[:, columns[start:stop]], feature_ids,
+                          sample_ids)
+            chunk_depths = None if depths is None else depths[start:stop]
+            with stage("chunk", start=start, shape=chunk.shape):
+                simulation = _Simulation(
+                    chunk, chunk_depths, distribution, kappa, pseudocount,
+                    impose_noise, percent_normal, percent_random,
+                    random_count, add_missing_at_random, percent_missing,
+                    sparse, None, dtype)
+                sim = simulation.run(root, executor,
+                                     first_block=start // BLOCK_SIZE)
+                with stage("write", shape=sim.shape):
+                    writer.append(sim, sample_ids)
+
+    return path
+
+
+def estimate_dispersion(table, per_feature=False):
+    """
+    Method of moments estimate of the over-dispersion
+    phi of a table, with the variance of the counts
+    modelled as var = m + phi * m ** 2 around the
+    expected counts m of each feature in each sample.
+    m is predicted from the counts of the other
+    features of the sample, scaled by the proportion
+    of the feature over the whole table, so that a
+    count is not part of its own prediction.
+
+    All the sums are accumulated in one pass over
+    the nonzero entries, the table is never densified.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    per_feature: bool
+        If True, one phi per feature (in the order
+        of the table's observation ids), features
+        without counts get the global estimate.
+        Default is False (one global phi).
+
+    Returns
+    -------
+    float or array_like, np.float
+       The over-dispersion, at least 1e-8.
+    """
+
+    coo = table.matrix_data.tocoo()
+    n_features, n_samples = coo.shape
+    y = coo.data.astype(np.float64)
+    depths = np.bincount(coo.col, y, minlength=n_samples)
+    total = depths.sum()
+    sums = np.bincount(coo.row, y, minlength=n_features)
+    # m = q * (depth - y), q = p / (1 - p) for the
+    # proportion p of the feature
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = np.where(sums < total, sums / (total - sums), 0)
+    # sums over samples of (y - m) ** 2 - m and m ** 2,
+    # expanded so that zero counts only enter through
+    # the depths
+    syy = np.bincount(coo.row, y * y, minlength=n_features)
+    syn = np.bincount(coo.row, y * depths[coo.col], minlength=n_features)
+    snn = np.sum(depths ** 2)
+    num = ((1 + q) ** 2 * syy - 2 * q * (1 + q) * syn + q ** 2 * snn
+           - q * (total - sums))
+    den = q ** 2 * (snn - 2 * syn + syy)
+    phi = num.sum() / den.sum()
+    if per_feature:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            phi = np.where(den > 0, num / den, phi)
+
+    return np.maximum(phi, _MIN_DISPERSION)
+
+
+def estimate_kappa(table, distribution="nb", per_feature=False):
+    """
+    Estimate kappa of pln or nb from the
+    over-dispersion of a table (see
+    estimate_dispersion). For nb kappa = 1 / phi,
+    for pln kappa = sqrt(log(1 + phi)) so that the
+    log-normal rates have the same dispersion.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    distribution: str
+        pln or nb (long or short name).
+        Default is nb.
+    per_feature: bool
+        If True, one kappa per feature.
+        Default is False.
+
+    Returns
+    -------
+    float or array_like, np.float
+       The estimated kappa.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if distribution is not pln or nb.
+    """
+
+    model = _DISTRIBUTIONS.get(distribution)
+    if model not in ("pln", "nb"):
+        raise ValueError("kappa can only be estimated for pln or nb")
+    phi = estimate_dispersion(table, per_feature)
+    if model == "nb":
+        return 1 / phi
+    return np.sqrt(np.log1p(phi))
+
+
+def fit_depths(table, seed=None):
+    """
+    Draw one read depth per sample from a
+    log-normal distribution fitted to the
+    sample sums of a table, see draw_depths.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Seed of the draws.
+        Default is None (fresh entropy).
+
+    Returns
+    -------
+    array_like, np.int
+       Depths (samples x 1), at least 1.
+    """
+
+    return draw_depths(table, model="lognormal", seed=seed)
+
+
+def _resolve_depths(table, depths, root, n_samples=None):
+    """
+    Depths of a simulation, drawn from the depth
+    stream of root when depths is a model name.
+    """
+
+    if isinstance(depths, str):
+        model = "lognormal" if depths == "fit" else depths
+        if model not in DEPTH_MODELS:
+            raise ValueError("depths must be an array, None, 'fit' or "
+                             "one of %s" % ", ".join(DEPTH_MODELS))
+        return draw_depths(table, n_samples, model,
+                           child_sequence(root, DEPTH_STREAM))
+    if depths is not None and n_samples is not None \
+            and len(depths) != n_samples:
+        raise ValueError("depths must have n_samples rows")
+    return depths
+
+
+def _check_seeding(seeding, depths, kappa, n_samples):
+    """
+    Check the seeding of a simulation, the samples
+    drawn with seeding="sample" must not depend on
+    the other samples.
     """
 
-    # check model name is correct
-    allowed_dists = ["Poisson Log-Normal", "pln",
-                     "Negative Binomial", "nb",
-                     "Dirichlet Multinomial", "dm",
-                     "Multinomial", "m"]
-    if distribution not in allowed_dists:
-        allow_str = ", ".join(allowed_dists)
-        ValueError("distribution must be one of %s" % allow_str)
-    # get data as table
-    mat = table.matrix_data.toarray().T
-    # get depths if not provided
-    if depths is None:
-        depths = mat.sum(1).reshape(mat.shape[0], -1)
-    # add noise, if requested
-    if impose_noise:
-        mat = add_noise(mat, pseudocount, percent_normal,
-                        percent_random, random_count,
-                        add_missing_at_random, percent_missing)
-    # run model simulation and return
-    if distribution in ["Poisson Log-Normal", "pln"]:
-        sim_res = poisson_lognormal(mat, depths, kappa=kappa)
-    elif distribution in ["Negative Binomial", "nb"]:
-        sim_res = negative_binomial(mat, depths, kappa=kappa)
-    elif distribution in ["Dirichlet Multinomial", "dm"]:
-        sim_res = dirichlet_multinomial(mat, depths,
-                                        use_dirichlet=True,
-                                        pseudocount=pseudocount)
-    elif distribution in ["Multinomial", "m"]:
-        sim_res = dirichlet_multinomial(mat, depths)
-
-    # make table to return
-    simulation_table = Table(sim_res[0],
-                             table.ids("observation")[sim_res[2]],
-                             table.ids()[sim_res[1]])
-
-    return simulation_table
+    if seeding not in SEEDINGS:
+        raise ValueError("seeding must be one of %s" % ", ".join(SEEDINGS))
+    if seeding == "sample":
+        if isinstance(depths, str):
+            raise ValueError("seeding='sample' needs depths that are "
+                             "None or an array")
+        if isinstance(kappa, str):
+            raise ValueError("seeding='sample' needs a numeric kappa")
+        if n_samples is not None:
+            raise ValueError("seeding='sample' does not resample samples")
+
+
+def _resolve_kappa(table, kappa, distribution):
+    """
+    Estimate kappa="auto" on a whole table, before
+    it is resampled or split into chunks.
+    """
+
+    if isinstance(kappa, str) and kappa == "auto" and \
+            _DISTRIBUTIONS.get(distribution) in ("pln", "nb"):
+        return estimate_kappa(table, distribution)
+    return kappa
+
+
+# seedings of simulate
+SEEDINGS = ["block", "sample"]
+# lower bound of estimated over-dispersions
+_MIN_DISPERSION = 1e-8
+# long and short names of the distributions
+# mapped to the model names used in base_models
+_DISTRIBUTIONS = {"Poisson Log-Normal": "pln", "pln": "pln",
+                  "Negative Binomial": "nb", "nb": "nb",
+                  "Dirichlet Multinomial": "dm", "dm": "dm",
+                  "Multinomial": "m", "m": "m"}
+
+
+class _Simulation:
+    """
+    Validated and precomputed input of a data-driven
+    simulation. Everything that does not depend on
+    the random draws (densified matrix, depths,
+    closure or log noise base) is computed once in
+    the constructor so that run() can be called
+    repeatedly for replicates.
+    """
+
+    def __init__(self, table, depths, distribution, kappa, pseudocount,
+                 impose_noise, percent_normal, percent_random,
+                 random_count, add_missing_at_random, percent_missing,
+                 sparse, support, dtype, cache=None, backend="numpy"):
+
+        # check model name is correct
+        if distribution not in _DISTRIBUTIONS:
+            allow_str = ", ".join(_DISTRIBUTIONS)
+            raise ValueError("distribution must be one of %s" % allow_str)
+        sparse = sparse or support is not None
+        if dtype not in (np.float32, np.float64):
+            raise ValueError("dtype must be np.float32 or np.float64")
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of %s"
+                             % ", ".join(BACKENDS))
+        self.model = _DISTRIBUTIONS[distribution]
+        self.backend = backend
+        self.dtype = dtype
+        if cache is None:
+            cache = {}
+        if isinstance(kappa, str):
+            if kappa != "auto":
+                raise ValueError("kappa must be a number, an array "
+                                 "or 'auto'")
+            if self.model in ("pln", "nb"):
+                key = ("kappa", self.model)
+                if key not in cache:
+                    with stage("estimate_kappa"):
+                        cache[key] = estimate_kappa(table, self.model)
+                kappa = cache[key]
+        self.kappa = kappa
+        self.pseudocount = pseudocount
+        self.noise_params = (percent_normal, percent_random, random_count,
+                             add_missing_at_random, percent_missing)
+        self.feature_ids = table.ids("observation")
+        self.sample_ids = table.ids()
+        # simulations of the same table (e.g. the points
+        # of a sweep) share the inputs that only depend
+        # on the table, the depths and the pseudocount
+        if "mat" not in cache:
+            # get data as table
+            with stage("densify", shape=table.shape[::-1], sparse=sparse):
+                if sparse:
+                    mat = table.matrix_data.T.tocsr().astype(dtype)
+                    if support is not None:
+                        mat = _restrict_support(mat, support)
+                else:
+                    mat = table.matrix_data.astype(dtype).toarray().T
+            # get depths if not provided
+            if depths is None:
+                depths = np.asarray(mat.sum(1)).reshape(mat.shape[0], -1)
+            cache["mat"], cache["depths"] = mat, depths
+        self.mat = mat = cache["mat"]
+        self.depths = depths = cache["depths"]
+        # the log base of the noise is shared, the
+        # noisy proportions are closed per replicate
+        if impose_noise:
+            key = ("noise", pseudocount)
+            if key not in cache:
+                with stage("noise_base", shape=mat.shape):
+                    input_matrix_validation(mat, depths)
+                    cache[key] = _noise_base(mat, pseudocount, dtype)
+            self.noise_base = cache[key]
+            self.closed = None
+        else:
+            self.noise_base = None
+            # the pseudocount only changes the closure of dm
+            key = ("closed", pseudocount if self.model == "dm" else None)
+            if key not in cache:
+                with stage("closure", shape=mat.shape):
+                    cache[key] = self._close(mat)
+            self.closed = cache[key]
+
+    def _close(self, mat, depths=None):
+        if self.model == "dm":
+            mat = _add_pseudocount(mat, self.pseudocount)
+        if depths is None:
+            depths = self.depths
+        return input_matrix_validation(mat, depths, dtype=self.dtype)
+
+    def run(self, seed, executor=None, first_block=0, replicate=0,
+            effects=None):
+        """
+        Draw one unfiltered simulated matrix
+        from the streams of seed.
+        """
+
+        return self.run_many([seed], executor, first_block, replicate,
+                             effects)[0]
+
+    def run_many(self, seeds, executor=None, first_block=0, replicate=0,
+                 effects=None):
+        """
+        Draw one unfiltered simulated matrix per
+        seed. Without noise all replicates share
+        the closed input in a single run_blocks call.
+        first_block places the rows within a larger
+        table, see run_blocks. replicate is the index
+        of the first seed in the profiling records.
+        effects is a (group, log-fold-changes) pair
+        applied to the closed input, see
+        _inject_effects.
+        """
+
+        if self.closed is not None:
+            closed = self.closed
+            if effects is not None:
+                with stage("effects", shape=closed.shape):
+                    closed = _inject_effects(closed, *effects)
+            with stage("kernel", replicate=replicate,
+                       replicates=len(seeds), shape=closed.shape):
+                return self._run_kernel(closed, seeds, executor,
+                                        first_block)
+        sims = []
+        for i, seed in enumerate(seeds, replicate):
+            # chunks of a larger table get their own noise
+            noise_keys = (NOISE_STREAM,) + ((first_block,)
+                                            if first_block else ())
+            rng = as_generator(child_sequence(seed, *noise_keys))
+            with stage("noise", replicate=i, shape=self.mat.shape):
+                closed = self._close(_apply_noise(
+                    self.noise_base, self.mat, *self.noise_params, rng))
+                if effects is not None:
+                    closed = _inject_effects(closed, *effects)
+            with stage("kernel", replicate=i, replicates=1,
+                       shape=closed.shape):
+                sims.append(self._run_kernel(closed, [seed], executor,
+                                             first_block)[0])
+        if issparse(self.mat):
+            return sims
+        return np.stack(sims)
+
+    def run_samples(self, seed, effects=None):
+        """
+        Draw one unfiltered simulated matrix with
+        the noise and the kernel of each sample
+        (row) drawn from the streams of its id (see
+        sample_sequence), one row at a time. effects
+        is as in run_many.
+        """
+
+        sims = []
+        with stage("samples", shape=self.mat.shape):
+            for i, sample_id in enumerate(self.sample_ids):
+                row = slice(i, i + 1)
+                depths = self.depths[row]
+                if self.closed is None:
+                    rng = as_generator(sample_sequence(seed, NOISE_STREAM,
+                                                       sample_id))
+                    closed = self._close(_apply_noise(
+                        self.noise_base[row], self.mat[row],
+                        *self.noise_params, rng), depths)
+                else:
+                    closed = self.closed[row]
+                if effects is not None:
+                    closed = _inject_effects(closed, effects[0][row],
+                                             effects[1])
+                sims.append(_simulate_closed(
+                    closed, depths, self.model, self.kappa,
+                    sample_sequence(seed, KERNEL_STREAM, sample_id),
+                    backend=self.backend))
+        if issparse(self.mat):
+            return vstack(sims, format="csr")
+        return np.concatenate(sims)
+
+    def _run_kernel(self, closed, seeds, executor, first_block):
+        return run_blocks(_simulate_closed, closed, self.depths,
+                          [child_sequence(seed, KERNEL_STREAM)
+                           for seed in seeds],
+                          executor=executor, first_block=first_block,
+                          model=self.model, kappa=self.kappa,
+                          backend=self.backend,
+                          out_dtype=_draw_dtype(self.dtype))
+
+    def to_table(self, sim, truth=None):
+        """
+        Filter a simulated matrix and wrap it
+        in a biom.Table (features x samples).
+        With the truth (one value per feature),
+        return it as well for the kept features.
+        """
+
+        with stage("output_validation", shape=sim.shape) as details:
+            sim, rows, columns = output_matrix_validation(
+                sim, compact=self.dtype == np.float32)
+            if details is not None:
+                details["output_shape"] = sim.shape
+        with stage("table", shape=sim.shape[::-1]):
+            table = Table(sim.T, self.feature_ids[columns],
+                          self.sample_ids[rows])
+        if truth is None:
+            return table
+        return table, pd.Series(truth[columns], index=table.ids(
+            "observation"), name="log_fold_change")
+
+
+def _select(table, sample_ids, feature_ids):
+    """
+    The selected samples and features of a table
+    or of an HDF5 biom file, without the ones that
+    sum to zero in the selection.
+    """
+
+    if isinstance(table, (str, os.PathLike)):
+        with stage("load", sample_ids=sample_ids is not None,
+                   feature_ids=feature_ids is not None):
+            return load_subset(table, sample_ids, feature_ids)
+    if sample_ids is None and feature_ids is None:
+        return table
+    samples = _positions(table.ids(), sample_ids, "sample")
+    features = _positions(table.ids("observation"), feature_ids,
+                          "feature")
+    mat = table.matrix_data.tocsr()[features][:, samples]
+
+    return Table(mat, table.ids("observation")[features],
+                 table.ids()[samples],
+                 table_id=table.table_id).remove_empty(inplace=False)
+
+
+def _as_groups(groups, sample_ids):
+    """
+    Boolean mask of the second (larger) level of
+    a two-level grouping of the samples.
+    """
+
+    if groups is None:
+        raise ValueError("groups is required with log_fold_changes")
+    if isinstance(groups, pd.Series):
+        groups = groups.reindex(sample_ids)
+        if groups.isna().any():
+            raise ValueError("groups is missing samples")
+    groups = np.asarray(groups)
+    if groups.shape != (len(sample_ids),):
+        raise ValueError("groups must have one entry per sample")
+    levels, group = np.unique(groups, return_inverse=True)
+    if len(levels) != 2:
+        raise ValueError("groups must have two levels")
+
+    return group.astype(bool)
+
+
+def _as_effects(log_fold_changes, feature_ids):
+    """
+    Log-fold-changes in the order of the features,
+    zero for the features missing from a Series.
+    """
+
+    if isinstance(log_fold_changes, pd.Series):
+        log_fold_changes = log_fold_changes.reindex(feature_ids,
+                                                    fill_value=0)
+    lfc = np.asarray(log_fold_changes, dtype=np.float64)
+    if lfc.shape != (len(feature_ids),):
+        raise ValueError("log_fold_changes must have one entry "
+                         "per feature")
+
+    return lfc
+
+
+def _inject_effects(closed, group, lfc):
+    """
+    Multiply the closed proportions of the rows
+    of group by exp(lfc) and close them again,
+    in a copy of the dense or CSR input.
+    """
+
+    fold = np.exp(lfc).astype(closed.dtype)
+    closed = closed.copy()
+    if issparse(closed):
+        rows = np.repeat(group, np.diff(closed.indptr))
+        closed.data[rows] *= fold[closed.indices[rows]]
+        return _sparse_closure(closed, dtype=closed.dtype)
+    shifted = closed[group] * fold
+    shifted /= shifted.sum(1, keepdims=True)
+    closed[group] = shifted
+
+    return closed
+
+
+def _restrict_support(mat, support):
+    """
+    Restrict a (samples x features) CSR matrix to
+    the nonzero entries of a (features x samples)
+    support mask. Support entries that are zero in
+    mat are kept as stored zeros.
+    """
+
+    if isinstance(support, Table):
+        support = support.matrix_data
+    support = csr_matrix(support).T.tocsr()
+    if support.shape != mat.shape:
+        raise ValueError("support shape does not match the table")
+    support.eliminate_zeros()
+    support.sort_indices()
+    rows, cols = support.nonzero()
+    values = np.asarray(mat[rows, cols], dtype=mat.dtype).ravel()
+
+    return csr_matrix((values, cols, support.indptr),
+                      shape=mat.shape)
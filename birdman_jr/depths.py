@@ -0,0 +1,126 @@
+import numpy as np
+from biom import Table
+from birdman_jr.parallel import as_generator
+
+# names of the depth models of draw_depths
+DEPTH_MODELS = ["empirical", "lognormal", "nb"]
+
+
+def draw_depths(table, n_samples=None, model="lognormal", seed=None):
+    """
+    Draw read depths from a model of the sample
+    sums of a table, for any number of samples.
+
+    Parameters
+    ----------
+    table: biom.Table or array_like
+        Feature table (features x samples), or
+        directly the observed sample depths.
+    n_samples: int or None
+        Number of depths to draw.
+        Default is None (one per sample).
+    model: str
+        "empirical" resamples the observed depths
+        with replacement, "lognormal" draws from a
+        log-normal fitted to them and "nb" from a
+        negative binomial with their mean and
+        variance (Poisson if not over-dispersed).
+        Default is "lognormal".
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Seed of the draws.
+        Default is None (fresh entropy).
+
+    Returns
+    -------
+    array_like, np.int
+       Depths (n_samples x 1), at least 1.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if model is unknown.
+    ValueError
+       Raises an error if no sample has a positive depth.
+    """
+
+    if model not in DEPTH_MODELS:
+        raise ValueError("model must be one of %s" % ", ".join(DEPTH_MODELS))
+    if isinstance(table, Table):
+        sums = np.asarray(table.matrix_data.sum(0)).ravel()
+    else:
+        sums = np.asarray(table, dtype=np.float64).ravel()
+    if n_samples is None:
+        n_samples = len(sums)
+    sums = sums[sums > 0]
+    if not len(sums):
+        raise ValueError("no sample has a positive depth")
+    rng = as_generator(seed)
+    size = (n_samples, 1)
+
+    if model == "empirical":
+        depths = rng.choice(sums, size=size)
+    elif model == "lognormal":
+        log_sums = np.log(sums)
+        depths = rng.lognormal(log_sums.mean(), log_sums.std(), size=size)
+    else:
+        mean, var = sums.mean(), sums.var()
+        if var > mean:
+            # numpy's (n, p) for the mean and variance
+            n = mean ** 2 / (var - mean)
+            depths = rng.negative_binomial(n, n / (n + mean), size=size)
+        else:
+            depths = rng.poisson(mean, size=size)
+
+    return np.maximum(np.rint(depths), 1).astype(np.int64)
+
+
+def resample_samples(table, n_samples, seed=None):
+    """
+    Draw samples (columns) of a table with
+    replacement to build a table of any number
+    of samples with the same proportions.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    n_samples: int
+        Number of samples of the new table.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Seed of the draws.
+        Default is None (fresh entropy).
+
+    Returns
+    -------
+    biom.Table
+       Table (features x n_samples), sample i is a
+       copy of a template sample with id
+       "<template id>_<i>".
+    """
+
+    columns = sample_columns(table, n_samples, seed)
+    ids = resampled_ids(table.ids(), columns)
+
+    return Table(table.matrix_data.tocsc()[:, columns],
+                 table.ids("observation"), ids)
+
+
+def sample_columns(table, n_samples, seed=None):
+    """
+    Indices of the template samples drawn
+    by resample_samples.
+    """
+
+    return as_generator(seed).integers(0, table.shape[1], n_samples)
+
+
+def resampled_ids(sample_ids, columns, start=0):
+    """
+    Ids "<template id>_<i>" of the resampled
+    samples, i counting from start.
+    """
+
+    template = np.asarray(sample_ids, dtype=str)[columns]
+    suffix = np.arange(start, start + len(columns)).astype(str)
+
+    return np.char.add(np.char.add(template, "_"), suffix).astype(object)
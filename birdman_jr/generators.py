@@ -1,8 +1,11 @@
+from functools import lru_cache
+
 import numpy as np
-from scipy.stats import norm
+
+_SQRT_2PI = np.sqrt(2 * np.pi)
 
 
-def gradient(g, mu, sigma, peaks=None):
+def gradient(g, mu, sigma, peaks=None, dtype=np.float64, chunk_size=None):
     """
     This generates an urn simulating a chain of interacting species.
     This commonly occurs in the context of a redox tower, where
@@ -17,8 +20,13 @@ def gradient(g, mu, sigma, peaks=None):
        Vector of standard deviations.
     peaks : array_like
        Vector of peaks
-    rng: np.random.RandomState
-       Numpy random state.
+    dtype: np.float64 or np.float32
+       Floating point precision of the output.
+       Default is np.float64.
+    chunk_size: int or None
+       Number of samples evaluated at once, which
+       bounds the temporary memory for huge grids.
+       Default is None (all samples at once).
     Returns
     -------
     np.array
@@ -30,11 +38,39 @@ def gradient(g, mu, sigma, peaks=None):
     if peaks is None:
         peaks = np.ones(len(mu))
 
-    xs = [peaks[i] * norm.pdf(g, loc=mu[i], scale=sigma[i])
-          for i in range(len(mu))]
-    return np.vstack(xs).T
+    return _gaussian_kernel(g, mu, sigma, peaks, dtype, chunk_size)
+
+
+def _gaussian_kernel(g, mu, sigma, scale=1, dtype=np.float64,
+                     chunk_size=None):
+    """
+    scale * norm.pdf(g, loc=mu, scale=sigma) over the
+    (samples x features) grid of g and mu, broadcast
+    in place over chunks of samples.
+    """
 
-def blocks(ncols, nrows, nblocks, overlap=0, minval=0, sigma=2, maxval=1.0):
+    g = np.asarray(g, dtype=dtype).reshape(-1, 1)
+    mu = np.asarray(mu, dtype=dtype)
+    sigma = np.asarray(sigma, dtype=dtype)
+    # normalizing constant and peaks folded into one vector
+    scale = (np.asarray(scale, dtype=dtype) / (sigma * _SQRT_2PI)
+             ).astype(dtype, copy=False)
+    out = np.empty((len(g), len(mu)), dtype=dtype)
+    step = chunk_size if chunk_size else max(len(g), 1)
+    for start in range(0, len(g), step):
+        block = out[start:start + step]
+        np.subtract(g[start:start + step], mu, out=block)
+        block /= sigma
+        np.square(block, out=block)
+        block *= -0.5
+        np.exp(block, out=block)
+        block *= scale
+
+    return out
+
+
+def blocks(ncols, nrows, nblocks, overlap=0, minval=0, sigma=2, maxval=1.0,
+           dtype=np.float64, chunk_size=None):
     """
     Generate block diagonal with Gaussian distributed values within blocks.
 
@@ -59,6 +95,13 @@ def blocks(ncols, nrows, nblocks, overlap=0, minval=0, sigma=2, maxval=1.0):
     maxval : int
         The max value output of the table (Default = 1)
 
+    dtype : np.float64 or np.float32
+        Floating point precision of the table
+        (Default = np.float64)
+
+    chunk_size : int or None
+        Number of rows of the background gradient
+        evaluated at once (Default = None, all rows)
 
     Returns
     -------
@@ -74,25 +117,17 @@ def blocks(ncols, nrows, nblocks, overlap=0, minval=0, sigma=2, maxval=1.0):
 
     if nblocks <= 1:
         raise ValueError('`nblocks` needs to be greater than 1.')
-    mat = np.zeros((nrows, ncols))
-    gradient = np.linspace(0, 10, nrows)
-    mu = np.linspace(0, 10, ncols)
-    xs = [norm.pdf(gradient, loc=mu[i], scale=sigma)
-          for i in range(len(mu))]
-    mat = np.vstack(xs).T
+    mat = _gaussian_kernel(np.linspace(0, 10, nrows),
+                           np.linspace(0, 10, ncols), sigma,
+                           dtype=dtype, chunk_size=chunk_size)
     block_cols = ncols // (nblocks * 2)
-    block_rows = nrows // nblocks 
+    block_rows = nrows // nblocks
+    # every row of a block sits at gradient 5, so a
+    # block is a single row broadcast over its rows
+    B = _block_row(block_cols + overlap, sigma, maxval, np.dtype(dtype))
 
     for b in range(nblocks - 1):
 
-        gradient = np.linspace(
-            5, 5, block_rows)  # samples (bock_rows)
-        # features (block_cols+overlap)
-        mu = np.linspace(0, 10, block_cols + overlap)
-        xs = [norm.pdf(gradient, loc=mu[i], scale=sigma)
-              for i in range(len(mu))]
-
-        B = np.vstack(xs).T * maxval
         lower_row = block_rows * b
         upper_row = min(block_rows * (b + 1), nrows)
         lower_col = block_cols * b
@@ -103,30 +138,32 @@ def blocks(ncols, nrows, nblocks, overlap=0, minval=0, sigma=2, maxval=1.0):
                 lower_col:int(upper_col + overlap)] = B
         else:
             ov_tmp = int(overlap / 2)
-            if (B.shape) == (mat[lower_row:upper_row,
-                                 int(lower_col - ov_tmp):
-                                 int(upper_col + ov_tmp + 1)].shape):
-                mat[lower_row:upper_row, int(
-                    lower_col - ov_tmp):int(upper_col + ov_tmp + 1)] = B
-            elif (B.shape) == (mat[lower_row:upper_row,
-                                   int(lower_col - ov_tmp):
-                                   int(upper_col + ov_tmp)].shape):
-                mat[lower_row:upper_row, int(
-                    lower_col - ov_tmp):int(upper_col + ov_tmp)] = B
-            elif (B.shape) == (mat[lower_row:upper_row,
-                                   int(lower_col - ov_tmp):
-                                   int(upper_col + ov_tmp - 1)].shape):
-                mat[lower_row:upper_row, int(
-                    lower_col - ov_tmp):int(upper_col + ov_tmp - 1)] = B
-
-    upper_col = int(upper_col - overlap) 
+            # the block fits one of these column spans
+            for extra in (1, 0, -1):
+                cols = slice(int(lower_col - ov_tmp),
+                             int(upper_col + ov_tmp + extra))
+                if mat[lower_row:upper_row, cols].shape[1] == len(B):
+                    mat[lower_row:upper_row, cols] = B
+                    break
+
+    upper_col = int(upper_col - overlap)
     # Make last block fill in the remainder
-    gradient = np.linspace(5, 5, nrows - upper_row)
-    mu = np.linspace(0, 10, ncols - upper_col)
-    xs = [norm.pdf(gradient, loc=mu[i], scale=sigma)
-          for i in range(len(mu))]
-    B = np.vstack(xs).T * maxval
-
-    mat[upper_row:, upper_col:] = B
+    mat[upper_row:, upper_col:] = _block_row(ncols - upper_col, sigma,
+                                             maxval, np.dtype(dtype))
 
     return mat
+
+
+@lru_cache(maxsize=32)
+def _block_row(n_cols, sigma, maxval, dtype):
+    """
+    Row of a block, the Gaussian kernel at gradient 5
+    over n_cols features evenly spaced on [0, 10].
+    Cached and read-only as all blocks share it.
+    """
+
+    row = _gaussian_kernel([5], np.linspace(0, 10, n_cols), sigma,
+                           maxval, dtype)[0]
+    row.flags.writeable = False
+
+    return row
@@ -0,0 +1,360 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import h5py
+import numpy as np
+import pandas as pd
+from biom import Table
+from scipy.sparse import csr_matrix
+
+# biom stores indices and indptr as int32
+_INDEX_MAX = np.iinfo(np.int32).max
+_VLEN_STR = h5py.special_dtype(vlen=str)
+# number of stored entries moved at once by the final pass
+_COPY_CHUNK = 1 << 22
+
+
+class HDF5TableWriter:
+    """
+    Write a table to an HDF5 biom (2.1) file one
+    block of samples at a time, with memory bounded
+    by the block size and the number of features.
+
+    Samples that sum to zero are dropped as they
+    are appended. Features that sum to zero are
+    dropped by close(), which remaps the stored
+    sample-major matrix in place and builds the
+    observation-major matrix from it chunk by chunk,
+    without reloading the whole table.
+
+    Parameters
+    ----------
+    path: str
+        Output HDF5 biom file.
+    feature_ids: array_like of str
+        Ids of the features (columns of the blocks).
+    table_id: str or None
+        Id of the table.
+        Default is None.
+    compress: bool
+        If True the datasets are gzip compressed.
+        Default is True.
+    chunk_size: int
+        Number of samples read per chunk by the
+        final pass. Default is 1024.
+
+    Examples
+    --------
+    >>> with HDF5TableWriter(path, feature_ids) as writer:
+    ...     for block, ids in blocks:
+    ...         writer.append(block, ids)
+    """
+
+    def __init__(self, path, feature_ids, table_id=None,
+                 compress=True, chunk_size=1024):
+
+        self.path = path
+        self.feature_ids = np.asarray(feature_ids, dtype=object)
+        self.table_id = table_id
+        self.chunk_size = chunk_size
+        self.sample_ids = []
+        self.feature_nnz = np.zeros(len(self.feature_ids), dtype=np.int64)
+        self.nnz = 0
+        compression = "gzip" if compress else None
+        self.h5 = h5py.File(path, "w")
+        matrix = self.h5.create_group("sample/matrix")
+        self._data = matrix.create_dataset(
+            "data", shape=(0,), maxshape=(None,), dtype=np.float64,
+            chunks=True, compression=compression)
+        self._indices = matrix.create_dataset(
+            "indices", shape=(0,), maxshape=(None,), dtype=np.int32,
+            chunks=True, compression=compression)
+        self._indptr = [0]
+        self.compression = compression
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.h5.close()
+
+    def append(self, block, sample_ids):
+        """
+        Append a block of samples.
+
+        Parameters
+        ----------
+        block: array_like or scipy.sparse matrix
+            Counts of the block (samples x features).
+        sample_ids: array_like of str
+            Ids of the samples (rows) of the block.
+        """
+
+        block = csr_matrix(block)
+        block.eliminate_zeros()
+        block.sort_indices()
+        # remove zero sums
+        keep = block.getnnz(1) > 0
+        if not keep.all():
+            block = block[keep]
+        sample_ids = np.asarray(sample_ids, dtype=object)[keep]
+        start = self.nnz
+        self.nnz += block.nnz
+        if self.nnz > _INDEX_MAX:
+            raise ValueError("Too many nonzero entries for a biom table")
+        self._data.resize((self.nnz,))
+        self._indices.resize((self.nnz,))
+        self._data[start:] = block.data
+        self._indices[start:] = block.indices
+        self._indptr.extend(start + block.indptr[1:])
+        self.feature_nnz += np.bincount(block.indices,
+                                        minlength=block.shape[1])
+        self.sample_ids.extend(sample_ids)
+
+    def close(self):
+        """
+        Drop zero-sum features, write the observation
+        matrix, the ids and the attributes and close
+        the file.
+        """
+
+        keep = self.feature_nnz > 0
+        # features without any stored entry only need
+        # the indices of the others to be shifted down
+        remap = np.cumsum(keep, dtype=np.int64) - 1
+        for start in range(0, self.nnz, _COPY_CHUNK):
+            stop = min(start + _COPY_CHUNK, self.nnz)
+            self._indices[start:stop] = remap[self._indices[start:stop]]
+        feature_nnz = self.feature_nnz[keep]
+        feature_ids = self.feature_ids[keep]
+        indptr = np.asarray(self._indptr, dtype=np.int32)
+        sample = self.h5["sample"]
+        sample.create_dataset("matrix/indptr", data=indptr,
+                              compression=self.compression)
+        self._write_ids(sample, self.sample_ids)
+        self._write_observations(indptr, feature_nnz)
+        self._write_ids(self.h5["observation"], feature_ids)
+        for axis in ["observation", "sample"]:
+            self.h5[axis].create_group("metadata")
+            self.h5[axis].create_group("group-metadata")
+        attrs = self.h5.attrs
+        attrs["id"] = self.table_id if self.table_id else "No Table ID"
+        attrs["type"] = ""
+        attrs["format-url"] = "http://biom-format.org"
+        attrs["format-version"] = (2, 1)
+        attrs["generated-by"] = "birdman_jr"
+        attrs["creation-date"] = datetime.now().isoformat()
+        attrs["shape"] = (len(feature_ids), len(self.sample_ids))
+        attrs["nnz"] = self.nnz
+        self.h5.close()
+
+    def _write_observations(self, sample_indptr, feature_nnz):
+        """
+        Transpose the sample-major matrix into the
+        observation-major one with a chunked counting
+        sort through disk-backed scratch arrays.
+        """
+
+        obs_indptr = np.zeros(len(feature_nnz) + 1, dtype=np.int64)
+        np.cumsum(feature_nnz, out=obs_indptr[1:])
+        cursor = obs_indptr[:-1].copy()
+        scratch = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            shape = (max(self.nnz, 1),)
+            data = np.memmap(os.path.join(scratch, "data"),
+                             dtype=np.float64, mode="w+", shape=shape)
+            indices = np.memmap(os.path.join(scratch, "indices"),
+                                dtype=np.int32, mode="w+", shape=shape)
+            n_samples = len(sample_indptr) - 1
+            for first in range(0, n_samples, self.chunk_size):
+                last = min(first + self.chunk_size, n_samples)
+                start, stop = sample_indptr[first], sample_indptr[last]
+                features = self._indices[start:stop]
+                samples = np.repeat(np.arange(first, last, dtype=np.int32),
+                                    np.diff(sample_indptr[first:last + 1]))
+                # samples arrive in order, so within a feature
+                # the rank in this chunk gives the position
+                order = np.argsort(features, kind="stable")
+                features = features[order]
+                counts = np.bincount(features, minlength=len(cursor))
+                group_start = np.cumsum(counts) - counts
+                ranks = np.arange(len(features)) - group_start[features]
+                positions = cursor[features] + ranks
+                data[positions] = self._data[start:stop][order]
+                indices[positions] = samples[order]
+                cursor += counts
+            obs = self.h5.create_group("observation/matrix")
+            for name, values in [("data", data), ("indices", indices)]:
+                dataset = obs.create_dataset(
+                    name, shape=(self.nnz,), dtype=values.dtype,
+                    chunks=True if self.nnz else None,
+                    compression=self.compression)
+                for start in range(0, self.nnz, _COPY_CHUNK):
+                    stop = min(start + _COPY_CHUNK, self.nnz)
+                    dataset[start:stop] = values[start:stop]
+            obs.create_dataset("indptr", data=obs_indptr.astype(np.int32),
+                               compression=self.compression)
+            del data, indices
+        finally:
+            shutil.rmtree(scratch)
+
+    def _write_ids(self, group, ids):
+        if len(ids) > 0:
+            group.create_dataset("ids", shape=(len(ids),), dtype=_VLEN_STR,
+                                 data=[str(i).encode("utf8") for i in ids],
+                                 compression=self.compression)
+        else:
+            group.create_dataset("ids", shape=(0,), data=[],
+                                 compression=self.compression)
+
+
+def load_subset(path, sample_ids=None, feature_ids=None,
+                remove_empty=True):
+    """
+    Load a subset of the samples and/or features of
+    an HDF5 biom (2.1) file, reading only their
+    slices of the matrix from disk.
+
+    The ids and the indptr of the selected axis are
+    read whole, the data and indices only for the
+    selected rows, one read per run of consecutive
+    rows. With sample ids the sample-major matrix is
+    read, with only feature ids the observation-major
+    one. The metadata is not loaded.
+
+    Parameters
+    ----------
+    path: str
+        HDF5 biom file.
+    sample_ids: array_like of str or None
+        Samples to load, in this order.
+        Default is None (all the samples).
+    feature_ids: array_like of str or None
+        Features to load, in this order.
+        Default is None (all the features).
+    remove_empty: bool
+        If True, the samples and features that
+        sum to zero in the subset are removed,
+        as biom does when loading a subset.
+        Default is True.
+
+    Returns
+    -------
+    biom.Table
+       The subset (features x samples).
+
+    Raises
+    ------
+    ValueError
+       Raises an error if an id is not in the
+       file or is selected more than once.
+    """
+
+    with h5py.File(path, "r") as h5:
+        all_samples = _read_ids(h5["sample/ids"])
+        all_features = _read_ids(h5["observation/ids"])
+        samples = _positions(all_samples, sample_ids, "sample")
+        features = _positions(all_features, feature_ids, "feature")
+        if sample_ids is not None or feature_ids is None:
+            mat = _read_rows(h5["sample/matrix"], samples,
+                             len(all_features))
+            if feature_ids is not None:
+                mat = mat[:, features]
+            mat = mat.T.tocsr()
+        else:
+            mat = _read_rows(h5["observation/matrix"], features,
+                             len(all_samples))
+        table_id = h5.attrs.get("id")
+
+    table = Table(mat, all_features[features], all_samples[samples],
+                  table_id=table_id)
+    if remove_empty:
+        table = table.remove_empty(inplace=False)
+
+    return table
+
+
+def _read_ids(dataset):
+    if not len(dataset):
+        return np.array([], dtype=object)
+    return np.asarray(dataset.asstr()[:], dtype=object)
+
+
+def _positions(ids, selected, axis):
+    """
+    Positions of the selected ids, all of them
+    if selected is None.
+    """
+
+    if selected is None:
+        return np.arange(len(ids))
+    selected = pd.Index(np.asarray(selected, dtype=object))
+    if selected.has_duplicates:
+        raise ValueError("%s ids are selected more than once" % axis)
+    positions = pd.Index(ids).get_indexer(selected)
+    if np.any(positions < 0):
+        missing = list(selected[positions < 0][:5])
+        raise ValueError("%s ids not found: %s"
+                         % (axis, ", ".join(map(str, missing))))
+
+    return positions
+
+
+def _read_rows(matrix, rows, n_cols):
+    """
+    CSR matrix of the given rows (in that order) of
+    a compressed biom matrix group. The rows are
+    read in file order, one slice of data and
+    indices per span of rows closer than a chunk
+    of the datasets (a chunk is decompressed whole
+    anyway), and gathered back in the given order.
+    """
+
+    if len(rows) == 0:
+        return csr_matrix((0, n_cols))
+    data, indices = matrix["data"], matrix["indices"]
+    indptr = matrix["indptr"][:].astype(np.int64)
+    if len(rows) == len(indptr) - 1 and \
+            np.array_equal(rows, np.arange(len(rows))):
+        return csr_matrix((data[:], indices[:], indptr),
+                          shape=(len(rows), n_cols))
+    starts, stops = indptr[rows], indptr[rows + 1]
+    lengths = stops - starts
+    order = np.argsort(starts, kind="stable")
+    gap = data.chunks[0] if data.chunks else _COPY_CHUNK
+    # a span starts where the next row is more
+    # than gap entries after the previous one
+    ordered_starts = starts[order]
+    ends = np.maximum.accumulate(stops[order])
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ordered_starts[1:] - ends[:-1] > gap
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(order)) - 1
+    span_starts = ordered_starts[first]
+    span_stops = ends[last]
+    buffers = [[], []]
+    for start, stop in zip(span_starts, span_stops):
+        if stop > start:
+            buffers[0].append(data[start:stop])
+            buffers[1].append(indices[start:stop])
+    span_data = np.concatenate(buffers[0] or [np.zeros(0)])
+    span_indices = np.concatenate(buffers[1] or [np.zeros(0, np.int32)])
+    # offset of each span in the buffers
+    offsets = np.cumsum(span_stops - span_starts) - (span_stops
+                                                     - span_starts)
+    span_of = np.cumsum(new) - 1
+    row_offset = np.empty(len(rows), dtype=np.int64)
+    row_offset[order] = (offsets[span_of] + ordered_starts
+                         - span_starts[span_of])
+    sub_indptr = np.concatenate([[0], np.cumsum(lengths)])
+    gather = np.repeat(row_offset - sub_indptr[:-1], lengths) + \
+        np.arange(sub_indptr[-1])
+
+    return csr_matrix((span_data[gather], span_indices[gather],
+                       sub_indptr), shape=(len(rows), n_cols))
@@ -0,0 +1,79 @@
+"""
+Numba compiled kernels of the "numba" backend of
+base_models. Importing this module requires numba,
+base_models falls back to numpy without it. The
+threading layer is left to numba's config, the
+worker pools of n_jobs never fork a process its
+threads ran in, see parallel.pool_context.
+"""
+import numpy as np
+from numba import njit, prange
+
+# errors of fused_counts, raised by the caller
+OK, NEGATIVE, ZERO_ROW = 0, 1, 2
+
+
+@njit(parallel=True, cache=True)
+def fused_counts(mat, depths, kappa, gamma, generators, block_size, out,
+                 rows, columns):
+    """
+    Closure, rate draw, Poisson draw and zero sum
+    masks of a dense (samples x features) matrix
+    in one pass per row, over blocks of rows in
+    parallel threads.
+
+    Block b is drawn from generators[b] (a typed
+    list of np.random.Generator), so the counts
+    only depend on the generators and block_size.
+    The rates are depths * p * exp(kappa * z) for
+    pln (z standard normal) and depths * p * g /
+    kappa for nb (g standard gamma of shape kappa,
+    with gamma set), with kappa one value per
+    feature.
+
+    Writes the counts to out and the masks of the
+    nonzero rows and columns to rows and columns
+    (which must start False). Returns the largest
+    count and an error code (OK, NEGATIVE or
+    ZERO_ROW).
+    """
+
+    n_rows, n_cols = mat.shape
+    n_blocks = len(generators)
+    if n_blocks == 0:
+        return 0, OK
+    max_counts = np.zeros(n_blocks, dtype=np.int64)
+    errors = np.zeros(n_blocks, dtype=np.int64)
+    for b in prange(n_blocks):
+        rng = generators[np.int64(b)]
+        for i in range(b * block_size, min((b + 1) * block_size, n_rows)):
+            total = 0.0
+            for j in range(n_cols):
+                if mat[i, j] < 0:
+                    errors[b] = NEGATIVE
+                total += mat[i, j]
+            if total == 0:
+                errors[b] = ZERO_ROW
+            if errors[b] != OK:
+                break
+            scale = depths[i] / total
+            nonzero = False
+            for j in range(n_cols):
+                # one draw per entry keeps the stream
+                # aligned over zero proportions
+                if gamma:
+                    lam = rng.standard_gamma(kappa[j]) / kappa[j]
+                else:
+                    lam = np.exp(kappa[j] * rng.standard_normal())
+                lam *= mat[i, j] * scale
+                count = rng.poisson(lam) if lam > 0 else 0
+                out[i, j] = count
+                if count > 0:
+                    nonzero = True
+                    # only ever set to True, the order
+                    # of the writes does not matter
+                    columns[j] = True
+                    max_counts[b] = max(max_counts[b], count)
+            rows[i] = nonzero
+
+    return max_counts.max(), errors.max()
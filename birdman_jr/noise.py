@@ -1,6 +1,9 @@
 import numpy as np
-from numpy.random import (randint, normal)
-from skbio.stats.composition import (alr, alr_inv)
+from scipy.sparse import csr_matrix, issparse
+from birdman_jr.parallel import as_generator
+
+# rows drawn and transformed at once
+_NOISE_ROWS = 256
 
 
 def add_noise(mat,
@@ -9,7 +12,9 @@ def add_noise(mat,
               percent_random=0.1,
               random_count=1,
               add_missing_at_random=False,
-              percent_missing=0.1):
+              percent_missing=0.1,
+              seed=None,
+              dtype=np.float64):
     """
     This function transforms count data into
     the simplex with the ALR This gives the
@@ -22,11 +27,15 @@ def add_noise(mat,
 
     Parameters
     ----------
-    mat: array_like
+    mat: array_like or scipy.sparse matrix
         matrix of strictly positive counts
         or probabilities/proportions.
         columns = features (components)
         rows = samples (compositions)
+        A sparse matrix is never densified,
+        noise is only added on its stored
+        entries and the proportions are
+        closed over them.
     pseudocount: float
         Pseudocount to add for ALR.
         Default is 1.
@@ -44,12 +53,22 @@ def add_noise(mat,
         mat. If True percent_missing is ignored.
     percent_missing: float
         Percent of data to add missing (zero)
-        values. Default is 0.1 (i.e. 10%)
+        values, drawn at distinct positions.
+        Default is 0.1 (i.e. 10%)
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Seed of the noise, a Generator is
+        drawn from directly.
+        Default is None (fresh entropy).
+    dtype: np.float64 or np.float32
+        Floating point precision of the
+        noisy proportions.
+        Default is np.float64.
 
     Returns
     -------
-    array_like, np.float
-       A matrix of noisy proportions.
+    array_like, np.float or scipy.sparse.csr_matrix
+       A matrix of noisy proportions, sparse
+       for sparse input.
 
     Raises
     ------
@@ -58,38 +77,182 @@ def add_noise(mat,
     ValueError
        Raises an error if the matrix has more than 2 dimension.
     ValueError
-       Raises an error if there is a row that has all zeros.
+       Raises an error if there is a row that has all zeros
+       and the pseudocount is zero.
     """
 
-    # transform mat into ALR space for
-    # adding normal dist. noise
-    mat_noise = alr(mat + pseudocount)
+    _validate(mat, pseudocount)
+    # transform mat into log space for adding
+    # normal dist. noise, in a single buffer that
+    # is then overwritten with the noisy proportions
+    mat_noise = _noise_base(mat, pseudocount, dtype)
 
-    # add homo-scedastic noise
-    err = percent_normal * np.ones_like(mat_noise)
-    mat_noise = normal(mat_noise, err)
+    return _apply_noise(mat_noise, mat, percent_normal,
+                        percent_random, random_count,
+                        add_missing_at_random, percent_missing,
+                        as_generator(seed), out=mat_noise)
 
-    # add hetero-scedastic noise
-    err = percent_random * np.ones_like(mat_noise)
-    n_entries = int(percent_random * np.count_nonzero(mat_noise))
-    i = randint(0, err.shape[0], n_entries)
-    j = randint(0, err.shape[1], n_entries)
-    err[i, j] = random_count
-    mat_noise = normal(mat_noise, err)
 
-    # transform back
-    mat_noise = alr_inv(mat_noise)
+def _validate(mat, pseudocount):
+    """
+    Raise the errors of the ALR transform of
+    mat + pseudocount without copying the matrix.
+    """
+
+    values = mat.data if issparse(mat) else np.asarray(mat)
+    if values.ndim > 2:
+        raise ValueError("Input matrix can only have two dimensions or less")
+    if np.any(values < 0):
+        raise ValueError("Cannot have negative proportions")
+    # the pseudocount is added before the log, so
+    # rows of zeros only fail without one
+    if pseudocount == 0 and np.any(np.asarray(mat.sum(-1)) == 0):
+        raise ValueError("Input matrix cannot have rows with all zeros")
+
+
+def _noise_base(mat, pseudocount, dtype=np.float64):
+    """
+    Log transform that noise is added on. Adding
+    noise to every log value but the first and
+    closing the exponential is the same as adding
+    it in ALR space (first feature as reference)
+    and taking the inverse ALR. The base only
+    depends on the input and the pseudocount so it
+    can be shared between noisy replicates. For
+    sparse input only the stored entries are kept.
+    """
+
+    if issparse(mat):
+        base = csr_matrix(mat, dtype=dtype, copy=True)
+        base.data += pseudocount
+        np.log(base.data, out=base.data)
+        return base
+    base = np.array(mat, dtype=dtype)
+    base += pseudocount
+    np.log(base, out=base)
+
+    return base
+
+
+def _apply_noise(mat_noise, mat,
+                 percent_normal,
+                 percent_random,
+                 random_count,
+                 add_missing_at_random,
+                 percent_missing,
+                 rng,
+                 out=None):
+    """
+    Add noise to the log base and return noisy
+    proportions, written to out (which may be the
+    base itself) or else to a new buffer, leaving
+    the base untouched.
+
+    The homoscedastic and heteroscedastic draws are
+    fused: every ALR value gets one normal draw with
+    standard deviation hypot(percent_normal,
+    percent_random), or hypot(percent_normal,
+    random_count) at the randomly chosen entries.
+    """
+
+    # the sum of the two independent
+    # normal draws is a single normal
+    sd_normal = np.hypot(percent_normal, percent_random)
+    sd_random = np.hypot(percent_normal, random_count)
+    if issparse(mat_noise):
+        return _apply_sparse_noise(mat_noise, mat, sd_normal, sd_random,
+                                   percent_random, add_missing_at_random,
+                                   percent_missing, rng)
+
+    if out is None:
+        out = np.empty_like(mat_noise)
+    n_rows, n_cols = mat_noise.shape
+    # entries with hetero-scedastic noise (in the ALR
+    # columns), sorted by row to be found per block
+    n_entries = int(percent_random * n_rows * (n_cols - 1))
+    i = rng.integers(0, n_rows, n_entries)
+    j = rng.integers(1, n_cols, n_entries)
+    order = np.argsort(i, kind="stable")
+    i, j = i[order], j[order]
+    for start in range(0, n_rows, _NOISE_ROWS):
+        stop = min(start + _NOISE_ROWS, n_rows)
+        block = out[start:stop]
+        z = rng.standard_normal((stop - start, n_cols - 1),
+                                dtype=mat_noise.dtype)
+        selected = slice(*np.searchsorted(i, [start, stop]))
+        bi, bj = i[selected] - start, j[selected] - 1
+        z_random = z[bi, bj] * sd_random
+        z *= sd_normal
+        z[bi, bj] = z_random
+        block[:, 0] = mat_noise[start:stop, 0]
+        np.add(mat_noise[start:stop, 1:], z, out=block[:, 1:])
+        # transform back
+        block -= block.max(1, keepdims=True)
+        np.exp(block, out=block)
+        block /= block.sum(1, keepdims=True)
+        if not add_missing_at_random:
+            block[np.asarray(mat[start:stop]) == 0] = 0
 
     # finally add sparsity
     # Note: there will be no zeros after
     #       using the pseudocount
     if add_missing_at_random:
-        n_entries = int(percent_missing * np.count_nonzero(mat_noise))
-        i = randint(0, mat_noise.shape[0], n_entries)
-        j = randint(0, mat_noise.shape[1], n_entries)
-        mat_noise[i, j] = 0
+        n_entries = int(percent_missing * np.count_nonzero(out))
+        out.reshape(-1)[_distinct_positions(n_entries, out.size, rng)] = 0
+
+    return out
+
+
+def _apply_sparse_noise(mat_noise, mat, sd_normal, sd_random,
+                        percent_random, add_missing_at_random,
+                        percent_missing, rng):
+    """
+    Noise on the stored entries of a CSR log base,
+    returning noisy proportions on the same support.
+    Missing values at random are drawn among the
+    stored entries.
+    """
+
+    nnz = mat_noise.nnz
+    # reduceat needs the starts of the nonempty rows
+    lengths = np.diff(mat_noise.indptr)
+    row_starts = mat_noise.indptr[:-1][lengths > 0]
+    lengths = lengths[lengths > 0]
+    data = rng.standard_normal(nnz, dtype=mat_noise.dtype)
+    n_entries = int(percent_random * nnz)
+    selected = rng.integers(0, nnz, n_entries)
+    z_random = data[selected] * sd_random
+    data *= sd_normal
+    data[selected] = z_random
+    # the first feature is the ALR reference
+    data[mat_noise.indices == 0] = 0
+    data += mat_noise.data
+    # transform back
+    data -= np.repeat(np.maximum.reduceat(data, row_starts), lengths)
+    np.exp(data, out=data)
+    data /= np.repeat(np.add.reduceat(data, row_starts), lengths)
+    # finally add sparsity
+    if add_missing_at_random:
+        n_entries = int(percent_missing * nnz)
+        data[_distinct_positions(n_entries, nnz, rng)] = 0
     else:
-        i, j = np.nonzero(mat == 0)
-        mat_noise[i, j] = 0
+        data[csr_matrix(mat).data == 0] = 0
+
+    return csr_matrix((data, mat_noise.indices.copy(),
+                       mat_noise.indptr.copy()), shape=mat_noise.shape)
+
+
+def _distinct_positions(n, size, rng):
+    """
+    n distinct positions in range(size), drawn with
+    replacement and topped up until n are distinct,
+    so that memory scales with n and not with size.
+    """
+
+    n = min(n, size)
+    positions = np.unique(rng.integers(0, size, n))
+    while len(positions) < n:
+        extra = rng.integers(0, size, n - len(positions))
+        positions = np.union1d(positions, extra)
 
-    return mat_noise
+    return positions
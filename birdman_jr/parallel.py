@@ -0,0 +1,357 @@
+import hashlib
+import multiprocessing
+import os
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.sparse import issparse, vstack
+
+# number of samples (rows) simulated per random stream,
+# the output for a given seed depends on it but not on
+# the number of workers the blocks are spread over
+BLOCK_SIZE = 256
+# spawn keys of the streams of one simulation: the
+# noise, the model kernel, the drawn depths and the
+# resampled samples draw from separate streams
+NOISE_STREAM = 0
+KERNEL_STREAM = 1
+DEPTH_STREAM = 2
+RESAMPLE_STREAM = 3
+
+
+def as_seed_sequence(seed):
+    """
+    Convert a seed into a numpy SeedSequence.
+
+    Parameters
+    ----------
+    seed: None, int, array_like of ints, np.random.SeedSequence
+          or np.random.Generator
+        Root seed of the simulation. None draws
+        fresh entropy from the OS. A Generator
+        is advanced to draw the entropy, so
+        repeated calls with it differ but are
+        reproducible from its initial state.
+
+    Returns
+    -------
+    np.random.SeedSequence
+        The root seed sequence.
+    """
+
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(
+            seed.integers(0, 2 ** 32, size=4, dtype=np.uint32))
+    return np.random.SeedSequence(seed)
+
+
+def as_generator(seed):
+    """
+    Convert a seed into a PCG64 numpy Generator.
+
+    Parameters
+    ----------
+    seed: None, int, array_like of ints, np.random.SeedSequence
+          or np.random.Generator
+        Seed as in as_seed_sequence, a Generator
+        is returned as is.
+
+    Returns
+    -------
+    np.random.Generator
+        The random generator.
+    """
+
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.Generator(np.random.PCG64(as_seed_sequence(seed)))
+
+
+def child_sequence(seed_seq, *keys):
+    """
+    Child stream of a SeedSequence. The child with
+    key i is the same stream as the i-th result of
+    seed_seq.spawn, but it is derived without
+    mutating seed_seq so it can be recomputed in any
+    process and in any order.
+
+    Parameters
+    ----------
+    seed_seq: np.random.SeedSequence
+        Parent seed sequence.
+    keys: int
+        Spawn key(s) of the child, one per level.
+
+    Returns
+    -------
+    np.random.SeedSequence
+        The child seed sequence.
+    """
+
+    return np.random.SeedSequence(seed_seq.entropy,
+                                  spawn_key=seed_seq.spawn_key + keys,
+                                  pool_size=seed_seq.pool_size)
+
+
+def sample_sequence(seed_seq, stream, sample_id):
+    """
+    Stream of one sample, keyed by a 64 bit blake2b
+    hash of its id, so that the draws of a sample do
+    not depend on its row or on the other samples.
+
+    Parameters
+    ----------
+    seed_seq: np.random.SeedSequence
+        Root seed sequence.
+    stream: int
+        Stream of the draws (NOISE_STREAM, ...).
+    sample_id: str
+        Id of the sample.
+
+    Returns
+    -------
+    np.random.SeedSequence
+        The seed sequence of the sample.
+    """
+
+    digest = hashlib.blake2b(str(sample_id).encode("utf8"),
+                             digest_size=8).digest()
+
+    return child_sequence(seed_seq, stream,
+                          int.from_bytes(digest, "little"))
+
+
+def n_workers(n_jobs):
+    """
+    Number of worker processes for n_jobs, where
+    None or 1 means serial and -1 all CPUs.
+    """
+
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError("n_jobs cannot be zero")
+    return n_jobs
+
+
+@contextmanager
+def worker_pool(n_jobs):
+    """
+    Process pool for n_jobs, or None when serial.
+    """
+
+    workers = n_workers(n_jobs)
+    if workers == 1:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=pool_context()) as executor:
+        yield executor
+
+
+def pool_context():
+    """
+    Start method of the worker processes: a fork
+    server where the platform has one, else the
+    default of multiprocessing. Forking a process
+    whose numba backend threads ran hangs tbb at
+    exit and aborts GNU OpenMP, so the workers
+    never fork the caller, whatever it ran before.
+    Scripts starting pools need an
+    if __name__ == "__main__" guard, as with spawn.
+    """
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return None
+
+
+def run_blocks(kernel, mat, depths, seeds, executor=None,
+               block_size=BLOCK_SIZE, first_block=0, out_dtype=np.int64,
+               **kwargs):
+    """
+    Run a simulation kernel over blocks of samples
+    (rows), for one or more replicates.
+
+    Block b of the replicate with seed s is drawn
+    from the stream child_sequence(s, b), so the
+    result only depends on the seeds and block_size
+    and is identical for serial and parallel runs.
+
+    Parameters
+    ----------
+    kernel: callable
+        kernel(mat, depths, rng=rng, **kwargs) returning
+        the simulated counts of a block of rows. It must
+        be a module level function so workers can import it.
+    mat: array_like or scipy.sparse matrix
+        Closed proportions (samples x features).
+    depths: array_like
+        Read depths (samples x 1).
+    seeds: list of np.random.SeedSequence
+        One root sequence per replicate.
+    executor: concurrent.futures.Executor or None
+        Pool to shard (replicate, block) tasks over,
+        None runs in this process. Dense inputs and
+        outputs are passed through shared memory.
+    block_size: int
+        Number of rows per random stream.
+    first_block: int
+        Index of the first block, so that a chunk of
+        rows starting at first_block * block_size is
+        drawn from the same streams as in a run over
+        the whole matrix. Default is 0.
+    out_dtype: np.dtype
+        Integer dtype of the dense output. If a
+        count does not fit it, the blocks are drawn
+        again from the same streams as np.int64.
+        Default is np.int64.
+
+    Returns
+    -------
+    array_like, np.int or scipy.sparse matrix
+        (replicates x samples x features) counts for
+        dense input, a list of CSR matrices (one per
+        replicate) for sparse input.
+    """
+
+    n_rows = mat.shape[0]
+    blocks = [(i, start, min(start + block_size, n_rows))
+              for i, start in enumerate(range(0, n_rows, block_size),
+                                        first_block)]
+    tasks = [(r, child_sequence(seed, i), start, stop)
+             for r, seed in enumerate(seeds)
+             for i, start, stop in blocks]
+
+    if issparse(mat):
+        # blocks of a CSR matrix are cheap row slices
+        # and are pickled to the workers as they are
+        def block_args(r, seed, start, stop):
+            return (kernel, kwargs, mat[start:stop],
+                    depths[start:stop], seed)
+        if executor is None:
+            sims = [_run_sparse_block(*block_args(*task))
+                    for task in tasks]
+        else:
+            sims = list(executor.map(_run_sparse_block_args,
+                                     [block_args(*task) for task in tasks]))
+        n_blocks = len(blocks)
+        return [vstack(sims[r * n_blocks:(r + 1) * n_blocks], format="csr")
+                for r in range(len(seeds))]
+
+    try:
+        return _run_dense_blocks(kernel, kwargs, mat, depths, tasks,
+                                 len(seeds), executor, out_dtype)
+    except OverflowError:
+        if np.dtype(out_dtype) == np.int64:
+            raise
+        return _run_dense_blocks(kernel, kwargs, mat, depths, tasks,
+                                 len(seeds), executor, np.int64)
+
+
+def _run_dense_blocks(kernel, kwargs, mat, depths, tasks, n_replicates,
+                      executor, out_dtype):
+    out_shape = (n_replicates,) + mat.shape
+    if executor is None:
+        out = np.empty(out_shape, dtype=out_dtype)
+        for r, seed, start, stop in tasks:
+            _store(out, r, start, stop,
+                   kernel(mat[start:stop], depths[start:stop],
+                          rng=as_generator(seed), **kwargs))
+        return out
+
+    with _shared_array(mat) as mat_spec, \
+            _shared_array(depths) as depths_spec, \
+            _shared_array(None, out_shape, out_dtype) as out_spec:
+        futures = [executor.submit(_run_dense_block, kernel, kwargs,
+                                   mat_spec, depths_spec, out_spec, *task)
+                   for task in tasks]
+        # every block is done before the shared
+        # memory is released, even on an error
+        wait(futures)
+        for future in futures:
+            future.result()
+        return _read_shared(out_spec)
+
+
+def _store(out, replicate, start, stop, counts):
+    """
+    Write the counts of a block into out, raising
+    an OverflowError if one does not fit its dtype.
+    """
+
+    if counts.size and counts.dtype != out.dtype:
+        info = np.iinfo(out.dtype)
+        if counts.max() > info.max or counts.min() < info.min:
+            raise OverflowError("counts do not fit %s" % out.dtype)
+    out[replicate, start:stop] = counts
+
+
+def _run_sparse_block(kernel, kwargs, mat, depths, seed):
+    return kernel(mat, depths, rng=as_generator(seed), **kwargs)
+
+
+def _run_sparse_block_args(args):
+    return _run_sparse_block(*args)
+
+
+def _run_dense_block(kernel, kwargs, mat_spec, depths_spec, out_spec,
+                     replicate, seed, start, stop):
+    blocks = [SharedMemory(name=spec[0])
+              for spec in (mat_spec, depths_spec, out_spec)]
+    try:
+        mat, depths, out = [np.ndarray(spec[1], np.dtype(spec[2]),
+                                       buffer=shm.buf)
+                            for spec, shm in zip((mat_spec, depths_spec,
+                                                  out_spec), blocks)]
+        _store(out, replicate, start, stop,
+               kernel(mat[start:stop], depths[start:stop],
+                      rng=as_generator(seed), **kwargs))
+    finally:
+        # views must be released before the blocks close
+        mat = depths = out = None
+        for shm in blocks:
+            shm.close()
+
+
+@contextmanager
+def _shared_array(arr, shape=None, dtype=None):
+    """
+    Copy arr (or allocate shape/dtype) into a shared
+    memory block and yield its (name, shape, dtype)
+    spec. The block is unlinked on exit.
+    """
+
+    if arr is not None:
+        arr = np.ascontiguousarray(arr)
+        shape, dtype = arr.shape, arr.dtype
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = SharedMemory(create=True, size=size)
+    try:
+        if arr is not None:
+            np.ndarray(shape, dtype, buffer=shm.buf)[...] = arr
+        yield shm.name, shape, dtype.str
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _read_shared(spec):
+    """
+    Copy the array of a shared memory spec out of
+    the block.
+    """
+
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, np.dtype(dtype), buffer=shm.buf).copy()
+    finally:
+        shm.close()
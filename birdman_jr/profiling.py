@@ -0,0 +1,166 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# profiles currently recording, innermost last
+_ACTIVE = []
+# returned by stage() when nothing is recording
+_NULL = nullcontext()
+
+
+class Profile:
+    """
+    Per-stage records of the instrumented calls run
+    inside a profile() block.
+
+    Each record holds the stage path (nested stage
+    names joined by "/"), its wall time in seconds,
+    the peak memory allocated above the start of the
+    stage in bytes (None without memory tracing) and
+    the details passed by the stage (shapes, replicate,
+    ...).
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._stack = []
+
+    def to_dict(self):
+        """
+        The records as a JSON serializable dict.
+        """
+
+        return {"records": [dict(record) for record in self.records]}
+
+    def to_json(self, path=None):
+        """
+        The records as JSON, written to path if given.
+        """
+
+        text = json.dumps(self.to_dict(), default=_to_builtin, indent=1)
+        if path is not None:
+            with open(path, "w") as fh:
+                fh.write(text)
+        return text
+
+    def to_frame(self):
+        """
+        The records as a pandas DataFrame,
+        one row per stage.
+        """
+
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+    def total(self, stage):
+        """
+        Total wall time of a stage path, in seconds.
+        """
+
+        return sum(record["seconds"] for record in self.records
+                   if record["stage"] == stage)
+
+
+@contextmanager
+def profile(trace_memory=True):
+    """
+    Record the stages of the instrumented calls
+    (simulate, simulate_replicates, ...) run inside
+    the block.
+
+    Parameters
+    ----------
+    trace_memory: bool
+        If True, also record the peak memory of each
+        stage with tracemalloc, which slows down the
+        allocations. Default is True.
+
+    Yields
+    ------
+    Profile
+       The records, filled as the stages run.
+
+    Examples
+    --------
+    >>> with profile() as prof:
+    ...     simulate(table, seed=42)
+    >>> prof.to_frame()
+    """
+
+    prof = Profile(trace_memory)
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _ACTIVE.append(prof)
+    try:
+        yield prof
+    finally:
+        _ACTIVE.remove(prof)
+        if started:
+            tracemalloc.stop()
+
+
+def stage(name, **details):
+    """
+    Context manager timing one stage of a call for
+    the active profiles. It yields the details of the
+    stage (to add output shapes while it runs) or
+    None, and is a shared no-op when no profile is
+    active.
+    """
+
+    if not _ACTIVE:
+        return _NULL
+    return _record(name, details)
+
+
+@contextmanager
+def _record(name, details):
+    profiles = list(_ACTIVE)
+    trace = tracemalloc.is_tracing() and any(prof.trace_memory
+                                             for prof in profiles)
+    frame = {"name": name, "peak": 0, "start": 0}
+    if trace:
+        # the peak is reset for this stage, keep the
+        # one of the enclosing stage so far
+        frame["start"], peak = tracemalloc.get_traced_memory()
+        _raise_parent_peak(profiles, peak)
+        tracemalloc.reset_peak()
+    paths = []
+    for prof in profiles:
+        paths.append("/".join([parent["name"] for parent in prof._stack]
+                              + [name]))
+        prof._stack.append(frame)
+    start = time.perf_counter()
+    try:
+        # details added by the stage while it runs
+        yield details
+    finally:
+        seconds = time.perf_counter() - start
+        size = None
+        if trace:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            size = peak - frame["start"]
+        for prof, path in zip(profiles, paths):
+            prof._stack.pop()
+            record = {"stage": path, "seconds": seconds,
+                      "bytes": size if prof.trace_memory else None}
+            record.update(details)
+            prof.records.append(record)
+        if trace:
+            _raise_parent_peak(profiles, peak)
+
+
+def _raise_parent_peak(profiles, peak):
+    for prof in profiles:
+        if prof._stack:
+            prof._stack[-1]["peak"] = max(prof._stack[-1]["peak"], peak)
+
+
+def _to_builtin(value):
+    # numpy scalars and tuples of shapes
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % type(value))
@@ -0,0 +1,131 @@
+import numpy as np
+from biom import Table
+from birdman_jr.parallel import as_generator
+
+# largest rate accepted by Generator.poisson
+_MAX_RATE = 1e18
+
+
+def negative_binomial_regression(x, depth, n_features, B_p=1, phi_s=1,
+                                 n_draws=None, seed=None, output="arrays",
+                                 feature_ids=None, sample_ids=None):
+    """
+    Simulate counts from a negative binomial
+    regression on a two column design matrix.
+    This is the generated quantities block of
+    stan-tmp/sim_nb.stan, drawn with NumPy
+    instead of a CmdStan fixed_param run.
+
+    beta_var[0] ~ Normal(-2, B_p) and
+    beta_var[1] ~ Normal(0 or 1, B_p), with a
+    mean of 0 if the last sample has x[:, 1] == 1
+    and 1 otherwise (the Stan program overwrites
+    beta_var once per sample, so the last sample
+    decides). The log abundances relative to the
+    first feature are lam_clr = [0, x @ beta_var],
+    each count draws its own |Cauchy(0, phi_s)|
+    dispersion and
+    y_sim ~ NegBinomial2Log(depth + lam_clr, phi).
+
+    Parameters
+    ----------
+    x: array_like
+        Design matrix (samples x 2), the
+        second column is the group indicator.
+    depth: array_like
+        Log read depth of each sample.
+    n_features: int
+        Number of features (D), at least 2.
+    B_p: float
+        Standard deviation of the
+        coefficients. Default is 1.
+    phi_s: float
+        Scale of the half-Cauchy dispersion.
+        Default is 1.
+    n_draws: int or None
+        Number of independent draws, stacked on
+        a leading axis of every array. None
+        returns a single draw without that axis.
+        Default is None.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Seed of the draws.
+        Default is None (fresh entropy).
+    output: str
+        "arrays" returns the dict of arrays,
+        "table" a biom.Table of y_sim (single
+        draw only). Default is "arrays".
+    feature_ids: array_like of str or None
+        Feature ids of the table.
+        Default is None (F0, F1, ...).
+    sample_ids: array_like of str or None
+        Sample ids of the table.
+        Default is None (S0, S1, ...).
+
+    Returns
+    -------
+    dict or biom.Table
+       "y_sim" (samples x features counts),
+       "beta_var" (2 x features - 1),
+       "lam_clr" (samples x features) and
+       "phi" (the dispersions of the last
+       sample, as stored by the Stan program),
+       or y_sim as a (features x samples) table.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if x does not have two columns.
+    ValueError
+       Raises an error if depth does not match x.
+    ValueError
+       Raises an error if n_features is less than 2.
+    ValueError
+       Raises an error if output is not "arrays" or "table".
+    ValueError
+       Raises an error if output is "table" with n_draws.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    depth = np.asarray(depth, dtype=np.float64).ravel()
+    if x.ndim != 2 or x.shape[1] != 2:
+        raise ValueError("x must be a (samples x 2) design matrix")
+    if depth.shape[0] != x.shape[0]:
+        raise ValueError("depth must have one value per row of x")
+    if n_features < 2:
+        raise ValueError("n_features must be at least 2")
+    if output not in ("arrays", "table"):
+        raise ValueError("output must be 'arrays' or 'table'")
+    if output == "table" and n_draws is not None:
+        raise ValueError("output='table' is only supported for one draw")
+    rng = as_generator(seed)
+    N, D = x.shape[0], n_features
+    draws = () if n_draws is None else (n_draws,)
+
+    beta_var = rng.standard_normal(draws + (2, D - 1))
+    beta_var *= B_p
+    beta_var[..., 0, :] -= 2
+    if x[-1, 1] != 1:
+        beta_var[..., 1, :] += 1
+    lam_clr = np.zeros(draws + (N, D))
+    np.matmul(x, beta_var, out=lam_clr[..., 1:])
+    # one dispersion per count
+    phi = np.abs(rng.standard_cauchy(draws + (N, D)))
+    phi *= phi_s
+    # NB2 as a gamma-Poisson mixture with mean exp(eta)
+    mu = np.exp(depth[:, None] + lam_clr)
+    rate = rng.gamma(phi, mu / phi)
+    # tiny dispersions give rates beyond what poisson
+    # accepts (the Stan rng rejects those draws)
+    np.minimum(rate, _MAX_RATE, out=rate)
+    y_sim = rng.poisson(rate)
+    sim = {"y_sim": y_sim, "beta_var": beta_var,
+           "lam_clr": lam_clr, "phi": phi[..., -1, :]}
+
+    if output == "table":
+        if feature_ids is None:
+            feature_ids = ["F%i" % i for i in range(D)]
+        if sample_ids is None:
+            sample_ids = ["S%i" % i for i in range(N)]
+        return Table(y_sim.T, feature_ids, sample_ids)
+
+    return sim
@@ -0,0 +1,206 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from birdman_jr.data_driven import _Simulation, _resolve_depths
+from birdman_jr.parallel import (as_seed_sequence, child_sequence,
+                                 n_workers, pool_context)
+
+# parameters of simulate that can vary over a sweep,
+# with their defaults
+SWEEP_PARAMETERS = {"distribution": "pln",
+                    "kappa": 1,
+                    "pseudocount": 1,
+                    "impose_noise": False,
+                    "percent_normal": 0.1,
+                    "percent_random": 0.1,
+                    "random_count": 1,
+                    "add_missing_at_random": False,
+                    "percent_missing": 0.1}
+
+
+def expand_grid(grid):
+    """
+    Expand a parameter grid into its points.
+
+    Parameters
+    ----------
+    grid: dict or list of dict
+        Values of each parameter, every combination
+        is a point. A list of grids is the union of
+        their points, as in sklearn's ParameterGrid.
+
+    Returns
+    -------
+    pd.DataFrame
+       One row per point (index "point") and one
+       column per sweep parameter, the parameters
+       that are not in the grid take their default.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if a parameter cannot be swept.
+    """
+
+    if isinstance(grid, dict):
+        grid = [grid]
+    points = []
+    for subgrid in grid:
+        unknown = set(subgrid) - set(SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError("parameters cannot be swept: %s"
+                             % ", ".join(sorted(unknown)))
+        names = list(subgrid)
+        # the raw values, an array of mixed values would
+        # turn them all into strings
+        for values in product(*(_values(subgrid[name])
+                                for name in names)):
+            point = dict(SWEEP_PARAMETERS)
+            point.update(zip(names, values))
+            points.append(point)
+    points = pd.DataFrame(points, columns=list(SWEEP_PARAMETERS))
+    points.index.name = "point"
+
+    return points
+
+
+def _values(values):
+    if isinstance(values, (list, tuple, np.ndarray)):
+        return list(values)
+    return [values]
+
+
+def sweep(table, grid, n_replicates=1, depths=None, sparse=False,
+          seed=None, n_jobs=None, dtype=np.float64):
+    """
+    Simulate every point of a parameter grid from
+    the same table.
+
+    The densified matrix, the depths, the closures
+    (one per dm pseudocount) and the noise bases
+    (one per pseudocount) are computed once and
+    shared by all the points, instead of once per
+    call of simulate.
+
+    Parameters
+    ----------
+    table: biom.Table
+        Feature table (features x samples)
+    grid: dict or list of dict
+        Parameter grid, see expand_grid.
+    n_replicates: int
+        Number of replicates per point.
+        Default is 1.
+    depths: array_like, None or str
+        Read depths shared by all points,
+        "fit" draws them once, see simulate.
+        Default is None (the sample sums).
+    sparse: bool
+        If True the table is never densified,
+        see simulate. Default is False.
+    seed: None, int, np.random.SeedSequence or np.random.Generator
+        Root seed, replicate r of point i is drawn
+        from the child stream (i, r), so a point
+        does not depend on the rest of the grid.
+        Default is None (fresh entropy).
+    n_jobs: int or None
+        Number of worker processes the points are
+        scheduled over. Each worker precomputes
+        the shared inputs once.
+        Default is None (serial).
+    dtype: np.float64 or np.float32
+        Floating point precision, see simulate.
+        Default is np.float64.
+
+    Returns
+    -------
+    pd.DataFrame
+       Tidy index of the simulations, one row per
+       (point, replicate) with the parameters.
+    iterator of (int, biom.Table)
+       The row of the index and the simulated
+       table, in the order of the index.
+
+    Raises
+    ------
+    ValueError
+       Raises an error if a parameter cannot be swept.
+    ValueError
+       Raises an error if a distribution is unknown.
+
+    The errors of simulate are raised here
+    as well, before any point is simulated.
+    """
+
+    points = expand_grid(grid)
+    index = points.loc[points.index.repeat(n_replicates)].reset_index()
+    index.insert(1, "replicate", np.tile(np.arange(n_replicates),
+                                         len(points)))
+    index.index.name = "simulation"
+    root = as_seed_sequence(seed)
+    setup = (table, _resolve_depths(table, depths, root), sparse, dtype)
+    # validate every point before the first draw
+    cache = {}
+    for params in points.to_dict("records"):
+        _simulation(setup, cache, params)
+    tasks = [(params, child_sequence(root, i, r))
+             for (i, r), params in zip(
+                 index[["point", "replicate"]].itertuples(index=False),
+                 points.loc[index["point"]].to_dict("records"))]
+
+    return index, _iter_sweep(setup, cache, tasks, n_jobs)
+
+
+def _iter_sweep(setup, cache, tasks, n_jobs):
+    workers = n_workers(n_jobs)
+    if workers == 1:
+        for i, (params, seed) in enumerate(tasks):
+            yield i, _simulate_point(setup, cache, params, seed)
+        return
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=pool_context(),
+                             initializer=_init_worker,
+                             initargs=(setup,)) as executor:
+        # a bounded window of points in flight keeps
+        # the finished tables from piling up
+        pending = deque()
+        for i, task in enumerate(tasks):
+            pending.append((i, executor.submit(_run_worker_point, *task)))
+            if len(pending) >= 2 * workers:
+                i, future = pending.popleft()
+                yield i, future.result()
+        while pending:
+            i, future = pending.popleft()
+            yield i, future.result()
+
+
+def _simulation(setup, cache, params):
+    table, depths, sparse, dtype = setup
+    return _Simulation(table, depths, params["distribution"],
+                       params["kappa"], params["pseudocount"],
+                       params["impose_noise"], params["percent_normal"],
+                       params["percent_random"], params["random_count"],
+                       params["add_missing_at_random"],
+                       params["percent_missing"], sparse, None, dtype,
+                       cache=cache)
+
+
+def _simulate_point(setup, cache, params, seed):
+    simulation = _simulation(setup, cache, params)
+    return simulation.to_table(simulation.run(seed))
+
+
+# inputs of the sweep, set once per worker process
+_WORKER = {}
+
+
+def _init_worker(setup):
+    _WORKER["setup"] = setup
+    _WORKER["cache"] = {}
+
+
+def _run_worker_point(params, seed):
+    return _simulate_point(_WORKER["setup"], _WORKER["cache"], params, seed)
@@ -1,12 +1,22 @@
 import unittest
 import numpy as np
+from scipy.sparse import csr_matrix
 from scipy.special import rel_entr
 from skbio.stats.composition import closure
 from birdman_jr.base_models import (poisson_lognormal,
                                     negative_binomial,
                                     dirichlet_multinomial)
 from birdman_jr.base_models import (input_matrix_validation,
-                                    output_matrix_validation)
+                                    output_matrix_validation,
+                                    _negative_binomial,
+                                    _dirichlet_multinomial,
+                                    _sparse_dirichlet_multinomial,
+                                    _fused_counts)
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 class TestBaseModels(unittest.TestCase):
@@ -42,6 +52,18 @@ class TestBaseModels(unittest.TestCase):
         kldiv[~np.isfinite(kldiv)] = 0.0
         self.assertTrue(0 <= kldiv.sum(1).max() <= 2)
 
+    def test_negative_binomial_moments(self):
+        # mean m = depths * proportions, variance m + m ** 2 / kappa
+        mat = closure(np.tile(self.mat[:1], (20000, 1)))
+        depths = np.full((mat.shape[0], 1), 100)
+        m = (depths * mat)[0]
+        for kappa in [0.5, 4, np.array([1, 2, 3, 4, 5, 6])]:
+            sim = _negative_binomial(mat, depths, kappa,
+                                     np.random.default_rng(42))
+            np.testing.assert_allclose(sim.mean(0), m, rtol=0.05)
+            np.testing.assert_allclose(sim.var(0), m + m ** 2 / kappa,
+                                       rtol=0.1)
+
     def test_dirichlet_multinomial(self):
         dm_mat = dirichlet_multinomial(self.mat, self.depths)[0]
         kldiv = rel_entr(closure(self.mat),
@@ -49,6 +71,108 @@ class TestBaseModels(unittest.TestCase):
         kldiv[~np.isfinite(kldiv)] = 0.0
         self.assertTrue(0 <= kldiv.sum(1).max() <= 2)
 
+    def test_dirichlet_multinomial_dirichlet(self):
+        dm_mat = dirichlet_multinomial(self.mat, self.depths,
+                                       use_dirichlet=True)[0]
+        self.assertEqual(dm_mat.shape[0], self.mat.shape[0])
+        self.assertTrue(np.array_equal(dm_mat.sum(1),
+                                       self.depths[:, 0]))
+
+    def test_multinomial_depths(self):
+        m_mat = dirichlet_multinomial(self.mat, self.depths)[0]
+        self.assertTrue(np.array_equal(m_mat.sum(1),
+                                       self.depths[:, 0]))
+        # zero proportions can never be drawn
+        self.assertTrue(np.all(m_mat[self.mat == 0] == 0))
+
+    def test_multinomial_methods(self):
+        # every sampler has the moments of numpy's multinomial,
+        # n p and n p (1 - p), over many rows of the same p
+        p = closure(np.tile(self.mat[2], (20000, 1)).astype(float))
+        for depth in [3, 40, 400]:
+            depths = np.full((p.shape[0], 1), depth)
+            m = depth * p[0]
+            for method in ['numpy', 'cdf', 'poisson']:
+                sim = _dirichlet_multinomial(p, depths, False,
+                                             np.random.default_rng(42),
+                                             method)
+                self.assertTrue(np.array_equal(sim.sum(1), depths[:, 0]))
+                self.assertTrue(np.all(sim[:, p[0] == 0] == 0))
+                np.testing.assert_allclose(sim.mean(0), m, rtol=0.05)
+                np.testing.assert_allclose(sim.var(0), m * (1 - p[0]),
+                                           rtol=0.1)
+        # uneven depths, a zero depth and zero proportions
+        mat = closure(self.mat.astype(float))
+        depths = np.array([[0], [1], [7], [100], [10 ** 6], [123456]])
+        for method in ['cdf', 'poisson']:
+            sim = _dirichlet_multinomial(mat, depths, False,
+                                         np.random.default_rng(0), method)
+            self.assertTrue(np.array_equal(sim.sum(1), depths[:, 0]))
+            self.assertTrue(np.all(sim[self.mat == 0] == 0))
+            self.assertTrue(np.array_equal(
+                dirichlet_multinomial(mat, depths + 1, seed=0,
+                                      method=method)[0],
+                dirichlet_multinomial(mat, depths + 1, seed=0,
+                                      method=method)[0]))
+            # the sparse path draws on the support only
+            sparse = csr_matrix(mat)
+            sim = _sparse_dirichlet_multinomial(
+                sparse, depths, False, np.random.default_rng(0), method)
+            self.assertTrue(np.array_equal(sim.indptr, sparse.indptr))
+            self.assertTrue(np.array_equal(np.asarray(sim.sum(1)).ravel(),
+                                           depths[:, 0]))
+        sparse = csr_matrix(np.tile(p[:1], (5000, 1)))
+        depths = np.full((5000, 1), 200)
+        sim = _sparse_dirichlet_multinomial(
+            sparse, depths, False, np.random.default_rng(0), 'cdf')
+        np.testing.assert_allclose(np.asarray(sim.mean(0)).ravel()
+                                   [p[0] > 0], 200 * p[0][p[0] > 0],
+                                   rtol=0.05)
+        with self.assertRaises(ValueError):
+            dirichlet_multinomial(self.mat, self.depths, method='alias')
+
+    def test_backends(self):
+        for model in [poisson_lognormal, negative_binomial]:
+            # sparse input and installs without numba use numpy
+            for mat in [self.mat, csr_matrix(self.mat)]:
+                sim, rows, columns = model(mat, self.depths, seed=0,
+                                           backend="numba")
+                self.assertEqual(sim.shape, (rows.sum(), columns.sum()))
+            with self.assertRaises(ValueError):
+                model(self.mat, self.depths, backend="cuda")
+
+    @unittest.skipIf(numba is None, "numba is not installed")
+    def test_numba_backend(self):
+        for model in [poisson_lognormal, negative_binomial]:
+            sim = model(self.mat, self.depths, kappa=2, seed=42,
+                        backend="numba")
+            self.assertTrue(np.array_equal(sim[0], model(
+                self.mat, self.depths, kappa=2, seed=42,
+                backend="numba")[0]))
+            self.assertEqual(sim[0].dtype, np.uint32)
+            # zero proportions stay zero
+            self.assertEqual(sim[0][0, 3:].sum(), 0)
+            for mat in [self.mat_zero, -self.mat]:
+                with self.assertRaises(ValueError):
+                    model(mat, self.depths, backend="numba")
+            with self.assertRaises(ValueError):
+                model(self.mat, self.depths_ve1, backend="numba")
+        # same moments as the numpy kernels
+        mat = closure(np.tile(self.mat[:1], (20000, 1)))
+        depths = np.full((mat.shape[0], 1), 100)
+        m = (depths * mat)[0]
+        rng = np.random.default_rng(42)
+        for kappa in [0.5, np.array([1, 2, 3, 4, 5, 6])]:
+            sim, rows, columns, _ = _fused_counts(mat, depths, "nb",
+                                                  kappa, rng)
+            np.testing.assert_allclose(sim.mean(0), m, rtol=0.05)
+            np.testing.assert_allclose(sim.var(0), m + m ** 2 / kappa,
+                                       rtol=0.1)
+            self.assertTrue(np.array_equal(columns, sim.any(0)))
+        sim = _fused_counts(mat, depths, "pln", 0.5, rng)[0]
+        np.testing.assert_allclose(sim.mean(0), m * np.exp(0.5 ** 2 / 2),
+                                   rtol=0.05)
+
     def test_input_matrix_validation_d1(self):
         with self.assertRaises(ValueError):
             input_matrix_validation(self.mat,
@@ -68,3 +192,42 @@ class TestBaseModels(unittest.TestCase):
         mat_res = output_matrix_validation(self.mat_zero)
         self.assertTrue(np.min(mat_res[0].shape)
                         < np.min(self.mat_zero.shape))
+
+    def test_output_matrix_validation_masks(self):
+        sim = self.mat_zero.copy()
+        sim[1, 0] = -5
+        sim_res, rows, columns = output_matrix_validation(sim.copy())
+        sim[sim < 0] = 0
+        self.assertTrue(np.array_equal(rows, sim.sum(1) > 0))
+        self.assertTrue(np.array_equal(columns, sim.sum(0) > 0))
+        self.assertTrue(np.array_equal(sim_res,
+                                       sim[np.ix_(rows, columns)]))
+        # counts are stored compactly
+        self.assertEqual(sim_res.dtype, np.uint32)
+
+    def test_output_matrix_validation_no_subset(self):
+        sim = self.mat_zero.copy()
+        sim_res, rows, columns = output_matrix_validation(sim,
+                                                          subset=False)
+        # masks only, no copy
+        self.assertTrue(sim_res is sim)
+        self.assertFalse(rows[0])
+        self.assertTrue(columns.all())
+
+    def test_float32(self):
+        for model in [poisson_lognormal, negative_binomial,
+                      dirichlet_multinomial]:
+            sim = model(self.mat, self.depths, seed=0,
+                        dtype=np.float32)[0]
+            self.assertEqual(sim.dtype, np.uint16)
+        # counts that overflow uint16 fall back to uint32
+        sim = dirichlet_multinomial(self.mat, self.depths * 1000,
+                                    dtype=np.float32)[0]
+        self.assertEqual(sim.dtype, np.uint32)
+        self.assertTrue(np.array_equal(sim.sum(1),
+                                       self.depths[:, 0] * 1000))
+        self.assertEqual(input_matrix_validation(
+            self.mat, self.depths, dtype=np.float32).dtype, np.float32)
+        with self.assertRaises(ValueError):
+            input_matrix_validation(self.mat, self.depths,
+                                    dtype=np.int32)
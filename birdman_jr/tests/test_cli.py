@@ -0,0 +1,76 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from biom import Table, load_table
+from click.testing import CliRunner
+from birdman_jr.cli import cli, shard_range
+
+
+class TestCLI(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        mat = np.random.default_rng(0).poisson(20, size=(8, 12))
+        self.table = os.path.join(self.tmp, "table.biom")
+        bt = Table(mat, ['o%i' % i for i in range(8)],
+                   ['s%i' % i for i in range(12)])
+        with h5py.File(self.table, "w") as fh:
+            bt.to_hdf5(fh, "test")
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def simulate(self, output_dir, *args):
+        return self.runner.invoke(cli, ["simulate", self.table, output_dir,
+                                        "--replicates", "5", "--seed", "42",
+                                        "--distribution", "m"] + list(args))
+
+    def test_shard_range(self):
+        ranges = [shard_range(10, i, 3) for i in range(3)]
+        self.assertEqual([list(r) for r in ranges],
+                         [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]])
+
+    def test_simulate(self):
+        whole = os.path.join(self.tmp, "whole")
+        result = self.simulate(whole)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(sorted(os.listdir(whole)),
+                         ["replicate-%05i.biom" % r for r in range(5)])
+        # shards write the same replicates as a single job
+        sharded = os.path.join(self.tmp, "sharded")
+        for shard in ["0/2", "1/2"]:
+            result = self.simulate(sharded, "--shard", shard)
+            self.assertEqual(result.exit_code, 0, result.output)
+        for name in os.listdir(whole):
+            bt = load_table(os.path.join(whole, name))
+            self.assertTrue(bt == load_table(os.path.join(sharded, name)))
+        self.assertTrue(np.array_equal(bt.sum('sample'),
+                                       load_table(self.table).sum('sample')))
+
+    def test_errors(self):
+        output_dir = os.path.join(self.tmp, "out")
+        for shard in ["2/2", "1", "a/b"]:
+            result = self.simulate(output_dir, "--shard", shard)
+            self.assertNotEqual(result.exit_code, 0)
+        result = self.runner.invoke(cli, ["simulate", self.table, output_dir,
+                                          "--shard", "0/2"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_lazy_imports(self):
+        code = ("import sys; from birdman_jr.cli import cli; "
+                "print(any(m in sys.modules for m in "
+                "['numpy', 'scipy', 'skbio', 'biom']))")
+        out = subprocess.run([sys.executable, "-c", code],
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "False")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,23 @@
+import os
+import shutil
+import tempfile
 import unittest
+import h5py
 import numpy as np
-from biom import Table
+import pandas as pd
+from biom import Table, load_table
+from numpy.testing import assert_array_equal
+from scipy.sparse import issparse
 from scipy.special import rel_entr
 from skbio.stats.composition import closure
+from birdman_jr.parallel import as_seed_sequence, child_sequence
 from birdman_jr.base_models import (poisson_lognormal,
                                     negative_binomial,
                                     dirichlet_multinomial)
-from birdman_jr.data_driven import simulate
+from birdman_jr.data_driven import (simulate, simulate_replicates,
+                                    simulate_to_hdf5, simulate_effects,
+                                    estimate_kappa, estimate_dispersion,
+                                    fit_depths, resimulate)
 
 
 class TestDataDriven(unittest.TestCase):
@@ -22,6 +33,8 @@ class TestDataDriven(unittest.TestCase):
         self.sids = ['s%i' % i for i in range(self.mat.shape[1])]
         self.fids = ['o%i' % i for i in range(self.mat.shape[0])]
         self.bt_test = Table(self.mat.T, self.fids, self.sids)
+        # non-square, so that a transposed result shows
+        self.bt_wide = Table(self.mat[:4].T, self.fids, self.sids[:4])
 
     def test_models_pln(self):
         bt_res = simulate(self.bt_test,
@@ -49,11 +62,383 @@ class TestDataDriven(unittest.TestCase):
     def test_models_dm(self):
         bt_res = simulate(self.bt_test,
                           self.depths,
-                          distribution='dm')
+                          distribution='dm',
+                          seed=42)
         mat_res = bt_res.matrix_data.toarray()
         mat_test = dirichlet_multinomial(self.mat,
-                                         self.depths)[0]
+                                         self.depths,
+                                         seed=42)[0]
         kldiv = rel_entr(closure(mat_test),
                          closure(mat_res))
         kldiv[~np.isfinite(kldiv)] = 0.0
         self.assertTrue(0 <= kldiv.sum(1).max() <= 10)
+
+    def _samples_by_features(self, bt_res):
+        # simulated counts of bt_wide, (samples x features)
+        # in the order of the input table
+        self.assertTrue(set(bt_res.ids()) <= set(self.sids[:4]))
+        self.assertTrue(set(bt_res.ids('observation')) <= set(self.fids))
+        return bt_res.to_dataframe(dense=True).T.reindex(
+            index=self.sids[:4], columns=self.fids, fill_value=0).values
+
+    def _kernel_by_features(self, sim_res):
+        # kernel output expanded back to (samples x features)
+        mat_res = np.zeros((4, len(self.fids)))
+        mat_res[np.ix_(sim_res[1], sim_res[2])] = sim_res[0]
+        return mat_res
+
+    def test_orientation_pln(self):
+        mat_res = self._samples_by_features(
+            simulate(self.bt_wide, self.depths[:4]))
+        mat_test = self._kernel_by_features(
+            poisson_lognormal(self.mat[:4], self.depths[:4]))
+        # zero proportions stay zero in both
+        self.assertTrue(np.all(mat_res[self.mat[:4] == 0] == 0))
+        self.assertTrue(np.all(mat_test[self.mat[:4] == 0] == 0))
+
+    def test_orientation_nb(self):
+        mat_res = self._samples_by_features(
+            simulate(self.bt_wide, self.depths[:4], distribution='nb'))
+        mat_test = self._kernel_by_features(
+            negative_binomial(self.mat[:4], self.depths[:4]))
+        self.assertTrue(np.all(mat_res[self.mat[:4] == 0] == 0))
+        self.assertTrue(np.all(mat_test[self.mat[:4] == 0] == 0))
+
+    def test_orientation_dm(self):
+        mat_res = self._samples_by_features(
+            simulate(self.bt_wide, self.depths[:4], distribution='dm'))
+        mat_test = self._kernel_by_features(
+            dirichlet_multinomial(self.mat[:4], self.depths[:4],
+                                  use_dirichlet=True))
+        # each sample keeps its own depth
+        assert_array_equal(mat_res.sum(1), self.depths[:4, 0])
+        assert_array_equal(mat_test.sum(1), self.depths[:4, 0])
+
+    def test_non_square(self):
+        bt_res = simulate(self.bt_wide, distribution='m')
+        self.assertEqual(set(bt_res.ids()), set(self.sids[:4]))
+        self.assertTrue(np.array_equal(bt_res.sum('sample'),
+                                       self.bt_wide.sum('sample')))
+
+    def test_sparse(self):
+        for dist in ['pln', 'nb', 'dm', 'm']:
+            bt_res = simulate(self.bt_test, distribution=dist,
+                              sparse=True)
+            self.assertTrue(issparse(bt_res.matrix_data))
+            # nothing is simulated outside the support
+            mat_res = bt_res.to_dataframe(dense=True)
+            mat_in = self.bt_test.to_dataframe(dense=True)
+            mat_in = mat_in.loc[mat_res.index, mat_res.columns]
+            self.assertTrue(np.all(mat_res.values[mat_in.values == 0]
+                                   == 0))
+
+    def test_sparse_multinomial_depths(self):
+        bt_res = simulate(self.bt_test, distribution='m', sparse=True)
+        self.assertTrue(np.array_equal(bt_res.sum('sample'),
+                                       self.bt_test.sum('sample')))
+
+    def test_support(self):
+        support = self.mat.T > 20
+        bt_res = simulate(self.bt_test, distribution='m',
+                          support=support)
+        mat_res = bt_res.to_dataframe(dense=True)
+        support = Table(support, self.fids, self.sids).to_dataframe(
+            dense=True).loc[mat_res.index, mat_res.columns]
+        self.assertTrue(np.all(mat_res.values[support.values == 0] == 0))
+
+    def test_sparse_noise(self):
+        bt_res = simulate(self.bt_test, distribution='m', sparse=True,
+                          impose_noise=True, seed=42)
+        self.assertTrue(np.array_equal(bt_res.sum('sample'),
+                                       self.bt_test.sum('sample')))
+        mat_res = bt_res.to_dataframe(dense=True)
+        mat_in = self.bt_test.to_dataframe(dense=True).loc[
+            mat_res.index, mat_res.columns]
+        self.assertTrue(np.all(mat_res.values[mat_in.values == 0] == 0))
+        reps = simulate_replicates(self.bt_test, 2, distribution='m',
+                                   sparse=True, impose_noise=True, seed=42)
+        self.assertEqual(len(list(reps)), 2)
+
+    def test_replicates_tables(self):
+        reps = simulate_replicates(self.bt_test, 3, distribution='m')
+        reps = list(reps)
+        self.assertEqual(len(reps), 3)
+        for bt_res in reps:
+            self.assertTrue(np.array_equal(bt_res.sum('sample'),
+                                           self.bt_test.sum('sample')))
+
+    def test_replicates_array(self):
+        for dist in ['pln', 'nb', 'dm', 'm']:
+            reps = simulate_replicates(self.bt_test, 4,
+                                       distribution=dist,
+                                       impose_noise=True,
+                                       output='array')
+            self.assertEqual(reps.shape, (4,) + self.mat.shape)
+        # replicates are independent draws
+        self.assertFalse(np.array_equal(reps[0], reps[1]))
+
+    def test_replicates_errors(self):
+        with self.assertRaises(ValueError):
+            simulate_replicates(self.bt_test, 2, output='list')
+        with self.assertRaises(ValueError):
+            simulate_replicates(self.bt_test, 2, sparse=True,
+                                output='array')
+        with self.assertRaises(ValueError):
+            simulate_replicates(self.bt_test, 2, distribution='gaussian')
+
+    def test_seed(self):
+        for dist in ['pln', 'nb', 'dm', 'm']:
+            bt_res = simulate(self.bt_test, distribution=dist,
+                              impose_noise=True, seed=11)
+            self.assertTrue(bt_res == simulate(self.bt_test,
+                                               distribution=dist,
+                                               impose_noise=True,
+                                               seed=11))
+            self.assertTrue(bt_res == simulate(self.bt_test,
+                                               distribution=dist,
+                                               impose_noise=True,
+                                               seed=11, n_jobs=2))
+
+    def test_simulate_to_hdf5(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            rng = np.random.default_rng(0)
+            mat = rng.poisson(3, size=(700, 6))
+            mat[:, 0] += 1
+            sids = ['s%i' % i for i in range(mat.shape[0])]
+            bt_big = Table(mat.T, self.fids, sids)
+            for dist in ['nb', 'm']:
+                path = os.path.join(tmp, '%s.biom' % dist)
+                simulate_to_hdf5(bt_big, path, chunk_size=300,
+                                 distribution=dist, seed=9)
+                # chunks use the streams of a full run
+                self.assertTrue(load_table(path) ==
+                                simulate(bt_big, distribution=dist,
+                                         seed=9))
+            path = os.path.join(tmp, 'noise.biom')
+            simulate_to_hdf5(bt_big, path, chunk_size=300,
+                             impose_noise=True, seed=9)
+            self.assertEqual(load_table(path).shape[1], mat.shape[0])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_effects(self):
+        groups = ['a', 'a', 'a', 'b', 'b', 'b']
+        depths = np.full((6, 1), 10 ** 6)
+        base = simulate(self.bt_test, depths, 'm', seed=42)
+        # no effect draws the same table
+        res, truth = simulate(self.bt_test, depths, 'm', seed=42,
+                              groups=groups, log_fold_changes=np.zeros(6))
+        self.assertEqual(res, base)
+        self.assertTrue(np.array_equal(truth.index, res.ids('observation')))
+        self.assertTrue(np.all(truth == 0))
+        lfc = np.array([0, 0, np.log(4), np.log(4), 0, 0])
+        res, truth = simulate(self.bt_test, depths, 'm', seed=42,
+                              groups=groups, log_fold_changes=lfc)
+        self.assertTrue(np.array_equal(truth, lfc))
+        # group a is untouched, the proportions of group b
+        # are changed by exp(lfc) and closed again
+        mat_res = res.matrix_data.toarray().T
+        self.assertTrue(np.array_equal(mat_res[:3],
+                                       base.matrix_data.toarray().T[:3]))
+        expected = closure(closure(self.mat[3:]) * np.exp(lfc))
+        np.testing.assert_allclose(closure(mat_res[3:]), expected,
+                                   atol=0.005)
+        # features given by id, the others have no effect
+        res_ids, truth_ids = simulate(
+            self.bt_test, depths, 'm', seed=42,
+            groups=pd.Series(groups, index=self.sids),
+            log_fold_changes=pd.Series(np.log(4), index=['o2', 'o3']))
+        self.assertEqual(res_ids, res)
+        self.assertTrue(truth_ids.equals(truth))
+        # and on the support of a sparse input
+        res, _ = simulate(self.bt_test, depths, 'm', sparse=True, seed=42,
+                          groups=groups, log_fold_changes=lfc)
+        np.testing.assert_allclose(
+            closure(res.matrix_data.toarray().T[3:]), expected, atol=0.005)
+        res, truth = simulate(self.bt_test, seed=42, n_samples=10,
+                              impose_noise=True, groups=groups,
+                              log_fold_changes=lfc)
+        self.assertEqual(res.shape[1], 10)
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, log_fold_changes=lfc)
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, groups=['a'] * 6, log_fold_changes=lfc)
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, groups=groups, log_fold_changes=lfc[:3])
+
+    def test_simulate_effects(self):
+        groups = [0, 0, 0, 1, 1, 1]
+        lfc = np.outer([0, 1, 2], [1, -1, 0, 0, 0, 0])
+        for impose_noise in [False, True]:
+            results = list(simulate_effects(self.bt_test, groups, lfc,
+                                            impose_noise=impose_noise,
+                                            seed=42))
+            self.assertEqual(len(results), 3)
+            for effect, (res, truth) in zip(lfc, results):
+                expected, expected_truth = simulate(
+                    self.bt_test, impose_noise=impose_noise, seed=42,
+                    groups=groups, log_fold_changes=effect)
+                self.assertEqual(res, expected)
+                self.assertTrue(truth.equals(expected_truth))
+        frame = pd.DataFrame(lfc[:, :2], columns=['o0', 'o1'])
+        for (res, truth), effect in zip(
+                simulate_effects(self.bt_test, groups, frame, seed=42),
+                lfc):
+            self.assertTrue(np.array_equal(truth, effect))
+        with self.assertRaises(ValueError):
+            simulate_effects(self.bt_test, groups, lfc[:, :3])
+
+    def test_subset(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'table.biom')
+            with h5py.File(path, 'w') as fh:
+                self.bt_test.to_hdf5(fh, 'test')
+            sids, fids = ['s4', 's0', 's1'], ['o5', 'o3', 'o0', 'o1']
+            bt_sub = Table(self.mat[[4, 0, 1]][:, [5, 3, 0, 1]].T, fids,
+                           sids)
+            bt_exp = simulate(bt_sub, seed=42)
+            for table in [path, self.bt_test]:
+                self.assertEqual(simulate(table, seed=42, sample_ids=sids,
+                                          feature_ids=fids), bt_exp)
+            self.assertEqual(simulate(path, seed=42),
+                             simulate(self.bt_test, seed=42))
+            # s0 and s1 only have zeros in o5 and o3
+            res = simulate(path, seed=42, sample_ids=sids,
+                           feature_ids=['o5', 'o3'])
+            self.assertEqual(list(res.ids()), ['s4'])
+            with self.assertRaises(ValueError):
+                simulate(path, sample_ids=['s0', 'x'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_sample_seeding(self):
+        for kwargs in [{}, {'impose_noise': True}, {'sparse': True},
+                       {'sparse': True, 'impose_noise': True},
+                       {'distribution': 'dm'}]:
+            bt_res = simulate(self.bt_test, seed=42, seeding='sample',
+                              **kwargs)
+            # a sample does not depend on its row or the others
+            bt_rev = simulate(self.bt_test.sort_order(self.sids[::-1]),
+                              seed=42, seeding='sample', **kwargs)
+            self.assertEqual(bt_rev.sort_order(bt_res.ids()), bt_res)
+            bt_sub = simulate(self.bt_test.filter(['s1', 's4'],
+                                                  inplace=False),
+                              seed=42, seeding='sample', **kwargs)
+            self.assertTrue(np.array_equal(
+                bt_sub.data('s4'), bt_res.filter(
+                    bt_sub.ids('observation'), axis='observation',
+                    inplace=False).data('s4')))
+        for kwargs in [{'seeding': 'row'}, {'depths': 'fit'},
+                       {'kappa': 'auto'}, {'n_samples': 10}]:
+            with self.assertRaises(ValueError):
+                simulate(self.bt_test, seed=42,
+                         **dict({'seeding': 'sample'}, **kwargs))
+
+    def test_resimulate(self):
+        old = self.bt_test.filter(self.sids[:4], inplace=False)
+        groups = np.array([0, 1, 0, 1, 0, 1])
+        lfc = np.linspace(-1, 1, len(self.fids))
+        for kwargs in [{}, {'impose_noise': True}, {'sparse': True},
+                       {'groups': groups, 'log_fold_changes': lfc}]:
+            old_kwargs = dict(kwargs)
+            if 'groups' in kwargs:
+                old_kwargs['groups'] = groups[:4]
+            bt_prev = simulate(old, seed=42, seeding='sample', **old_kwargs)
+            bt_exp = simulate(self.bt_test, seed=42, seeding='sample',
+                              **kwargs)
+            if 'groups' in kwargs:
+                bt_prev, (bt_exp, truth_exp) = bt_prev[0], bt_exp
+                bt_res, truth = resimulate(bt_prev, self.bt_test, 42,
+                                           **kwargs)
+                pd.testing.assert_series_equal(truth, truth_exp)
+            else:
+                bt_res = resimulate(bt_prev, self.bt_test, 42, **kwargs)
+            self.assertEqual(bt_res, bt_exp)
+        # changed samples are simulated again
+        mat = self.mat.copy()
+        mat[0] = mat[0, ::-1]
+        bt_new = Table(mat.T, self.fids, self.sids)
+        bt_prev = simulate(self.bt_test, seed=42, seeding='sample')
+        bt_res = resimulate(bt_prev, bt_new, 42, changed=['s0'])
+        self.assertEqual(bt_res, simulate(bt_new, seed=42,
+                                          seeding='sample'))
+        self.assertTrue(np.array_equal(bt_res.data('s1'),
+                                       bt_prev.data('s1')))
+        # nothing to simulate
+        self.assertEqual(resimulate(bt_prev, self.bt_test, 42), bt_prev)
+        with self.assertRaises(ValueError):
+            resimulate(bt_prev, self.bt_test, None)
+        with self.assertRaises(ValueError):
+            resimulate(bt_prev, self.bt_test.filter(
+                self.fids[:3], axis='observation', inplace=False), 42)
+
+    def test_backend(self):
+        for kwargs in [{}, {'impose_noise': True}, {'seeding': 'sample'},
+                       {'distribution': 'nb', 'kappa': 2}]:
+            bt_res = simulate(self.bt_test, seed=42, backend='numba',
+                              **kwargs)
+            self.assertEqual(bt_res, simulate(self.bt_test, seed=42,
+                                              backend='numba', **kwargs))
+            self.assertEqual(bt_res.shape[1], self.mat.shape[0])
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, backend='cuda')
+
+    def test_float32(self):
+        for dist in ['pln', 'nb', 'dm', 'm']:
+            for sparse in [False, True]:
+                bt_res = simulate(self.bt_test, distribution=dist,
+                                  sparse=sparse, dtype=np.float32)
+                self.assertEqual(bt_res.shape[1], self.mat.shape[0])
+        bt_res = simulate(self.bt_test, impose_noise=True,
+                          dtype=np.float32)
+        self.assertEqual(bt_res.shape[1], self.mat.shape[0])
+
+    def test_estimate_kappa(self):
+        rng = np.random.default_rng(0)
+        props = rng.dirichlet(np.ones(50), size=1)
+        mu = rng.integers(5000, 20000, size=(2000, 1)) * props
+        ids = (['o%i' % i for i in range(50)],
+               ['s%i' % i for i in range(2000)])
+        for kappa in [0.5, 4]:
+            counts = rng.poisson(rng.gamma(kappa, mu / kappa))
+            bt = Table(counts.T, *ids)
+            self.assertAlmostEqual(estimate_kappa(bt, 'nb') / kappa, 1,
+                                   delta=0.1)
+            per_feature = estimate_kappa(bt, 'nb', per_feature=True)
+            self.assertEqual(per_feature.shape, (50,))
+            self.assertAlmostEqual(np.median(per_feature) / kappa, 1,
+                                   delta=0.1)
+        sigma = 0.5
+        counts = rng.poisson(mu * np.exp(sigma * rng.standard_normal(
+            mu.shape)))
+        bt = Table(counts.T, *ids)
+        self.assertAlmostEqual(estimate_kappa(bt, 'pln'), sigma, delta=0.05)
+        self.assertAlmostEqual(estimate_dispersion(bt),
+                               np.expm1(sigma ** 2), delta=0.05)
+        with self.assertRaises(ValueError):
+            estimate_kappa(bt, 'dm')
+
+    def test_fit_depths(self):
+        depths = fit_depths(self.bt_test, seed=42)
+        self.assertEqual(depths.shape, (6, 1))
+        self.assertTrue(np.all(depths >= 1))
+        self.assertTrue(np.array_equal(depths, fit_depths(self.bt_test,
+                                                          seed=42)))
+
+    def test_auto_kappa_fit_depths(self):
+        bt_res = simulate(self.bt_test, kappa='auto', depths='fit',
+                          distribution='nb', seed=42)
+        self.assertTrue(bt_res == simulate(self.bt_test, kappa='auto',
+                                           depths='fit', distribution='nb',
+                                           seed=42))
+        # fitted depths are the multinomial totals
+        bt_res = simulate(self.bt_test, depths='fit', distribution='m',
+                          seed=42)
+        self.assertEqual(bt_res.sum(), fit_depths(
+            self.bt_test, child_sequence(as_seed_sequence(42), 2)).sum())
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, kappa='fit')
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, depths='auto')
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from biom import Table, load_table
+from birdman_jr.data_driven import simulate, simulate_to_hdf5
+from birdman_jr.depths import draw_depths, resample_samples
+
+
+class TestDepths(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        mat = rng.poisson(rng.integers(5, 50, size=(40, 1)), size=(40, 6))
+        mat[:, 0] += 1
+        self.fids = ['o%i' % i for i in range(6)]
+        self.sids = ['s%i' % i for i in range(40)]
+        self.bt_test = Table(mat.T, self.fids, self.sids)
+        self.sums = mat.sum(1)
+
+    def test_draw_depths(self):
+        for model in ['empirical', 'lognormal', 'nb']:
+            depths = draw_depths(self.bt_test, 20000, model, seed=42)
+            self.assertEqual(depths.shape, (20000, 1))
+            self.assertEqual(depths.dtype, np.int64)
+            self.assertTrue(np.all(depths >= 1))
+            # the log-normal is a fit, not the sums' distribution
+            self.assertAlmostEqual(depths.mean() / self.sums.mean(), 1,
+                                   delta=0.1)
+            self.assertTrue(np.array_equal(
+                depths, draw_depths(self.bt_test, 20000, model, seed=42)))
+        # the empirical model only draws observed depths
+        depths = draw_depths(self.sums, model='empirical', seed=42)
+        self.assertEqual(depths.shape, (40, 1))
+        self.assertTrue(np.all(np.isin(depths, self.sums)))
+        with self.assertRaises(ValueError):
+            draw_depths(self.bt_test, model='gamma')
+
+    def test_resample_samples(self):
+        bt_res = resample_samples(self.bt_test, 100, seed=42)
+        self.assertEqual(bt_res.shape, (6, 100))
+        for i, sid in enumerate(bt_res.ids()):
+            template, suffix = sid.rsplit('_', 1)
+            self.assertEqual(int(suffix), i)
+            self.assertTrue(np.array_equal(
+                bt_res.data(sid), self.bt_test.data(template)))
+
+    def test_simulate_n_samples(self):
+        bt_res = simulate(self.bt_test, distribution='m', n_samples=300,
+                          depths='empirical', seed=42)
+        self.assertEqual(bt_res.shape, (6, 300))
+        self.assertTrue(np.all(np.isin(bt_res.sum('sample'), self.sums)))
+        with self.assertRaises(ValueError):
+            simulate(self.bt_test, n_samples=300, depths=self.sums[:, None])
+
+    def test_simulate_to_hdf5_n_samples(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'resampled.biom')
+            simulate_to_hdf5(self.bt_test, path, chunk_size=256,
+                             distribution='nb', n_samples=700,
+                             depths='nb', seed=9)
+            self.assertTrue(load_table(path) ==
+                            simulate(self.bt_test, distribution='nb',
+                                     n_samples=700, depths='nb', seed=9))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    unittest.main()
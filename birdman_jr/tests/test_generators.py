@@ -0,0 +1,114 @@
+import unittest
+import numpy as np
+from scipy.stats import norm
+from numpy.testing import assert_allclose
+from birdman_jr.generators import gradient, blocks
+
+
+def loop_gradient(g, mu, sigma, peaks):
+    return np.vstack([peaks[i] * norm.pdf(g, loc=mu[i], scale=sigma[i])
+                      for i in range(len(mu))]).T
+
+
+def loop_blocks(ncols, nrows, nblocks, overlap=0, sigma=2, maxval=1.0):
+    # the loop of blocks before it was vectorized, kept
+    # as is so that a change of the block placement shows
+    mat = loop_gradient(np.linspace(0, 10, nrows),
+                        np.linspace(0, 10, ncols),
+                        np.full(ncols, sigma), np.ones(ncols))
+    block_cols = ncols // (nblocks * 2)
+    block_rows = nrows // nblocks
+
+    for b in range(nblocks - 1):
+        gradient = np.linspace(5, 5, block_rows)
+        mu = np.linspace(0, 10, block_cols + overlap)
+        xs = [norm.pdf(gradient, loc=mu[i], scale=sigma)
+              for i in range(len(mu))]
+        B = np.vstack(xs).T * maxval
+        lower_row = block_rows * b
+        upper_row = min(block_rows * (b + 1), nrows)
+        lower_col = block_cols * b
+        upper_col = min(block_cols * (b + 1), ncols)
+
+        if b == 0:
+            mat[lower_row:upper_row,
+                lower_col:int(upper_col + overlap)] = B
+        else:
+            ov_tmp = int(overlap / 2)
+            if (B.shape) == (mat[lower_row:upper_row,
+                                 int(lower_col - ov_tmp):
+                                 int(upper_col + ov_tmp + 1)].shape):
+                mat[lower_row:upper_row, int(
+                    lower_col - ov_tmp):int(upper_col + ov_tmp + 1)] = B
+            elif (B.shape) == (mat[lower_row:upper_row,
+                                   int(lower_col - ov_tmp):
+                                   int(upper_col + ov_tmp)].shape):
+                mat[lower_row:upper_row, int(
+                    lower_col - ov_tmp):int(upper_col + ov_tmp)] = B
+            elif (B.shape) == (mat[lower_row:upper_row,
+                                   int(lower_col - ov_tmp):
+                                   int(upper_col + ov_tmp - 1)].shape):
+                mat[lower_row:upper_row, int(
+                    lower_col - ov_tmp):int(upper_col + ov_tmp - 1)] = B
+
+    upper_col = int(upper_col - overlap)
+    # make last block fill in the remainder
+    gradient = np.linspace(5, 5, nrows - upper_row)
+    mu = np.linspace(0, 10, ncols - upper_col)
+    xs = [norm.pdf(gradient, loc=mu[i], scale=sigma)
+          for i in range(len(mu))]
+    B = np.vstack(xs).T * maxval
+    mat[upper_row:, upper_col:] = B
+    return mat
+
+
+class TestGenerators(unittest.TestCase):
+
+    def setUp(self):
+        self.g = np.linspace(0, 10, 30)
+        self.mu = np.linspace(0, 10, 12)
+        self.sigma = np.linspace(0.5, 3, 12)
+        self.peaks = np.linspace(1, 2, 12)
+
+    def test_gradient(self):
+        mat = gradient(self.g, self.mu, self.sigma, self.peaks)
+        self.assertEqual(mat.shape, (30, 12))
+        assert_allclose(mat, loop_gradient(self.g, self.mu,
+                                           self.sigma, self.peaks))
+        # peaks default to one
+        assert_allclose(gradient(self.g, self.mu, self.sigma),
+                        loop_gradient(self.g, self.mu, self.sigma,
+                                      np.ones(12)))
+
+    def test_gradient_chunked(self):
+        mat = gradient(self.g, self.mu, self.sigma, self.peaks)
+        chunked = gradient(self.g, self.mu, self.sigma, self.peaks,
+                           chunk_size=7)
+        self.assertTrue(np.array_equal(mat, chunked))
+
+    def test_gradient_float32(self):
+        mat = gradient(self.g, self.mu, self.sigma, self.peaks,
+                       dtype=np.float32)
+        self.assertEqual(mat.dtype, np.float32)
+        assert_allclose(mat, loop_gradient(self.g, self.mu,
+                                           self.sigma, self.peaks),
+                        rtol=1e-5, atol=1e-7)
+
+    def test_blocks(self):
+        for args in [(40, 30, 2, 0), (40, 30, 3, 2),
+                     (100, 51, 4, 5), (60, 60, 5, 3)]:
+            assert_allclose(blocks(*args, maxval=2.0),
+                            loop_blocks(*args, maxval=2.0))
+
+    def test_blocks_error(self):
+        with self.assertRaises(ValueError):
+            blocks(10, 10, 1)
+
+    def test_blocks_float32(self):
+        mat = blocks(40, 30, 3, dtype=np.float32, chunk_size=4)
+        self.assertEqual(mat.dtype, np.float32)
+        assert_allclose(mat, loop_blocks(40, 30, 3), rtol=1e-5, atol=1e-7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from biom import Table, load_table
+from scipy.sparse import csr_matrix
+from birdman_jr.io import HDF5TableWriter, load_subset
+
+
+class TestIO(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.mat = rng.poisson(0.5, size=(50, 20))
+        self.mat[3, :] = 0
+        self.mat[:, 5] = 0
+        self.sids = ['s%i' % i for i in range(self.mat.shape[0])]
+        self.fids = ['o%i' % i for i in range(self.mat.shape[1])]
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'table.biom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_writer(self):
+        with HDF5TableWriter(self.path, self.fids,
+                             chunk_size=7) as writer:
+            for start in range(0, 50, 13):
+                block = self.mat[start:start + 13]
+                if start:
+                    block = csr_matrix(block)
+                writer.append(block, self.sids[start:start + 13])
+        bt_res = load_table(self.path)
+        rows = self.mat.sum(1) > 0
+        columns = self.mat.sum(0) > 0
+        bt_exp = Table(self.mat[rows][:, columns].T,
+                       np.array(self.fids)[columns],
+                       np.array(self.sids)[rows])
+        self.assertTrue(bt_res == bt_exp)
+        # only the output file is left behind
+        self.assertEqual(os.listdir(self.tmp), ['table.biom'])
+
+    def test_writer_empty(self):
+        with HDF5TableWriter(self.path, self.fids) as writer:
+            writer.append(np.zeros((2, 20)), self.sids[:2])
+        self.assertEqual(load_table(self.path).shape, (0, 0))
+
+    def test_load_subset(self):
+        with HDF5TableWriter(self.path, self.fids) as writer:
+            writer.append(self.mat, self.sids)
+        bt_file = load_table(self.path)
+        self.assertEqual(load_subset(self.path), bt_file)
+        dense = bt_file.to_dataframe(dense=True)
+        # requested order, with runs of consecutive samples
+        sids = ['s10', 's11', 's12', 's2', 's40', 's4', 's41']
+        fids = ['o7', 'o1', 'o2', 'o6']
+        for sample_ids, feature_ids in [(sids, None), (None, fids),
+                                        (sids, fids)]:
+            bt_res = load_subset(self.path, sample_ids, feature_ids,
+                                 remove_empty=False)
+            expected = dense.loc[feature_ids or dense.index,
+                                 sample_ids or dense.columns]
+            self.assertEqual(list(bt_res.ids()), list(expected.columns))
+            self.assertEqual(list(bt_res.ids('observation')),
+                             list(expected.index))
+            self.assertTrue(np.array_equal(bt_res.matrix_data.toarray(),
+                                           expected.to_numpy()))
+        # zero sums of the subset are removed
+        bt_res = load_subset(self.path, sids, ['o7'])
+        self.assertTrue(np.all(bt_res.sum('sample') > 0))
+        self.assertEqual(bt_res.shape[1],
+                         (dense.loc['o7', sids] > 0).sum())
+        # s3 summed to zero and is not in the file
+        with self.assertRaises(ValueError):
+            load_subset(self.path, ['s0', 's3'])
+        with self.assertRaises(ValueError):
+            load_subset(self.path, ['s0', 's0'])
+
+    def test_load_subset_empty(self):
+        with HDF5TableWriter(self.path, self.fids) as writer:
+            writer.append(self.mat, self.sids)
+        n_features, n_samples = load_table(self.path).shape
+        for sample_ids, feature_ids, shape in [
+                ([], None, (n_features, 0)), (None, [], (0, n_samples)),
+                ([], [], (0, 0)), (['s0', 's1'], [], (0, 2))]:
+            bt_res = load_subset(self.path, sample_ids, feature_ids,
+                                 remove_empty=False)
+            self.assertEqual(bt_res.shape, shape)
+            self.assertEqual(bt_res.nnz, 0)
+            self.assertEqual(load_subset(self.path, sample_ids,
+                                         feature_ids).shape, (0, 0))
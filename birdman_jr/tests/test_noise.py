@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
-from skbio.stats.composition import closure
+from scipy.sparse import csr_matrix, issparse
+from skbio.stats.composition import closure, alr, alr_inv
 from numpy.testing import assert_array_almost_equal
 from birdman_jr.noise import add_noise
 
@@ -29,6 +30,63 @@ class TestNoise(unittest.TestCase):
                                 percent_normal=0,
                                 percent_random=0,
                                 add_missing_at_random=True,
-                                percent_missing=0.35)
+                                percent_missing=0.35,
+                                seed=42)
         self.assertTrue(round(np.count_nonzero(sparse_mat == 0) / 36, 1)
                         == 0.3)
+
+    def test_seed(self):
+        noisy = add_noise(self.mat, seed=42)
+        self.assertTrue(np.array_equal(noisy, add_noise(self.mat, seed=42)))
+        self.assertFalse(np.array_equal(noisy, add_noise(self.mat, seed=1)))
+        # a generator is drawn from directly
+        rng = np.random.default_rng(42)
+        first = add_noise(self.mat, seed=rng)
+        self.assertFalse(np.array_equal(first, add_noise(self.mat, seed=rng)))
+        self.assertTrue(np.array_equal(
+            first, add_noise(self.mat, seed=np.random.default_rng(42))))
+
+    def test_float32(self):
+        noisy = add_noise(self.mat, seed=0, dtype=np.float32)
+        self.assertEqual(noisy.dtype, np.float32)
+
+    def test_alr_equivalent(self):
+        # without noise the log base closes to the inverse ALR
+        noisy = add_noise(self.mat, percent_normal=0, percent_random=0)
+        expected = alr_inv(alr(self.mat + 1))
+        expected[self.mat == 0] = 0
+        assert_array_almost_equal(noisy, expected)
+
+    def test_zero_row(self):
+        # the pseudocount is added before the log
+        mat = self.mat.copy()
+        mat[2] = 0
+        for mat_in in (mat, csr_matrix(mat)):
+            noisy = add_noise(mat_in, pseudocount=1, seed=42)
+            if issparse(noisy):
+                noisy = noisy.toarray()
+            self.assertTrue(np.all(np.isfinite(noisy)))
+            self.assertTrue(np.all(noisy[2] == 0))
+            self.assertTrue(np.all(noisy[mat > 0] > 0))
+        with self.assertRaises(ValueError):
+            add_noise(mat, pseudocount=0)
+
+    def test_sparse(self):
+        noisy = add_noise(csr_matrix(self.mat), seed=42)
+        self.assertTrue(issparse(noisy))
+        # noise stays on the support of the input
+        self.assertTrue(np.all(noisy.toarray()[self.mat == 0] == 0))
+        assert_array_almost_equal(np.asarray(noisy.sum(1)).ravel(),
+                                  np.ones(self.mat.shape[0]))
+        no_noise = add_noise(csr_matrix(self.mat),
+                             percent_normal=0, percent_random=0)
+        assert_array_almost_equal(no_noise.toarray(),
+                                  closure(np.where(self.mat > 0,
+                                                   self.mat + 1, 0)))
+
+    def test_sparse_missing(self):
+        noisy = add_noise(csr_matrix(self.mat), seed=42,
+                          add_missing_at_random=True,
+                          percent_missing=0.5)
+        self.assertLess(np.count_nonzero(noisy.data),
+                        np.count_nonzero(self.mat))
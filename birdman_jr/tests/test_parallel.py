@@ -0,0 +1,123 @@
+import multiprocessing
+import unittest
+import numpy as np
+from biom import Table
+from scipy.sparse import csr_matrix
+from skbio.stats.composition import closure
+from birdman_jr.base_models import (poisson_lognormal,
+                                    negative_binomial,
+                                    dirichlet_multinomial,
+                                    _simulate_closed)
+from birdman_jr.data_driven import simulate, simulate_replicates
+from birdman_jr.parallel import (child_sequence, n_workers,
+                                 as_seed_sequence, sample_sequence,
+                                 run_blocks, worker_pool, pool_context)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # enough samples for several blocks
+        self.mat = rng.poisson(5, size=(600, 12)) + 1
+        self.depths = self.mat.sum(1).reshape(self.mat.shape[0], -1)
+        self.sids = ['s%i' % i for i in range(self.mat.shape[0])]
+        self.fids = ['o%i' % i for i in range(self.mat.shape[1])]
+        self.bt_test = Table(self.mat.T, self.fids, self.sids)
+
+    def test_child_sequence(self):
+        root = as_seed_sequence(42)
+        spawned = np.random.SeedSequence(42).spawn(3)
+        for i in range(3):
+            self.assertTrue(np.array_equal(
+                child_sequence(root, i).generate_state(4),
+                spawned[i].generate_state(4)))
+        # deriving a child does not advance the root
+        self.assertEqual(root.n_children_spawned, 0)
+
+    def test_sample_sequence(self):
+        root = as_seed_sequence(42)
+        state = sample_sequence(root, 0, 's1').generate_state(4)
+        self.assertTrue(np.array_equal(
+            state, sample_sequence(as_seed_sequence(42), 0,
+                                   's1').generate_state(4)))
+        for seq in [sample_sequence(root, 1, 's1'),
+                    sample_sequence(root, 0, 's2'),
+                    sample_sequence(as_seed_sequence(43), 0, 's1')]:
+            self.assertFalse(np.array_equal(state, seq.generate_state(4)))
+
+    def test_n_workers(self):
+        self.assertEqual(n_workers(None), 1)
+        self.assertEqual(n_workers(3), 3)
+        self.assertTrue(n_workers(-1) >= 1)
+        with self.assertRaises(ValueError):
+            n_workers(0)
+
+    @unittest.skipUnless(
+        'forkserver' in multiprocessing.get_all_start_methods(),
+        'no fork server on this platform')
+    def test_pool_context(self):
+        # the workers never fork the caller, whatever it ran
+        self.assertEqual(pool_context().get_start_method(), 'forkserver')
+        with worker_pool(2) as executor:
+            self.assertEqual(executor._mp_context.get_start_method(),
+                             'forkserver')
+
+    def test_base_models_n_jobs(self):
+        for model in [poisson_lognormal, negative_binomial,
+                      dirichlet_multinomial]:
+            serial = model(self.mat, self.depths, seed=7)[0]
+            pooled = model(self.mat, self.depths, seed=7, n_jobs=2)[0]
+            self.assertTrue(np.array_equal(serial, pooled))
+            other = model(self.mat, self.depths, seed=8)[0]
+            self.assertFalse(np.array_equal(serial, other))
+
+    def test_run_blocks_out_dtype(self):
+        seeds = [as_seed_sequence(7), as_seed_sequence(8)]
+        depths = self.depths * 100
+        expected = run_blocks(_simulate_closed, closure(self.mat), depths,
+                              seeds, model='m')
+        self.assertEqual(expected.dtype, np.int64)
+        self.assertGreater(expected.max(), np.iinfo(np.uint8).max)
+        for n_jobs in [None, 2]:
+            with worker_pool(n_jobs) as executor:
+                narrow = run_blocks(_simulate_closed, closure(self.mat),
+                                    depths, seeds, executor=executor,
+                                    out_dtype=np.uint32, model='m')
+                # a count overflows, drawn again as np.int64
+                wide = run_blocks(_simulate_closed, closure(self.mat),
+                                  depths, seeds, executor=executor,
+                                  out_dtype=np.uint8, model='m')
+            self.assertEqual(narrow.dtype, np.uint32)
+            self.assertEqual(wide.dtype, np.int64)
+            self.assertTrue(np.array_equal(narrow, expected))
+            self.assertTrue(np.array_equal(wide, expected))
+
+    def test_sparse_n_jobs(self):
+        serial = dirichlet_multinomial(csr_matrix(self.mat), self.depths,
+                                       seed=7)[0]
+        pooled = dirichlet_multinomial(csr_matrix(self.mat), self.depths,
+                                       seed=7, n_jobs=2)[0]
+        self.assertTrue(np.array_equal(serial.toarray(), pooled.toarray()))
+
+    def test_simulate_n_jobs(self):
+        serial = simulate(self.bt_test, distribution='nb', seed=3)
+        pooled = simulate(self.bt_test, distribution='nb', seed=3,
+                          n_jobs=2)
+        self.assertTrue(serial == pooled)
+
+    def test_replicates_n_jobs(self):
+        serial = simulate_replicates(self.bt_test, 3, seed=5,
+                                     output='array')
+        pooled = simulate_replicates(self.bt_test, 3, seed=5,
+                                     output='array', n_jobs=2)
+        self.assertTrue(np.array_equal(serial, pooled))
+        tables = list(simulate_replicates(self.bt_test, 3, seed=5,
+                                          n_jobs=2))
+        for i in range(3):
+            self.assertTrue(np.array_equal(
+                tables[i].matrix_data.toarray().T, serial[i]))
+        # replicate i is simulate() seeded with the i-th child
+        single = simulate(self.bt_test, seed=child_sequence(
+            as_seed_sequence(5), 1))
+        self.assertTrue(single == tables[1])
@@ -0,0 +1,101 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from birdman_jr.regression import negative_binomial_regression
+
+STAN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, os.pardir, "stan-tmp")
+PARSE = os.path.join(STAN_DIR, "parse.py")
+
+
+def load_parse():
+    spec = importlib.util.spec_from_file_location("parse", PARSE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_stan_csv(path, draws):
+    # CmdStan layout: comment header, column-major
+    # names and values per variable, comment footer
+    names, values = ["lp__", "accept_stat__"], [np.zeros((len(
+        draws["y_sim"]), 2))]
+    for name in ["y_sim", "beta_var", "lam_clr", "phi"]:
+        array = draws[name]
+        shape = array.shape[1:]
+        for flat in range(int(np.prod(shape))):
+            dims = np.unravel_index(flat, shape, order="F")
+            names.append(".".join([name] + [str(i + 1) for i in dims]))
+        values.append(array.reshape(len(array), -1, order="F"))
+    with open(path, "w") as fh:
+        fh.write("# model = sim_nb_model\n#   sample\n")
+        fh.write(",".join(names) + "\n")
+        fh.write("# Adaptation terminated\n")
+        np.savetxt(fh, np.hstack(values), delimiter=",", fmt="%.17g")
+        fh.write("# \n#  Elapsed Time: 0 seconds (Warm-up)\n# \n")
+
+
+@unittest.skipUnless(os.path.exists(PARSE), "no stan-tmp/parse.py")
+class TestParse(unittest.TestCase):
+
+    def setUp(self):
+        self.parse = load_parse()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "sim_nb-1.csv")
+        x = np.ones((6, 2))
+        x[:3, 1] = 0
+        self.draws = negative_binomial_regression(
+            x, np.log(np.full(6, 100)), 5, n_draws=7, seed=42)
+        write_stan_csv(self.path, self.draws)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_read_file(self):
+        # chunks smaller than the draws
+        parsed = self.parse.read_file(self.path, chunk_size=3)
+        for name, array in self.draws.items():
+            assert_allclose(parsed[name], array, rtol=1e-14)
+
+    def test_mmap(self):
+        parsed = self.parse.read_file(self.path, mmap_dir=self.tmp)
+        self.assertIsInstance(parsed["y_sim"], np.memmap)
+        y_sim = np.load(os.path.join(self.tmp, "y_sim.npy"))
+        self.assertTrue(np.array_equal(y_sim, self.draws["y_sim"]))
+
+    def test_read_cached(self):
+        cache_dir = os.path.join(self.tmp, "cache")
+        parsed = self.parse.read_cached(self.path, cache_dir)
+        for name, array in self.draws.items():
+            self.assertIsInstance(parsed[name], np.memmap)
+            assert_allclose(parsed[name], array, rtol=1e-14)
+        # a second read maps the cached files without parsing
+        entry, = os.listdir(cache_dir)
+        stamp = os.stat(os.path.join(cache_dir, entry,
+                                     "y_sim.npy")).st_mtime_ns
+        self.parse.read_cached(self.path, cache_dir)
+        self.assertEqual(os.stat(os.path.join(cache_dir, entry,
+                                              "y_sim.npy")).st_mtime_ns,
+                         stamp)
+        self.assertEqual(os.listdir(cache_dir), [entry])
+
+    def test_read_cached_invalidation(self):
+        cache_dir = os.path.join(self.tmp, "cache")
+        self.parse.read_cached(self.path, cache_dir)
+        draws = {name: array[:2] for name, array in self.draws.items()}
+        write_stan_csv(self.path, draws)
+        parsed = self.parse.read_cached(self.path, cache_dir)
+        self.assertEqual(len(parsed["y_sim"]), 2)
+        assert_allclose(parsed["phi"], draws["phi"], rtol=1e-14)
+
+    def test_missing_variable(self):
+        with self.assertRaises(ValueError):
+            self.parse.read_file(self.path, variables=["mu"])
+
+
+if __name__ == "__main__":
+    unittest.main()
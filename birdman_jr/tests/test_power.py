@@ -0,0 +1,104 @@
+import unittest
+import numpy as np
+import pandas as pd
+from biom import Table
+from scipy.stats import (false_discovery_control, mannwhitneyu,
+                         ttest_ind)
+from birdman_jr.power import (power_analysis, power_curves,
+                              _bh, _welch_pvalues, _wilcoxon_pvalues)
+
+
+class TestPower(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        mat = rng.poisson(rng.lognormal(3, 1, size=(1, 20)),
+                          size=(24, 20)) + 1
+        self.fids = ['o%i' % i for i in range(20)]
+        self.sids = ['s%i' % i for i in range(24)]
+        self.bt_test = Table(mat.T, self.fids, self.sids)
+        self.groups = ['a', 'b'] * 12
+        self.lfc = np.zeros(20)
+        self.lfc[:4] = 2
+        self.group = np.array(self.groups) == 'b'
+
+    def test_tests_match_scipy(self):
+        rng = np.random.default_rng(1)
+        # integers give ties
+        x = rng.integers(0, 4, size=(3, 24, 5)).astype(float)
+        expected = [[mannwhitneyu(x[r, self.group, f],
+                                  x[r, ~self.group, f],
+                                  method='asymptotic').pvalue
+                     for f in range(5)] for r in range(3)]
+        np.testing.assert_allclose(_wilcoxon_pvalues(x, self.group),
+                                   expected, rtol=1e-12)
+        x = rng.normal(size=(3, 24, 5))
+        expected = ttest_ind(x[:, self.group], x[:, ~self.group], axis=1,
+                             equal_var=False).pvalue
+        np.testing.assert_allclose(_welch_pvalues(x, self.group),
+                                   expected, rtol=1e-10)
+        # constant features are never discoveries
+        self.assertTrue(np.all(_welch_pvalues(np.ones((1, 24, 2)),
+                                              self.group) == 1))
+        self.assertTrue(np.all(_wilcoxon_pvalues(np.ones((1, 24, 2)),
+                                                 self.group) == 1))
+        pvalues = rng.random((4, 50))
+        np.testing.assert_allclose(_bh(pvalues),
+                                   false_discovery_control(pvalues, axis=1))
+
+    def test_power_analysis(self):
+        replicates, features = power_analysis(
+            self.bt_test, self.groups, self.lfc, n_replicates=40,
+            alphas=[0.05, 0.1], chunk_size=16, seed=42)
+        self.assertEqual(len(replicates), 2 * 2 * 40)
+        self.assertEqual(len(features), 2 * 2 * 20)
+        self.assertGreater(replicates.attrs['replicates_per_second'], 0)
+        self.assertTrue(np.array_equal(
+            replicates['true_positives'] + replicates['false_positives'],
+            replicates['discoveries']))
+        curves = power_curves(replicates)
+        self.assertEqual(list(curves.index),
+                         [('t', 0.05), ('t', 0.1),
+                          ('wilcoxon', 0.05), ('wilcoxon', 0.1)])
+        # a fold change of e^2 is found in most replicates
+        self.assertTrue(np.all(curves['power'] > 0.5))
+        self.assertTrue(np.all(curves.xs(0.1, level='alpha')['power']
+                               >= curves.xs(0.05, level='alpha')['power']))
+        rates = features.groupby(['test', 'alpha', 'log_fold_change'])
+        rates = rates['detection_rate'].mean()
+        self.assertTrue(np.all(rates.xs(0.0, level='log_fold_change')
+                               < rates.xs(2.0, level='log_fold_change')))
+        # chunking does not change the draws
+        again, _ = power_analysis(
+            self.bt_test, self.groups, self.lfc, n_replicates=40,
+            alphas=[0.05, 0.1], chunk_size=7, seed=42)
+        pd.testing.assert_frame_equal(
+            replicates.sort_values(['test', 'alpha', 'replicate'])
+            .reset_index(drop=True),
+            again.sort_values(['test', 'alpha', 'replicate'])
+            .reset_index(drop=True))
+
+    def test_null(self):
+        # no effect, the discoveries are all false
+        replicates, features = power_analysis(
+            self.bt_test, pd.Series(self.groups, index=self.sids),
+            pd.Series(dtype=float), n_replicates=20, tests=['t'],
+            seed=42)
+        self.assertTrue(replicates['power'].isna().all())
+        self.assertEqual(replicates['true_positives'].sum(), 0)
+        self.assertLess(features['detection_rate'].mean(), 0.1)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            power_analysis(self.bt_test, ['a'] * 24, self.lfc)
+        with self.assertRaises(ValueError):
+            power_analysis(self.bt_test, ['a'] + ['b'] * 23, self.lfc)
+        with self.assertRaises(ValueError):
+            power_analysis(self.bt_test, self.groups, self.lfc[:3])
+        with self.assertRaises(ValueError):
+            power_analysis(self.bt_test, self.groups, self.lfc,
+                           tests=['anova'])
+
+
+if __name__ == "__main__":
+    unittest.main()
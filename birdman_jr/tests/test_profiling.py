@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import numpy as np
+from biom import Table
+from birdman_jr.data_driven import simulate, simulate_replicates
+from birdman_jr.profiling import profile, stage
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        mat = rng.poisson(20, size=(30, 8)) + 1
+        self.bt_test = Table(mat.T, ['o%i' % i for i in range(8)],
+                             ['s%i' % i for i in range(30)])
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_simulate_stages(self):
+        with profile() as prof:
+            res = simulate(self.bt_test, impose_noise=True, seed=42)
+        stages = [record['stage'] for record in prof.records]
+        self.assertEqual(stages, ['simulate/densify', 'simulate/noise_base',
+                                  'simulate/noise', 'simulate/kernel',
+                                  'simulate/output_validation',
+                                  'simulate/table', 'simulate'])
+        records = {record['stage']: record for record in prof.records}
+        self.assertEqual(records['simulate/densify']['shape'], (30, 8))
+        self.assertEqual(records['simulate/kernel']['replicate'], 0)
+        self.assertEqual(records['simulate/output_validation']
+                         ['output_shape'], res.shape[::-1])
+        for record in prof.records:
+            self.assertGreaterEqual(record['seconds'], 0)
+            self.assertGreaterEqual(record['bytes'], 0)
+        # the enclosing stage holds its nested stages
+        self.assertGreaterEqual(prof.total('simulate'),
+                                sum(record['seconds']
+                                    for record in prof.records[:-1]))
+        self.assertGreaterEqual(records['simulate']['bytes'],
+                                records['simulate/noise_base']['bytes'])
+        # profiling does not change the draws
+        self.assertEqual(res, simulate(self.bt_test, impose_noise=True,
+                                       seed=42))
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_replicates(self):
+        with profile(trace_memory=False) as prof:
+            list(simulate_replicates(self.bt_test, 3, seed=42, offset=2))
+        kernels = [record for record in prof.records
+                   if record['stage'] == 'replicate/kernel']
+        self.assertEqual([record['replicate'] for record in kernels],
+                         [2, 3, 4])
+        self.assertTrue(all(record['bytes'] is None
+                            for record in prof.records))
+        with profile() as prof:
+            simulate_replicates(self.bt_test, 3, seed=42, output='array')
+        kernels = [record for record in prof.records
+                   if record['stage'] == 'kernel']
+        self.assertEqual(len(kernels), 1)
+        self.assertEqual(kernels[0]['replicates'], 3)
+
+    def test_export(self):
+        with profile() as prof:
+            simulate(self.bt_test, seed=42)
+        path = os.path.join(self.tmp, 'profile.json')
+        prof.to_json(path)
+        with open(path) as fh:
+            exported = json.load(fh)
+        self.assertEqual(len(exported['records']), len(prof.records))
+        self.assertEqual(exported['records'][0]['shape'], [30, 8])
+        frame = prof.to_frame()
+        self.assertEqual(list(frame['stage']),
+                         [record['stage'] for record in prof.records])
+
+    def test_disabled(self):
+        # nothing is recorded outside profile
+        self.assertIs(stage('simulate'), stage('kernel', replicate=0))
+        with stage('simulate') as details:
+            self.assertIsNone(details)
+        with profile() as prof:
+            pass
+        simulate(self.bt_test, seed=42)
+        self.assertEqual(prof.records, [])
+
+    def test_nested_profiles(self):
+        with profile() as outer:
+            with stage('outer'):
+                with profile(trace_memory=False) as inner:
+                    with stage('inner', n=1):
+                        pass
+        self.assertEqual([record['stage'] for record in outer.records],
+                         ['outer/inner', 'outer'])
+        self.assertEqual(inner.records[0]['stage'], 'inner')
+        self.assertEqual(inner.records[0]['n'], 1)
+        self.assertIsNone(inner.records[0]['bytes'])
+        self.assertIsNotNone(outer.records[0]['bytes'])
+
+
+if __name__ == "__main__":
+    unittest.main()
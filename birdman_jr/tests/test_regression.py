@@ -0,0 +1,132 @@
+import os
+import unittest
+import numpy as np
+import pandas as pd
+from scipy.stats import ks_2samp
+from numpy.testing import assert_allclose
+from birdman_jr.regression import negative_binomial_regression
+
+STAN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, os.pardir, "stan-tmp")
+STAN_CSV = os.path.join(STAN_DIR, "output", "sim_nb-202106021451-1.csv")
+
+try:
+    import cmdstanpy
+except ImportError:
+    cmdstanpy = None
+
+
+def stan_columns(df, name, shape):
+    cols = [c for c in df.columns if c.startswith(name + ".")]
+    return df[cols].values.reshape((len(df),) + shape, order="F")
+
+
+class TestRegression(unittest.TestCase):
+
+    def setUp(self):
+        # the design of stan-tmp/sim_nb.py
+        self.N, self.D = 50, 20
+        self.x = np.ones((self.N, 2))
+        self.x[:self.N // 2, 1] = 0
+        self.depth = np.log(np.full(self.N, 100))
+
+    def test_shapes(self):
+        sim = negative_binomial_regression(self.x, self.depth, self.D,
+                                           seed=42)
+        self.assertEqual(sim["y_sim"].shape, (self.N, self.D))
+        self.assertEqual(sim["beta_var"].shape, (2, self.D - 1))
+        self.assertEqual(sim["lam_clr"].shape, (self.N, self.D))
+        self.assertEqual(sim["phi"].shape, (self.D,))
+        self.assertTrue(np.all(sim["lam_clr"][:, 0] == 0))
+        assert_allclose(sim["lam_clr"][:, 1:], self.x @ sim["beta_var"])
+        draws = negative_binomial_regression(self.x, self.depth, self.D,
+                                             n_draws=3, seed=42)
+        self.assertEqual(draws["y_sim"].shape, (3, self.N, self.D))
+        assert_allclose(draws["lam_clr"][..., 1:],
+                        self.x @ draws["beta_var"])
+
+    def test_table(self):
+        bt = negative_binomial_regression(self.x, self.depth, self.D,
+                                          seed=42, output="table")
+        self.assertEqual(bt.shape, (self.D, self.N))
+        sim = negative_binomial_regression(self.x, self.depth, self.D,
+                                           seed=42)
+        self.assertTrue(np.array_equal(bt.matrix_data.toarray(),
+                                       sim["y_sim"].T))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            negative_binomial_regression(self.x[:, :1], self.depth, self.D)
+        with self.assertRaises(ValueError):
+            negative_binomial_regression(self.x, self.depth[1:], self.D)
+        with self.assertRaises(ValueError):
+            negative_binomial_regression(self.x, self.depth, 1)
+        with self.assertRaises(ValueError):
+            negative_binomial_regression(self.x, self.depth, self.D,
+                                         output="tables")
+        with self.assertRaises(ValueError):
+            negative_binomial_regression(self.x, self.depth, self.D,
+                                         n_draws=2, output="table")
+
+    def test_moments(self):
+        draws = negative_binomial_regression(self.x, self.depth, self.D,
+                                             B_p=0.5, n_draws=4000,
+                                             seed=42)
+        beta = draws["beta_var"]
+        assert_allclose(beta.mean((0, 2)), [-2, 0], atol=0.02)
+        assert_allclose(beta.std((0, 2)), [0.5, 0.5], atol=0.02)
+        # the median of a half-Cauchy is its scale
+        self.assertAlmostEqual(np.median(draws["phi"]), 1, delta=0.05)
+        # the last sample sets the mean of the group coefficient
+        x = self.x[::-1]
+        beta = negative_binomial_regression(x, self.depth, self.D,
+                                            n_draws=1000,
+                                            seed=42)["beta_var"]
+        self.assertAlmostEqual(beta[:, 1].mean(), 1, delta=0.05)
+
+    def test_poisson_limit(self):
+        # a huge dispersion scale leaves Poisson counts
+        draws = negative_binomial_regression(self.x, self.depth, self.D,
+                                             phi_s=1e8, n_draws=2000,
+                                             seed=42)
+        mu = np.exp(self.depth[:, None] + draws["lam_clr"])
+        resid = (draws["y_sim"] - mu) / np.sqrt(mu)
+        self.assertAlmostEqual(resid.mean(), 0, delta=0.01)
+        self.assertAlmostEqual(resid.var(), 1, delta=0.05)
+
+    @unittest.skipUnless(os.path.exists(STAN_CSV), "no Stan output")
+    def test_stan_output(self):
+        # the stored fixed_param draw of sim_nb.stan
+        df = pd.read_csv(STAN_CSV, comment="#")
+        beta = stan_columns(df, "beta_var", (2, self.D - 1))[0]
+        lam_clr = stan_columns(df, "lam_clr", (self.N, self.D))[0]
+        phi = stan_columns(df, "phi", (self.D,))[0]
+        assert_allclose(lam_clr[:, 0], 0)
+        assert_allclose(lam_clr[:, 1:], self.x @ beta, atol=1e-5)
+        draws = negative_binomial_regression(self.x, self.depth, self.D,
+                                             n_draws=500, seed=42)
+        for stan, ours in [(phi, draws["phi"]),
+                           (beta[0], draws["beta_var"][:, 0]),
+                           (beta[1], draws["beta_var"][:, 1])]:
+            self.assertGreater(ks_2samp(stan, ours.ravel()).pvalue, 0.001)
+
+    @unittest.skipIf(cmdstanpy is None, "cmdstanpy is not installed")
+    def test_stan_equivalence(self):
+        model = cmdstanpy.CmdStanModel(
+            stan_file=os.path.join(STAN_DIR, "sim_nb.stan"))
+        n_draws = 1000
+        fit = model.sample(fixed_param=True, iter_sampling=n_draws,
+                           chains=1, seed=42,
+                           data={"N": self.N, "D": self.D,
+                                 "depth": self.depth, "x": self.x,
+                                 "B_p": 1, "phi_s": 1})
+        stan = fit.stan_variables()
+        ours = negative_binomial_regression(self.x, self.depth, self.D,
+                                            n_draws=n_draws, seed=42)
+        for name in ["y_sim", "beta_var", "lam_clr", "phi"]:
+            self.assertGreater(ks_2samp(np.ravel(stan[name]),
+                                        ours[name].ravel()).pvalue, 0.001)
+
+
+if __name__ == "__main__":
+    unittest.main()
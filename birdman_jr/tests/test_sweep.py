@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+from biom import Table
+from birdman_jr.data_driven import simulate
+from birdman_jr.parallel import as_seed_sequence, child_sequence
+from birdman_jr.sweep import expand_grid, sweep
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        mat = np.random.default_rng(0).poisson(20, size=(8, 12))
+        self.bt_test = Table(mat, ['o%i' % i for i in range(8)],
+                             ['s%i' % i for i in range(12)])
+        self.grid = {"distribution": ["pln", "dm"],
+                     "kappa": [0.5, 2],
+                     "impose_noise": [False, True]}
+
+    def test_expand_grid(self):
+        points = expand_grid(self.grid)
+        self.assertEqual(len(points), 8)
+        self.assertEqual(points.index.name, "point")
+        self.assertTrue(np.all(points["pseudocount"] == 1))
+        points = expand_grid([{"distribution": "m"},
+                              {"distribution": "nb", "kappa": [1, 3]}])
+        self.assertEqual(points["distribution"].tolist(), ["m", "nb", "nb"])
+        with self.assertRaises(ValueError):
+            expand_grid({"depths": [1]})
+
+    def test_sweep(self):
+        index, tables = sweep(self.bt_test, self.grid, n_replicates=2,
+                              seed=42)
+        self.assertEqual(len(index), 16)
+        self.assertEqual(index["replicate"].tolist(), [0, 1] * 8)
+        root = as_seed_sequence(42)
+        for i, bt_res in tables:
+            row = index.loc[i]
+            params = row.drop(["point", "replicate"]).to_dict()
+            expected = simulate(self.bt_test,
+                                seed=child_sequence(root, row["point"],
+                                                    row["replicate"]),
+                                **params)
+            self.assertTrue(bt_res == expected)
+
+    def test_sweep_auto_kappa(self):
+        index, tables = sweep(self.bt_test, {"distribution": "nb",
+                                             "kappa": [0.5, "auto"]},
+                              seed=0)
+        self.assertEqual(index["kappa"].tolist(), [0.5, "auto"])
+        root = as_seed_sequence(0)
+        for (i, bt_res), kappa in zip(tables, [0.5, "auto"]):
+            self.assertTrue(bt_res == simulate(
+                self.bt_test, distribution="nb", kappa=kappa,
+                seed=child_sequence(root, i, 0)))
+
+    def test_sweep_pool(self):
+        index, tables = sweep(self.bt_test, self.grid, seed=42)
+        _, pooled = sweep(self.bt_test, self.grid, seed=42, n_jobs=2)
+        for (i, bt_res), (j, bt_pool) in zip(tables, pooled):
+            self.assertEqual(i, j)
+            self.assertTrue(bt_res == bt_pool)
+
+    def test_sweep_errors(self):
+        # raised before any point is drawn
+        with self.assertRaises(ValueError):
+            sweep(self.bt_test, {"distribution": ["pln", "poisson"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
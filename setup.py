@@ -32,8 +32,12 @@ setup(name='birdman_jr',
           'numpy',
           'biom',
           'pandas',
+          'h5py',
+          'click',
       ],
-      entry_points={},
+      entry_points={
+          'console_scripts': ['birdman-jr=birdman_jr.cli:cli'],
+      },
       package_data={},
       #scripts=glob('birdman_jr/scripts/*'),
       classifiers=classifiers)
\ No newline at end of file
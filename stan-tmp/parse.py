@@ -1,38 +1,205 @@
-import re
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 
+import numpy as np
 import pandas as pd
 
+# generated quantities of sim_nb.stan
+VARIABLES = ["y_sim", "lam_clr", "beta_var", "phi"]
+# written last, a cache entry without it is incomplete
+MANIFEST = "manifest.json"
 
-def read_file(filepath):
-    df = pd.read_csv(filepath, skiprows=31, skipfooter=5)
-    cols_to_drop = ["lp__", "accept_stat__"]
-    df = df.drop(columns=cols_to_drop)
-
-    y_sim_cols = [x for x in df.columns if "y_sim" in x]
-    # read last column entry to get dimensions
-    N, D = map(
-        int,
-        re.search("y_sim\\.(\\d+)\\.(\\d+)", y_sim_cols[-1]).groups()
-    )
-    y_sim = df[y_sim_cols].values.reshape(N, D, order="F")
-
-    lam_clr_cols = [x for x in df.columns if "lam_clr" in x]
-    lam_clr = df[lam_clr_cols].values.reshape(N, D, order="F")
-
-    beta_var_cols = [x for x in df.columns if "beta_var" in x]
-    p, _ = map(
-        int,
-        re.search("beta_var\\.(\\d+)\\.(\\d+)", beta_var_cols[-1]).groups()
-    )
-    beta_var = df[beta_var_cols].values.reshape(p, (D-1), order="F")
-
-    phi_cols = [x for x in df.columns if "phi" in x]
-    phi = df[phi_cols].values
-
-    return {
-        "table": df,
-        "y_sim": y_sim,
-        "lam_clr": lam_clr,
-        "beta_var": beta_var,
-        "phi": phi
-    }
+
+def read_file(filepath, variables=VARIABLES, chunk_size=1000,
+              mmap_dir=None):
+    """
+    Read the draws of a CmdStan CSV output.
+
+    The comment header and footer are skipped by the
+    C parser, the column names are indexed once and
+    the draws are streamed chunk by chunk into arrays
+    preallocated with one leading axis of draws.
+
+    Parameters
+    ----------
+    filepath: str
+        CmdStan CSV output.
+    variables: list of str
+        Variables to extract.
+        Default is y_sim, lam_clr, beta_var and phi.
+    chunk_size: int
+        Number of draws parsed at once.
+        Default is 1000.
+    mmap_dir: str or None
+        If given, each variable is written to a
+        memory-mapped <mmap_dir>/<variable>.npy
+        instead of being held in memory.
+        Default is None.
+
+    Returns
+    -------
+    dict
+       One (draws x dims) array per variable,
+       e.g. y_sim is (draws x N x D).
+    """
+
+    header, n_draws = _scan(filepath)
+    index = column_index(header, variables)
+    arrays = {}
+    for name, (start, stop, shape) in index.items():
+        shape = (n_draws,) + shape
+        if mmap_dir is None:
+            arrays[name] = np.empty(shape)
+        else:
+            arrays[name] = np.lib.format.open_memmap(
+                os.path.join(mmap_dir, name + ".npy"), mode="w+",
+                dtype=np.float64, shape=shape)
+
+    # only the columns of the variables are converted
+    first = min(start for start, _, _ in index.values())
+    last = max(stop for _, stop, _ in index.values())
+    reader = pd.read_csv(filepath, comment="#", engine="c",
+                         usecols=range(first, last), dtype=np.float64,
+                         chunksize=chunk_size)
+    row = 0
+    for chunk in reader:
+        values = chunk.to_numpy()
+        rows = slice(row, row + len(values))
+        for name, (start, stop, shape) in index.items():
+            block = values[:, start - first:stop - first]
+            # CmdStan flattens the dimensions in column-major order
+            block = block.reshape((len(values),) + shape[::-1])
+            arrays[name][rows] = block.transpose(
+                (0,) + tuple(range(len(shape), 0, -1)))
+        row += len(values)
+
+    for array in arrays.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    return arrays
+
+
+def read_cached(filepath, cache_dir=None, variables=VARIABLES,
+                chunk_size=1000):
+    """
+    Read the draws of a CmdStan CSV output through a
+    cache of .npy files.
+
+    The first read parses the CSV with read_file into
+    one .npy file per variable. Later reads memory-map
+    them (read-only) as long as the CSV has the same
+    path, size and modification time, otherwise it is
+    parsed again.
+
+    Parameters
+    ----------
+    filepath: str
+        CmdStan CSV output.
+    cache_dir: str or None
+        Directory of the cache, one entry per CSV.
+        Default is None (.cache next to the CSV).
+    variables: list of str
+        Variables to extract, as in read_file.
+    chunk_size: int
+        Number of draws parsed at once, as in read_file.
+
+    Returns
+    -------
+    dict
+       One read-only memory-mapped (draws x dims)
+       array per variable.
+    """
+
+    filepath = os.path.abspath(filepath)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(filepath), ".cache")
+    entry = os.path.join(cache_dir, hashlib.blake2b(
+        filepath.encode(), digest_size=16).hexdigest())
+    stat = os.stat(filepath)
+    key = {"path": filepath, "size": stat.st_size,
+           "mtime_ns": stat.st_mtime_ns}
+    manifest = _read_manifest(entry)
+    if manifest is None or manifest["key"] != key or \
+            not set(variables) <= set(manifest["variables"]):
+        # parse into a fresh directory and swap it in
+        # whole, so a reader never sees a partial entry
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            read_file(filepath, variables, chunk_size, mmap_dir=tmp)
+            with open(os.path.join(tmp, MANIFEST), "w") as fh:
+                json.dump({"key": key, "variables": list(variables)}, fh)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    return {name: np.load(os.path.join(entry, name + ".npy"),
+                          mmap_mode="r")
+            for name in variables}
+
+
+def _read_manifest(entry):
+    try:
+        with open(os.path.join(entry, MANIFEST)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def column_index(header, variables=VARIABLES):
+    """
+    Map each variable to the (start, stop) slice of
+    its columns and its dimensions, from the names
+    of the header (e.g. y_sim.1.1 ... y_sim.N.D).
+    """
+
+    names = header.split(",")
+    index = {}
+    start = 0
+    while start < len(names):
+        name = names[start].split(".", 1)[0]
+        stop = start + 1
+        while stop < len(names) and \
+                names[stop].split(".", 1)[0] == name:
+            stop += 1
+        if name in variables:
+            # the last column holds the dimensions
+            shape = tuple(int(i) for i in names[stop - 1].split(".")[1:])
+            if int(np.prod(shape)) != stop - start:
+                raise ValueError("columns of %s are not contiguous" % name)
+            index[name] = (start, stop, shape)
+        start = stop
+    missing = set(variables) - set(index)
+    if missing:
+        raise ValueError("variables not found: %s"
+                         % ", ".join(sorted(missing)))
+
+    return index
+
+
+def _scan(filepath):
+    """
+    Header line and number of draws, counting the
+    lines that are not comments in one binary pass.
+    """
+
+    header = None
+    n_lines = 0
+    with open(filepath, "rb") as fh:
+        for line in fh:
+            if line.startswith(b"#") or not line.strip():
+                continue
+            if header is None:
+                header = line.decode().strip()
+            else:
+                n_lines += 1
+    if header is None:
+        raise ValueError("no header in %s" % filepath)
+
+    return header, n_lines